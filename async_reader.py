@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import time
+from evdev import InputDevice
+from logging_manager import logger
+
+class AsyncReader:
+    def __init__(self, input_manager, event_processor, recorder=None):
+        self.input_manager = input_manager
+        self.event_processor = event_processor
+        self.recorder = recorder
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name="AsyncReader", daemon=True)
+        self.tasks = {}
+
+    # Run the event loop that reads every device
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # Start the loop and begin reading the given (path, name) pairs
+    def start(self, devices):
+        self.thread.start()
+        for device_path, name in devices:
+            self.add_device(device_path, name)
+
+    # Start reading a device, safe to call from any thread
+    def add_device(self, device_path, name):
+        self.loop.call_soon_threadsafe(self.create_task, device_path, name)
+
+    # Stop reading a device, safe to call from any thread
+    def remove_device(self, device_path):
+        self.loop.call_soon_threadsafe(self.cancel_task, device_path)
+
+    def create_task(self, device_path, name):
+        if device_path not in self.tasks:
+            self.tasks[device_path] = self.loop.create_task(self.read_device(device_path, name))
+
+    def cancel_task(self, device_path):
+        task = self.tasks.get(device_path)
+        if task:
+            task.cancel()
+
+    # Pair a device and queue its events until it is cancelled or removed
+    async def read_device(self, device_path, name):
+        if not self.input_manager.pair_device(device_path, name, f"{self.thread.name}:{device_path}"):
+            logger.error(f"Failed to pair device {device_path}")
+            self.tasks.pop(device_path, None)
+            return
+
+        events = self.event_processor.add_device(device_path)
+        recorder = self.recorder
+        if recorder:
+            recorder.add_device(device_path, name)
+        try:
+            inputs = InputDevice(device_path)
+            try:
+                async for event in inputs.async_read_loop():
+                    events.append((event.type, event.code, event.value, time.perf_counter()))
+                    if recorder:
+                        recorder.record(device_path, event.timestamp(), event.type, event.code, event.value)
+            finally:
+                inputs.close()
+        except OSError as error:
+            logger.warning(f"Stopped reading {device_path}: {error}")
+        finally:
+            self.event_processor.remove_device(device_path)
+            self.tasks.pop(device_path, None)
+
+    # Cancel every reader and wait for them to unpair
+    async def shutdown(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Stop the loop and its thread, returning once every device is released
+    def stop(self, timeout=2):
+        if not self.thread.is_alive():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(timeout)
+        except Exception as error:
+            logger.warning(f"Async input shutdown incomplete: {error}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        if not self.loop.is_running():
+            self.loop.close()
@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import random
+import resource
+import time
+
+# Render into an off-screen framebuffer so the benchmark runs headless
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+from evdev import ecodes
+from config import DEFAULT_CONFIG
+from input_manager import InputManager
+from canvas import Canvas
+from header_manager import HeaderManager
+from event_processor import EventProcessor
+from motion_predictor import MotionPredictor
+from session_recorder import read_session
+
+WIDTH, HEIGHT = 1920, 1080
+HEADER_HEIGHT = 100
+COLORS = DEFAULT_CONFIG.palette
+# The first simulated mouse is an admin
+ADMIN_NAME = next(device.name for device in DEFAULT_CONFIG.devices if device.role == "admin")
+
+
+# Yield the raw events of one simulated mouse forever, one report at a
+# time: a press, a random walk of motion reports, and a release
+def synthetic_events(rng, stroke_length=(50, 400)):
+    while True:
+        yield [(ecodes.EV_KEY, ecodes.BTN_LEFT, 1), (ecodes.EV_SYN, ecodes.SYN_REPORT, 0)]
+        dx, dy = rng.randint(-7, 7), rng.randint(-7, 7)
+        for _ in range(rng.randint(*stroke_length)):
+            dx = max(-7, min(7, dx + rng.randint(-2, 2)))
+            dy = max(-7, min(7, dy + rng.randint(-2, 2)))
+            yield [(ecodes.EV_REL, ecodes.REL_X, dx), (ecodes.EV_REL, ecodes.REL_Y, dy), (ecodes.EV_SYN, ecodes.SYN_REPORT, 0)]
+        yield [(ecodes.EV_KEY, ecodes.BTN_LEFT, 0), (ecodes.EV_SYN, ecodes.SYN_REPORT, 0)]
+        # Move somewhere else on the canvas before the next stroke
+        yield [(ecodes.EV_REL, ecodes.REL_X, rng.randint(-300, 300)), (ecodes.EV_REL, ecodes.REL_Y, rng.randint(-200, 200)), (ecodes.EV_SYN, ecodes.SYN_REPORT, 0)]
+
+
+# Return the value at a percentile of a sorted list
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Simulation:
+    def __init__(self, users, rate, fps, seed=0, low_latency=False):
+        self.screen = pygame.display.set_mode((WIDTH, HEIGHT))
+        self.canvas_layer = pygame.Surface((WIDTH, HEIGHT))
+        self.canvas_surface = self.canvas_layer.subsurface((0, HEADER_HEIGHT, WIDTH, HEIGHT - HEADER_HEIGHT))
+        self.canvas_surface.fill((255, 255, 255))
+        self.header_surface = pygame.Surface((WIDTH, HEADER_HEIGHT))
+        self.input_manager = InputManager(WIDTH, HEIGHT)
+        self.canvas = Canvas(self.canvas_surface, self.input_manager, header_height=HEADER_HEIGHT)
+        self.header_manager = HeaderManager(self.header_surface, COLORS)
+        self.event_processor = EventProcessor(self.input_manager, self.header_manager, WIDTH, HEIGHT, header_height=HEADER_HEIGHT, viewport=self.canvas.viewport)
+        # Draw current lines every frame and stroke tips ahead of the input,
+        # like main.py --low-latency
+        self.predictor = None
+        if low_latency:
+            self.canvas.refresh_interval = 0
+            self.predictor = MotionPredictor()
+        self.fps = fps
+        # Reports each simulated mouse sends per frame
+        self.reports_per_frame = max(1, rate // fps)
+        self.streams = {}
+        self.queues = {}
+        for user in range(users):
+            name = ADMIN_NAME if user == 0 else f"Simulated Mouse {user}"
+            self.add_stream(f"/dev/input/sim{user}", name, synthetic_events(random.Random(seed + user)))
+
+        self.frame_times = []
+        self.latencies = []
+        self.pending = []
+        self.events = 0
+
+    # Pair a simulated device fed by a generator of event lists
+    def add_stream(self, device_path, name, stream):
+        self.input_manager.pair_device(device_path, name, device_path)
+        self.queues[device_path] = self.event_processor.add_device(device_path)
+        self.streams[device_path] = stream
+
+    def set_tool(self, tool, users=None):
+        for device_path in list(self.streams)[:users]:
+            self.input_manager.set_tool(device_path, tool)
+
+    # Queue one frame worth of input, then run the same per-frame work as
+    # the main loop
+    def frame(self):
+        pushed_at = time.perf_counter()
+        for device_path, stream in self.streams.items():
+            queue = self.queues[device_path]
+            for _ in range(self.reports_per_frame):
+                report = next(stream, ())
+                queue.extend(event + (pushed_at,) for event in report)
+                self.events += len(report)
+        self.pending.append(pushed_at)
+
+        start = time.perf_counter()
+        self.event_processor.drain()
+        refreshed_at = self.canvas.last_refresh_time
+        canvas_rects = self.canvas.refresh()
+        if self.header_manager.needs_redraw:
+            self.header_surface.fill((200, 200, 200))
+            self.header_manager.draw()
+        positions = [self.input_manager.get_position(device) for device in self.input_manager.get_active_inputs()]
+        self.header_manager.draw_buttons(positions)
+        self.screen.blit(self.canvas_surface, (0, HEADER_HEIGHT))
+        self.screen.blit(self.header_surface, (0, 0))
+        if self.predictor:
+            now = time.perf_counter()
+            tips = []
+            for device in self.input_manager.get_active_inputs():
+                position = self.input_manager.get_position(device)
+                self.predictor.update(device, position, now)
+                tips.append((device, position, self.predictor.predict(device)))
+            self.canvas.draw_tips(self.screen, tips)
+        for x, y in positions:
+            pygame.draw.rect(self.screen, (0, 0, 0), (x - 10, y - 10, 20, 20), 2)
+        if canvas_rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(canvas_rects)
+        end = time.perf_counter()
+        self.frame_times.append(end - start)
+
+        # Input reaches the pixels on the frame the canvas next refreshes
+        if self.canvas.last_refresh_time != refreshed_at:
+            self.latencies.extend(end - pushed for pushed in self.pending)
+            self.pending = []
+
+    def run(self, frames, realtime=False):
+        clock = pygame.time.Clock()
+        start = time.perf_counter()
+        for _ in range(frames):
+            self.frame()
+            if realtime:
+                clock.tick(self.fps)
+        return time.perf_counter() - start
+
+    # Return the measurements as a dictionary
+    def report(self, name, elapsed):
+        frame_times = sorted(self.frame_times)
+        latencies = sorted(self.latencies)
+        strokes = 0
+        points = 0
+        for device_id in self.input_manager.get_active_inputs():
+            for stroke in self.input_manager.get_device(device_id).get_strokes():
+                strokes += 1
+                points += len(stroke)
+        return {
+            "scenario": name,
+            "users": len(self.streams),
+            "frames": len(frame_times),
+            "frame_ms_p50": percentile(frame_times, 0.5) * 1000,
+            "frame_ms_p95": percentile(frame_times, 0.95) * 1000,
+            "frame_ms_p99": percentile(frame_times, 0.99) * 1000,
+            "frame_ms_max": frame_times[-1] * 1000 if frame_times else 0.0,
+            "latency_ms_p50": percentile(latencies, 0.5) * 1000,
+            "latency_ms_p95": percentile(latencies, 0.95) * 1000,
+            "latency_ms_p99": percentile(latencies, 0.99) * 1000,
+            "events_per_sec": self.events / elapsed if elapsed else 0.0,
+            "strokes": strokes,
+            "points": points,
+            "points_saved": self.input_manager.get_points_saved(),
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+
+# Scenarios take the parsed arguments and return the simulation and the
+# time spent in the measured part
+def long_session(args):
+    simulation = Simulation(args.users, args.rate, args.fps, args.seed, args.low_latency)
+    return simulation, simulation.run(args.frames, args.realtime)
+
+def heavy_erase(args):
+    simulation = Simulation(args.users, args.rate, args.fps, args.seed, args.low_latency)
+    simulation.run(args.frames, args.realtime)
+    # Everyone but the last user switches to the eraser, the admin erases
+    # across every device
+    simulation.frame_times = []
+    simulation.latencies = []
+    simulation.events = 0
+    simulation.set_tool('Eraser', max(1, args.users - 1))
+    return simulation, simulation.run(args.frames, args.realtime)
+
+def many_users(args):
+    simulation = Simulation(max(args.users, 12), args.rate, args.fps, args.seed, args.low_latency)
+    return simulation, simulation.run(args.frames, args.realtime)
+
+# Replay a recorded session log, grouping its events into the frames they
+# arrived in
+def replay(args):
+    if not args.log:
+        raise SystemExit("the replay scenario needs --log")
+    devices = {}
+    frames = {}
+    first_timestamp = None
+    for record in read_session(args.log):
+        if record[0] == "device":
+            devices.setdefault(record[1], record[2])
+            continue
+        _, device_path, timestamp, event_type, code, value = record
+        if first_timestamp is None:
+            first_timestamp = timestamp
+        frame = int((timestamp - first_timestamp) * args.fps)
+        frames.setdefault(device_path, {}).setdefault(frame, []).append((event_type, code, value))
+
+    last_frame = max((max(device_frames) for device_frames in frames.values()), default=0)
+    simulation = Simulation(0, args.fps, args.fps, args.seed, args.low_latency)
+    for device_path, name in devices.items():
+        device_frames = frames.get(device_path, {})
+        simulation.add_stream(device_path, name, (device_frames.get(frame, ()) for frame in range(last_frame + 1)))
+    return simulation, simulation.run(last_frame + 1, args.realtime)
+
+SCENARIOS = {
+    "long-session": long_session,
+    "heavy-erase": heavy_erase,
+    "many-users": many_users,
+    "replay": replay,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmark of the draw, erase and render pipeline")
+    parser.add_argument("scenarios", nargs="*", default=["long-session", "heavy-erase", "many-users"], help=f"any of {', '.join(SCENARIOS)}")
+    parser.add_argument("--users", type=int, default=3, help="simulated mice")
+    parser.add_argument("--frames", type=int, default=1800, help="frames per measured run")
+    parser.add_argument("--rate", type=int, default=1000, help="reports per second per mouse")
+    parser.add_argument("--fps", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--realtime", action="store_true", help="pace frames at --fps like the main loop")
+    parser.add_argument("--low-latency", action="store_true", help="run the main loop's low latency mode")
+    parser.add_argument("--log", help="session log recorded with main.py --record, for the replay scenario")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}, choose from {', '.join(SCENARIOS)}")
+
+    pygame.init()
+    results = []
+    for name in args.scenarios:
+        simulation, elapsed = SCENARIOS[name](args)
+        result = simulation.report(name, elapsed)
+        results.append(result)
+        print(f"{name}: {result['users']} users, {result['frames']} frames")
+        print(f"  frame ms    p50 {result['frame_ms_p50']:.2f}  p95 {result['frame_ms_p95']:.2f}  p99 {result['frame_ms_p99']:.2f}  max {result['frame_ms_max']:.2f}")
+        print(f"  latency ms  p50 {result['latency_ms_p50']:.1f}  p95 {result['latency_ms_p95']:.1f}  p99 {result['latency_ms_p99']:.1f}")
+        print(f"  {result['events_per_sec']:.0f} events/s, {result['strokes']} strokes, {result['points']} points, {result['points_saved']} points saved, {result['max_rss_mb']:.0f} MB max RSS")
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+    pygame.quit()
+
+if __name__ == "__main__":
+    main()
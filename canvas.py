@@ -1,43 +1,244 @@
+import math
 import pygame
 import time
+from stroke import BOARD_MIN, BOARD_MAX, point_pairs
+from tile_cache import TileCache
+from stroke_renderer import draw_round_lines
+
+class Viewport:
+    # Maps board coordinates, which strokes are stored in, to the screen.
+    # The origin is the board position shown at the top left of the canvas
+    # area. With the default origin at the area's own position and a zoom of
+    # 1, board and screen coordinates are the same.
+    def __init__(self, area, origin=None, zoom=1.0, min_zoom=0.25, max_zoom=4.0):
+        self.area = area
+        self.home = area.topleft if origin is None else origin
+        self.origin = self.home
+        self.zoom = zoom
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.changed = True
+
+    # Convert a screen position to board coordinates
+    def to_board(self, position):
+        return (
+            round(self.origin[0] + (position[0] - self.area.x) / self.zoom),
+            round(self.origin[1] + (position[1] - self.area.y) / self.zoom)
+        )
+
+    # Convert a board position to screen coordinates
+    def to_screen(self, position):
+        return (
+            round(self.area.x + (position[0] - self.origin[0]) * self.zoom),
+            round(self.area.y + (position[1] - self.origin[1]) * self.zoom)
+        )
+
+    # Return the screen (x, y) pairs of a flat point buffer
+    def to_screen_pairs(self, points):
+        if self.zoom == 1 and self.origin == self.area.topleft:
+            return point_pairs(points)
+        return [self.to_screen((points[i], points[i + 1])) for i in range(0, len(points) - 1, 2)]
+
+    # Move the origin to a board position, kept where every board position
+    # from the top left of the screen to the bottom right of the area fits
+    # the range points are stored in
+    def move_to(self, origin):
+        area = self.area
+        self.origin = (
+            max(BOARD_MIN + math.ceil(area.x / self.zoom) + 1,
+                min(BOARD_MAX - math.ceil(area.width / self.zoom) - 1, origin[0])),
+            max(BOARD_MIN + math.ceil(area.y / self.zoom) + 1,
+                min(BOARD_MAX - math.ceil(area.height / self.zoom) - 1, origin[1]))
+        )
+        self.changed = True
+
+    # Move the board by a distance in screen pixels
+    def pan(self, dx, dy):
+        self.move_to((round(self.origin[0] + dx / self.zoom), round(self.origin[1] + dy / self.zoom)))
+
+    # Zoom by a factor, keeping the board under a screen position in place
+    def zoom_by(self, factor, position=None):
+        zoom = max(self.min_zoom, min(self.max_zoom, self.zoom * factor))
+        if zoom == self.zoom:
+            return
+        if position is None:
+            position = self.area.center
+        anchor = self.to_board(position)
+        self.zoom = zoom
+        self.move_to((
+            round(anchor[0] - (position[0] - self.area.x) / zoom),
+            round(anchor[1] - (position[1] - self.area.y) / zoom)
+        ))
+
+    # Return to the original origin and zoom
+    def reset(self):
+        self.origin = self.home
+        self.zoom = 1.0
+        self.changed = True
+
 
 class Canvas:
-    def __init__(self, drawing_surface, input_manager, header_height=100):
+    # The drawing surface must be a subsurface of a screen sized layer, so
+    # current lines are drawn in screen coordinates without offsetting them.
+    # Committed strokes are rendered into board tiles, and only the tiles in
+    # view are composited onto the surface.
+    def __init__(self, drawing_surface, input_manager, header_height=100, max_tiles=128, refresh_interval=0.1):
         self.surface = drawing_surface
+        self.layer = drawing_surface.get_parent()
         self.input_manager = input_manager
-        self.refresh_interval = 0.1
+        self.refresh_interval = refresh_interval
         self.last_refresh_time = 0
         self.header_height = header_height
+        self.area = drawing_surface.get_rect(topleft=drawing_surface.get_offset())
+        self.viewport = Viewport(self.area)
+        self.tiles = TileCache(max_surfaces=max_tiles)
+        # Tiles scaled for the current zoom, by key
+        self.scaled = {}
+        # Current line and number of its points already drawn, per device
+        self.drawn_lines = {}
 
     # Clear the canvas
     def clear(self):
         self.surface.fill((255, 255, 255))
 
-    # Redraw the canvas
+    # Draw a flat point buffer of board coordinates onto the screen sized
+    # layer, and return the rect it covers. Lines being drawn get round
+    # joints, and are smoothed once they are committed.
+    def draw_line(self, surface, points, color, size):
+        if len(points) > 2:
+            width = max(1, round(size * self.viewport.zoom))
+            return draw_round_lines(surface, color, self.viewport.to_screen_pairs(points), width)
+        return None
+
+    # Sort every committed stroke into the tiles it covers, including the
+    # strokes of devices that are no longer paired. Tiles are rendered when
+    # they are next shown.
+    def rebuild(self):
+        self.tiles.clear()
+        self.scaled = {}
+        for device in self.input_manager.get_stroke_devices():
+            for stroke in device.get_strokes():
+                self.tiles.add(stroke, draw=False)
+
+    # Sort the committed strokes into tiles and use previously rendered
+    # tiles, as (tx, ty, compressed) tuples, instead of drawing them
+    def load_tiles(self, tiles):
+        self.rebuild()
+        self.tiles.load(tiles)
+
+    # Return the keys of the tiles in view
+    def visible_tiles(self):
+        size = self.tiles.tile_size
+        left, top = self.viewport.to_board(self.area.topleft)
+        right, bottom = self.viewport.to_board(self.area.bottomright)
+        return [
+            (tx, ty)
+            for ty in range(top // size, bottom // size + 1)
+            for tx in range(left // size, right // size + 1)
+        ]
+
+    # Composite a tile onto the canvas surface and return the screen rect it
+    # covers
+    def draw_tile(self, key):
+        size = self.tiles.tile_size
+        x, y = self.viewport.to_screen((key[0] * size, key[1] * size))
+        right, bottom = self.viewport.to_screen(((key[0] + 1) * size, (key[1] + 1) * size))
+        rect = pygame.Rect(x, y, right - x, bottom - y)
+        surface = self.tiles.get_surface(key)
+        target = rect.move(-self.area.x, -self.area.y)
+        if surface is None:
+            self.surface.fill((255, 255, 255), target)
+        elif rect.size == surface.get_size():
+            self.surface.blit(surface, target)
+        else:
+            scaled = self.scaled.get(key)
+            if scaled is None or scaled[0] is not surface or scaled[1].get_size() != rect.size:
+                scaled = self.scaled[key] = (surface, pygame.transform.smoothscale(surface, rect.size))
+            self.surface.blit(scaled[1], target)
+        return rect
+
+    # Draw the points added to each current line since the last refresh, or
+    # every current line when redraw is set, and return the changed rects
+    def draw_current_lines(self, current_lines, redraw=False):
+        rects = []
+        drawn_lines = {}
+        for device_id, current_line, color, size in current_lines:
+            line, drawn = self.drawn_lines.get(device_id, (None, 0))
+            if redraw or line is not current_line:
+                drawn = 0
+            rect = self.draw_line(self.layer, current_line[max(0, drawn - 2):], color, size)
+            if rect:
+                rects.append(rect)
+            drawn_lines[device_id] = (current_line, len(current_line))
+        self.drawn_lines = drawn_lines
+        return rects
+
+    # Redraw the canvas and return the rects that changed, in canvas
+    # coordinates, or None when the whole canvas changed. Committed changes
+    # are shown every frame, current lines every refresh interval or when
+    # a tile drawn over them makes it necessary.
     def refresh(self):
         current_time = time.time()
-        if current_time - self.last_refresh_time < self.refresh_interval:
-            return
-        self.last_refresh_time = current_time
-
-        self.clear()
-        devices = self.input_manager.get_active_inputs()
-
-        # For previous lines
-        for device_id in devices:
-            device = self.input_manager.get_device(device_id)
-            if device:
-                for stroke in device.get_undo_stack() or []:
-                    line, color = stroke
-                    if len(line) > 1:
-                        adjusted_line = [(x, y - self.header_height) for (x, y) in line]
-                        pygame.draw.lines(self.surface, color, False, adjusted_line, self.input_manager.get_size(device_id))
-
-        # For current lines
-        for device_id in devices:
-            device = self.input_manager.get_device(device_id)
-            if device:
-                current_line = device.get_current_line()
-                if current_line and len(current_line) > 1:
-                    adjusted_line = [(x, y - self.header_height) for (x, y) in current_line]
-                    pygame.draw.lines(self.surface, device.get_color(), False, adjusted_line, self.input_manager.get_size(device_id))
+        due = current_time - self.last_refresh_time >= self.refresh_interval
+        if not due and not self.viewport.changed and not self.input_manager.has_canvas_updates():
+            return []
+        if due:
+            self.last_refresh_time = current_time
+
+        current_lines = self.input_manager.get_current_lines()
+
+        # Only the tiles under a changed stroke are rendered again
+        rebuild, changes = self.input_manager.take_canvas_updates()
+        changed = set()
+        if rebuild:
+            self.rebuild()
+        else:
+            for removed, added in changes:
+                if removed is not None:
+                    changed.update(self.tiles.replace(removed, added))
+                else:
+                    for stroke in added:
+                        changed.update(self.tiles.add(stroke))
+        for key in changed:
+            self.scaled.pop(key, None)
+
+        visible = self.visible_tiles()
+        if rebuild or self.viewport.changed:
+            self.viewport.changed = False
+            self.scaled = {key: self.scaled[key] for key in visible if key in self.scaled}
+            for key in visible:
+                self.draw_tile(key)
+            self.tiles.evict(set(visible))
+            self.draw_current_lines(current_lines, redraw=True)
+            return None
+
+        rects = [self.draw_tile(key) for key in visible if key in changed]
+        self.tiles.evict(set(visible))
+
+        # For current lines, which compositing a tile draws over
+        if due or rects:
+            rects.extend(self.draw_current_lines(current_lines, redraw=bool(rects)))
+        return [rect.clip(self.area).move(-self.area.x, -self.area.y) for rect in rects]
+
+    # Draw the end of each device's current line that is not on the canvas
+    # yet straight onto the screen, from its last drawn point through the
+    # device's position to where it is predicted to be. Tips are given as
+    # (device id, position, predicted position) in screen coordinates.
+    # Returns the screen rects drawn, which must be restored next frame.
+    def draw_tips(self, screen, tips):
+        current_lines = {device_id: (line, color, size) for device_id, line, color, size in self.input_manager.get_current_lines()}
+        rects = []
+        screen.set_clip(self.area)
+        for device_id, position, predicted in tips:
+            if device_id not in current_lines:
+                continue
+            line, color, size = current_lines[device_id]
+            drawn_line, drawn = self.drawn_lines.get(device_id, (None, 0))
+            if drawn_line is not line:
+                drawn = 0
+            pairs = self.viewport.to_screen_pairs(line[max(0, drawn - 2):])
+            pairs += [position, predicted]
+            width = max(1, round(size * self.viewport.zoom))
+            rects.append(draw_round_lines(screen, color, pairs, width).clip(self.area))
+        screen.set_clip(None)
+        return rects
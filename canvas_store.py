@@ -0,0 +1,449 @@
+import os
+import struct
+import sys
+import threading
+import time
+from logging_manager import logger
+from stroke import Stroke, TOOLS, new_points
+from tile_cache import compress_pixels
+
+# The store directory holds snapshot.bin with every device's strokes,
+# snapshot-<generation>.tiles with the board tiles already rendered, and
+# journal-<generation>.bin with the changes made since that snapshot. Each
+# snapshot starts a new journal generation, older journals are deleted once
+# the snapshot is on disk. Version 1 files, written before strokes kept
+# their tool, version 2 journals, written before erases kept the start of
+# the eraser's path, and version 3 journals, written before undo and redo
+# kept the strokes they changed, are still read. Tiles rendered before
+# strokes were smoothed are ignored and drawn again.
+JOURNAL_MAGIC = b"CCJOURNAL4\n"
+SNAPSHOT_MAGIC = b"CCSNAPSHOT2\n"
+JOURNAL_VERSIONS = {b"CCJOURNAL1\n": 1, b"CCJOURNAL2\n": 2, b"CCJOURNAL3\n": 3, JOURNAL_MAGIC: 4}
+SNAPSHOT_VERSIONS = {b"CCSNAPSHOT1\n": 1, SNAPSHOT_MAGIC: 2}
+TILES_MAGIC = b"CCTILES2\n"
+
+# Journal operations
+DEVICE, ADD, UNDO, REDO, CLEAR, ERASE = range(6)
+
+GENERATION = struct.Struct("<Q")
+COUNT = struct.Struct("<I")
+OPERATION = struct.Struct("<BH")
+LENGTH = struct.Struct("<H")
+STROKE = struct.Struct("<BBBHBI")
+STROKE_V1 = struct.Struct("<BBBHI")
+POSITION = struct.Struct("<hh")
+TILE = struct.Struct("<iiI")
+
+
+# Write a stroke as its style followed by the raw point buffer
+def write_stroke(write, stroke):
+    points = stroke.points
+    if sys.byteorder == "big":
+        points = points[:]
+        points.byteswap()
+    tool = TOOLS.index(stroke.tool) if stroke.tool in TOOLS else 0
+    write(STROKE.pack(*stroke.color, stroke.width, tool, len(points) // 2))
+    write(points.tobytes())
+
+# Read a stroke written by write_stroke, or None if the data ends early
+def read_stroke(read, version=2):
+    header = STROKE if version >= 2 else STROKE_V1
+    data = read(header.size)
+    if len(data) < header.size:
+        return None
+    if version >= 2:
+        red, green, blue, width, tool, count = header.unpack(data)
+    else:
+        red, green, blue, width, count = header.unpack(data)
+        tool = 0
+    data = read(count * 4)
+    if len(data) < count * 4:
+        return None
+    points = new_points()
+    points.frombytes(data)
+    if sys.byteorder == "big":
+        points.byteswap()
+    return Stroke(points, (red, green, blue), width, TOOLS[tool] if tool < len(TOOLS) else TOOLS[0])
+
+# Write the strokes an undo or redo removed and added, each with the id of
+# the device holding it
+def write_changes(write, removed, added):
+    for strokes in (removed, added):
+        write(COUNT.pack(len(strokes)))
+        for stroke, owner in strokes.items():
+            write_text(write, owner.device_id)
+            write_stroke(write, stroke)
+
+# Read the (device id, stroke) pairs written by write_changes as a removed
+# and an added list, or None if the data ends early
+def read_changes(read, version):
+    changes = []
+    for _ in range(2):
+        data = read(COUNT.size)
+        if len(data) < COUNT.size:
+            return None
+        count, = COUNT.unpack(data)
+        strokes = []
+        for _ in range(count):
+            owner_id = read_text(read)
+            stroke = None if owner_id is None else read_stroke(read, version)
+            if stroke is None:
+                return None
+            strokes.append((owner_id, stroke))
+        changes.append(strokes)
+    return changes
+
+def write_text(write, text):
+    data = text.encode()
+    write(LENGTH.pack(len(data)))
+    write(data)
+
+# Read a string written by write_text, or None if the data ends early
+def read_text(read):
+    data = read(LENGTH.size)
+    if len(data) < LENGTH.size:
+        return None
+    length, = LENGTH.unpack(data)
+    data = read(length)
+    if len(data) < length:
+        return None
+    return data.decode()
+
+# Read the (tx, ty, compressed) tiles of a tiles file, or none if it was
+# written with another tile size or cut short
+def read_tiles(path, tile_size):
+    tiles = []
+    with open(path, "rb") as tiles_file:
+        read = tiles_file.read
+        if read(len(TILES_MAGIC)) != TILES_MAGIC:
+            return []
+        size, count = struct.unpack("<II", read(8))
+        if size != tile_size:
+            return []
+        for _ in range(count):
+            data = read(TILE.size)
+            if len(data) < TILE.size:
+                return []
+            tx, ty, length = TILE.unpack(data)
+            data = read(length)
+            if len(data) < length:
+                return []
+            tiles.append((tx, ty, data))
+    return tiles
+
+
+class CanvasStore:
+    # Without save_tiles snapshots keep no rendered tiles, for a canvas that
+    # is drawn in another process and whose tiles here never change
+    def __init__(self, directory, input_manager, canvas, snapshot_interval=60, flush_interval=1.0, save_tiles=True):
+        self.directory = directory
+        self.input_manager = input_manager
+        self.canvas = canvas
+        self.save_tiles = save_tiles
+        self.snapshot_interval = snapshot_interval
+        self.flush_interval = flush_interval
+        self.generation = 0
+        self.journal = None
+        self.declared = set()
+        self.records = 0
+        self.last_snapshot_time = time.time()
+        self.last_flush_time = time.time()
+        self.snapshot_thread = None
+        # Set when files of an older version were loaded
+        self.upgraded = False
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def journal_path(self, generation):
+        return self.path(f"journal-{generation}.bin")
+
+    def tiles_path(self, generation):
+        return self.path(f"snapshot-{generation}.tiles")
+
+    # Restore the latest snapshot and replay the journal written since, then
+    # journal every further change
+    def load(self):
+        start = time.perf_counter()
+        self.generation = self.load_snapshot()
+        snapshot_generation = self.generation
+
+        # A snapshot interrupted before it was written leaves more than one
+        # journal to replay
+        generation = self.generation
+        offset = None
+        while os.path.exists(self.journal_path(generation)):
+            offset = self.replay_journal(generation)
+            self.generation = generation
+            generation += 1
+        self.open_journal(offset)
+        self.input_manager.add_listener(self)
+        self.remove_old_files(snapshot_generation)
+
+        # Rewrite older files in the current format rather than append to them
+        if self.upgraded:
+            self.upgraded = False
+            self.snapshot(wait=True)
+
+        logger.info(f"Restored canvas generation {self.generation} in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    # Restore every device's strokes from the snapshot, and its rendered
+    # tiles so they do not have to be drawn again. Returns its generation.
+    def load_snapshot(self):
+        try:
+            snapshot = open(self.path("snapshot.bin"), "rb")
+        except FileNotFoundError:
+            return 0
+        with snapshot:
+            read = snapshot.read
+            version = SNAPSHOT_VERSIONS.get(read(len(SNAPSHOT_MAGIC)))
+            if version is None:
+                logger.error("Ignoring snapshot.bin, it is not a canvas snapshot")
+                return 0
+            self.upgraded |= version < 2
+            generation, = GENERATION.unpack(read(GENERATION.size))
+            device_count, = COUNT.unpack(read(COUNT.size))
+            for _ in range(device_count):
+                device_id = read_text(read)
+                name = read_text(read)
+                stacks = []
+                for _ in range(2):
+                    count, = COUNT.unpack(read(COUNT.size))
+                    stacks.append([read_stroke(read, version) for _ in range(count)])
+                self.input_manager.restore_device(device_id, name, stacks[0], stacks[1])
+
+        tiles = []
+        tiles_path = self.tiles_path(generation)
+        if os.path.exists(tiles_path):
+            tiles = read_tiles(tiles_path, self.canvas.tiles.tile_size)
+        # The canvas is sorted into tiles here, so the restored strokes are
+        # not drawn again
+        self.canvas.load_tiles(tiles)
+        self.input_manager.take_canvas_updates()
+        return generation
+
+    # Apply the changes in a journal without journaling them again, and
+    # return the offset of the end of the last complete record
+    def replay_journal(self, generation):
+        offset = 0
+        self.input_manager.replaying = True
+        try:
+            with open(self.journal_path(generation), "rb") as journal:
+                read = journal.read
+                version = JOURNAL_VERSIONS.get(read(len(JOURNAL_MAGIC)))
+                if version is None or len(read(GENERATION.size)) < GENERATION.size:
+                    return None
+                # Records are appended to the journal after replaying it,
+                # which must be in the current version for that
+                self.upgraded |= version < JOURNAL_VERSIONS[JOURNAL_MAGIC]
+                offset = journal.tell()
+                while True:
+                    data = read(OPERATION.size)
+                    if len(data) < OPERATION.size:
+                        break
+                    operation, length = OPERATION.unpack(data)
+                    data = read(length)
+                    if len(data) < length:
+                        break
+                    device_id = data.decode()
+                    if operation == DEVICE:
+                        name = read_text(read)
+                        if name is None:
+                            break
+                        self.input_manager.declare_device(device_id, name)
+                    elif operation == ADD:
+                        stroke = read_stroke(read, version)
+                        if stroke is None:
+                            break
+                        self.input_manager.add_stroke(device_id, stroke)
+                    elif operation in (UNDO, REDO) and version >= 4:
+                        changes = read_changes(read, version)
+                        if changes is None:
+                            break
+                        self.input_manager.apply_recorded(device_id, *changes, redo=operation == REDO)
+                    elif operation == UNDO:
+                        # Older journals only recorded that the device undid
+                        self.input_manager.undo(device_id)
+                    elif operation == REDO:
+                        self.input_manager.redo(device_id)
+                    elif operation == CLEAR:
+                        self.input_manager.clear(device_id)
+                    elif operation == ERASE:
+                        # From version 3 the end of the path is followed by
+                        # its start
+                        size = POSITION.size * 2 if version >= 3 else POSITION.size
+                        data = read(size)
+                        if len(data) < size:
+                            break
+                        pos = POSITION.unpack_from(data)
+                        start = POSITION.unpack_from(data, POSITION.size) if version >= 3 else pos
+                        self.input_manager.erase(device_id, pos, start)
+                    else:
+                        logger.error(f"Unknown operation {operation} in journal {generation}")
+                        break
+                    offset = journal.tell()
+        finally:
+            self.input_manager.replaying = False
+        return offset
+
+    # Open the current journal, appending after the last complete record if
+    # it was replayed, or starting it afresh
+    def open_journal(self, offset=None):
+        path = self.journal_path(self.generation)
+        if offset:
+            self.journal = open(path, "r+b", buffering=64 * 1024)
+            self.journal.truncate(offset)
+            self.journal.seek(offset)
+        else:
+            self.journal = open(path, "wb", buffering=64 * 1024)
+            self.journal.write(JOURNAL_MAGIC)
+            self.journal.write(GENERATION.pack(self.generation))
+        self.declared = set()
+        self.records = 0
+
+    # Declare a device in the journal unless it already was, so replaying
+    # it creates the device before its records
+    def declare(self, device):
+        if device.device_id not in self.declared:
+            self.declared.add(device.device_id)
+            device_id = device.device_id.encode()
+            self.journal.write(OPERATION.pack(DEVICE, len(device_id)))
+            self.journal.write(device_id)
+            write_text(self.journal.write, device.name)
+
+    # Write the start of a journal record, declaring the device first
+    def write_operation(self, operation, device):
+        self.declare(device)
+        write = self.journal.write
+        device_id = device.device_id.encode()
+        write(OPERATION.pack(operation, len(device_id)))
+        write(device_id)
+        self.records += 1
+
+    # InputManager listener methods
+    def on_add_stroke(self, device, stroke):
+        self.write_operation(ADD, device)
+        write_stroke(self.journal.write, stroke)
+
+    # Undo and redo are journaled as the strokes they changed, which may be
+    # other devices' for an admin. Replaying a bare undo would undo the
+    # history rebuilt after a restart, not the operation that was undone.
+    def on_undo(self, device, removed, added):
+        self.write_undo(UNDO, device, removed, added)
+
+    def on_redo(self, device, removed, added):
+        self.write_undo(REDO, device, removed, added)
+
+    def write_undo(self, operation, device, removed, added):
+        for owner in set(removed.values()) | set(added.values()):
+            self.declare(owner)
+        self.write_operation(operation, device)
+        write_changes(self.journal.write, removed, added)
+
+    def on_clear(self, device):
+        self.write_operation(CLEAR, device)
+
+    def on_erase(self, device, pos, start):
+        self.write_operation(ERASE, device)
+        self.journal.write(POSITION.pack(*pos))
+        self.journal.write(POSITION.pack(*(pos if start is None else start)))
+
+    # Called once per frame after the canvas refreshes, flushes the journal
+    # and starts a snapshot when one is due
+    def update(self):
+        now = time.time()
+        if now - self.last_flush_time >= self.flush_interval:
+            self.journal.flush()
+            self.last_flush_time = now
+        if (self.records and now - self.last_snapshot_time >= self.snapshot_interval
+                and not (self.snapshot_thread and self.snapshot_thread.is_alive())
+                and not self.input_manager.has_canvas_updates()):
+            self.snapshot()
+
+    # Start a new journal generation and write the snapshot it is based on
+    # in the background. The strokes are copied and the rendered tiles are
+    # taken while the canvas is up to date with them. The operation log is
+    # not kept: after a restart undo takes a device's strokes away in order,
+    # and the strokes it had undone can be redone.
+    def snapshot(self, wait=False):
+        log = self.input_manager.log
+        with self.input_manager.lock:
+            devices = [
+                (device.device_id, device.name, device.get_strokes(), log.get_redo_strokes(device.device_id))
+                for device in list(self.input_manager.inputs.values()) + list(self.input_manager.detached.values())
+            ]
+        # Tiles not yet updated with the latest changes would be stale
+        if not self.save_tiles or self.input_manager.has_canvas_updates():
+            tiles = []
+        else:
+            tiles = self.canvas.tiles.export()
+
+        self.journal.close()
+        self.generation += 1
+        self.open_journal()
+        self.last_snapshot_time = time.time()
+
+        self.snapshot_thread = threading.Thread(target=self.write_snapshot, args=(self.generation, devices, tiles), name="CanvasSnapshot")
+        self.snapshot_thread.start()
+        if wait:
+            self.snapshot_thread.join()
+
+    def write_snapshot(self, generation, devices, tiles):
+        start = time.perf_counter()
+        try:
+            tiles_path = self.path(f"snapshot-{generation}.tiles.tmp")
+            with open(tiles_path, "wb", buffering=1024 * 1024) as tiles_file:
+                write = tiles_file.write
+                write(TILES_MAGIC)
+                write(struct.pack("<II", self.canvas.tiles.tile_size, len(tiles)))
+                for tx, ty, pixels, compressed in tiles:
+                    if compressed is None:
+                        compressed = compress_pixels(pixels)
+                    write(TILE.pack(tx, ty, len(compressed)))
+                    write(compressed)
+            os.replace(tiles_path, self.tiles_path(generation))
+
+            snapshot_path = self.path("snapshot.tmp")
+            with open(snapshot_path, "wb", buffering=1024 * 1024) as snapshot:
+                write = snapshot.write
+                write(SNAPSHOT_MAGIC)
+                write(GENERATION.pack(generation))
+                write(COUNT.pack(len(devices)))
+                for device_id, name, strokes, redo_strokes in devices:
+                    write_text(write, device_id)
+                    write_text(write, name)
+                    for stack in (strokes, redo_strokes):
+                        write(COUNT.pack(len(stack)))
+                        for stroke in stack:
+                            write_stroke(write, stroke)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(snapshot_path, self.path("snapshot.bin"))
+        except OSError as error:
+            logger.error(f"Canvas snapshot {generation} failed: {error}")
+            return
+        self.remove_old_files(generation)
+        logger.info(f"Canvas snapshot {generation} written in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    # Delete journals and tiles that the snapshot generation replaces
+    def remove_old_files(self, generation):
+        for name in os.listdir(self.directory):
+            for prefix, suffix in (("journal-", ".bin"), ("snapshot-", ".tiles")):
+                if name.startswith(prefix) and name.endswith(suffix):
+                    number = name[len(prefix):-len(suffix)]
+                    if number.isdigit() and int(number) < generation:
+                        os.remove(self.path(name))
+
+    # Snapshot anything journaled since the last snapshot and close the journal
+    def close(self):
+        if self.snapshot_thread:
+            self.snapshot_thread.join()
+        if self.records:
+            if self.save_tiles:
+                # Bring the rendered strokes up to date so they can be
+                # snapshotted
+                self.canvas.last_refresh_time = 0
+                self.canvas.refresh()
+            self.snapshot(wait=True)
+        self.journal.close()
@@ -0,0 +1,568 @@
+import asyncio
+import struct
+import threading
+from collections import deque
+from logging_manager import logger
+from config import MAX_SIZE
+from stroke import Stroke, TOOLS, BOARD_MIN, BOARD_MAX, new_points
+
+# Peers exchange frames of a little endian length followed by a batch of
+# operations. Each operation is an opcode, the device id and its data. Numbers
+# are varints, and points are zigzag varint deltas from the previous point,
+# which keeps a stroke to two or three bytes a point.
+FRAME = struct.Struct("<I")
+MAX_FRAME = 16 * 1024 * 1024
+
+# Operations. A peer introduces itself with HELLO and its name, which
+# namespaces its devices, so they keep their ids when it reconnects. UNDO and
+# REDO carry the strokes they removed and added, as the journal records them,
+# so peers whose operation logs differ still end up with the same strokes.
+DEVICE, POINTS, ADD, UNDO, REDO, CLEAR, ERASE, LEAVE, HELLO = range(9)
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def write_signed(out, value):
+    write_varint(out, (value << 1) ^ (value >> 63))
+
+def read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def read_signed(data, offset):
+    value, offset = read_varint(data, offset)
+    return (value >> 1) ^ -(value & 1), offset
+
+def write_text(out, text):
+    data = text.encode()
+    write_varint(out, len(data))
+    out += data
+
+def read_text(data, offset):
+    length, offset = read_varint(data, offset)
+    return bytes(data[offset:offset + length]).decode(), offset + length
+
+# Write a flat point buffer as its point count and deltas
+def write_points(out, points):
+    write_varint(out, len(points) // 2)
+    last_x = last_y = 0
+    for i in range(0, len(points) - 1, 2):
+        x = points[i]
+        y = points[i + 1]
+        write_signed(out, x - last_x)
+        write_signed(out, y - last_y)
+        last_x, last_y = x, y
+
+# Read points written by write_points, refusing any off the board
+def read_points(data, offset):
+    count, offset = read_varint(data, offset)
+    points = new_points()
+    x = y = 0
+    try:
+        for _ in range(count):
+            dx, offset = read_signed(data, offset)
+            dy, offset = read_signed(data, offset)
+            x += dx
+            y += dy
+            points.append(x)
+            points.append(y)
+    except OverflowError:
+        raise ValueError(f"Point {x}, {y} is off the board")
+    return points, offset
+
+# Return a position, refusing one off the board
+def check_position(x, y):
+    if not (BOARD_MIN <= x <= BOARD_MAX and BOARD_MIN <= y <= BOARD_MAX):
+        raise ValueError(f"Position {x}, {y} is off the board")
+    return (x, y)
+
+def write_style(out, color, width, tool):
+    out += bytes(color)
+    write_varint(out, width)
+    out.append(TOOLS.index(tool) if tool in TOOLS else 0)
+
+# Read a style written by write_style, refusing a width config.py would
+# not allow. Colors are a byte a channel, so always within 0 to 255.
+def read_style(data, offset):
+    color = tuple(data[offset:offset + 3])
+    if len(color) < 3:
+        raise IndexError("Style cut short")
+    width, offset = read_varint(data, offset + 3)
+    if not 1 <= width <= MAX_SIZE:
+        raise ValueError(f"Stroke width {width} is not between 1 and {MAX_SIZE}")
+    tool = data[offset]
+    return color, width, TOOLS[tool] if tool < len(TOOLS) else TOOLS[0], offset + 1
+
+# Write (device id, stroke) pairs as their count and each pair
+def write_changes(out, changes):
+    write_varint(out, len(changes))
+    for owner_id, stroke in changes:
+        write_text(out, owner_id)
+        write_style(out, *stroke.style)
+        write_points(out, stroke.points)
+
+def read_changes(data, offset):
+    count, offset = read_varint(data, offset)
+    changes = []
+    for _ in range(count):
+        owner_id, offset = read_text(data, offset)
+        color, width, tool, offset = read_style(data, offset)
+        points, offset = read_points(data, offset)
+        changes.append((owner_id, Stroke(points, color, width, tool)))
+    return changes, offset
+
+# Encode one operation, a tuple of the opcode, the device id and its data
+def encode_operation(operation):
+    out = bytearray()
+    out.append(operation[0])
+    write_text(out, operation[1])
+    kind = operation[0]
+    if kind == DEVICE:
+        write_text(out, operation[2])
+    elif kind == POINTS:
+        _, _, color, width, points = operation
+        write_style(out, color, width, "Marker")
+        write_points(out, points)
+    elif kind == ADD:
+        stroke = operation[2]
+        write_style(out, *stroke.style)
+        write_points(out, stroke.points)
+    elif kind == ERASE:
+        # The end of the eraser's path, then its start relative to the end
+        _, _, pos, start = operation
+        write_signed(out, pos[0])
+        write_signed(out, pos[1])
+        write_signed(out, start[0] - pos[0])
+        write_signed(out, start[1] - pos[1])
+    elif kind in (UNDO, REDO):
+        write_changes(out, operation[2])
+        write_changes(out, operation[3])
+    return out
+
+# Decode a frame payload back into operation tuples
+def decode_operations(data):
+    operations = []
+    offset = 0
+    while offset < len(data):
+        kind = data[offset]
+        device_id, offset = read_text(data, offset + 1)
+        if kind == DEVICE:
+            name, offset = read_text(data, offset)
+            operations.append((DEVICE, device_id, name))
+        elif kind == POINTS:
+            color, width, tool, offset = read_style(data, offset)
+            points, offset = read_points(data, offset)
+            operations.append((POINTS, device_id, color, width, points))
+        elif kind == ADD:
+            color, width, tool, offset = read_style(data, offset)
+            points, offset = read_points(data, offset)
+            operations.append((ADD, device_id, Stroke(points, color, width, tool)))
+        elif kind == ERASE:
+            x, offset = read_signed(data, offset)
+            y, offset = read_signed(data, offset)
+            dx, offset = read_signed(data, offset)
+            dy, offset = read_signed(data, offset)
+            operations.append((ERASE, device_id, check_position(x, y), check_position(x + dx, y + dy)))
+        elif kind in (UNDO, REDO):
+            removed, offset = read_changes(data, offset)
+            added, offset = read_changes(data, offset)
+            operations.append((kind, device_id, removed, added))
+        elif kind in (CLEAR, LEAVE, HELLO):
+            operations.append((kind, device_id))
+        else:
+            raise ValueError(f"Unknown collaboration operation {kind}")
+    return operations
+
+
+class Connection:
+    # A peer's socket, with the frames waiting to be written up to a limit
+    # of max_pending bytes
+    def __init__(self, reader, writer, label, max_pending):
+        self.reader = reader
+        self.writer = writer
+        self.label = label
+        self.prefix = None
+        self.frames = asyncio.Queue()
+        self.pending = 0
+        self.max_pending = max_pending
+        self.declared = set()
+        self.devices = set()
+        self.closed = False
+
+    # Queue a frame, returns False when the peer has fallen too far behind.
+    # The canvas sent on connecting is queued whatever its size.
+    def send(self, payload, limit=True):
+        if limit and self.pending + len(payload) > self.max_pending:
+            return False
+        self.pending += len(payload)
+        self.frames.put_nowait(FRAME.pack(len(payload)) + payload)
+        return True
+
+    async def write_loop(self):
+        while True:
+            frame = await self.frames.get()
+            self.writer.write(frame)
+            await self.writer.drain()
+            self.pending -= len(frame) - FRAME.size
+
+    # Yield the operations of each frame the peer sends
+    async def read_frames(self):
+        while True:
+            try:
+                header = await self.reader.readexactly(FRAME.size)
+            except asyncio.IncompleteReadError as error:
+                if error.partial:
+                    raise
+                return
+            length, = FRAME.unpack(header)
+            if length > MAX_FRAME:
+                raise ValueError(f"Frame of {length} bytes from {self.label}")
+            yield decode_operations(await self.reader.readexactly(length))
+
+    # Exchange names with the peer, whose devices are then namespaced so
+    # they never clash with ours
+    async def greet(self, name):
+        self.send(encode_operation((HELLO, name)))
+        async for operations in self.read_frames():
+            if not operations or operations[0][0] != HELLO:
+                raise ValueError(f"{self.label} did not introduce itself")
+            self.label = operations[0][1]
+            self.prefix = f"remote:{self.label}:"
+            return
+
+    # Write the frames still queued and close the socket
+    def close(self):
+        if not self.closed:
+            while not self.frames.empty():
+                self.writer.write(self.frames.get_nowait())
+            self.closed = True
+            self.writer.close()
+
+    # Drop the connection without writing what is queued
+    def abort(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.transport.abort()
+
+
+class CollabPeer:
+    # Shares the canvas with other peers over TCP. Changes made on the render
+    # thread are only appended to a deque, an asyncio loop in its own thread
+    # batches and sends them, and operations received from peers wait in
+    # another deque until the render loop applies them.
+    def __init__(self, input_manager, name, batch_interval=0.016, max_pending=4 * 1024 * 1024):
+        self.input_manager = input_manager
+        self.name = name
+        self.batch_interval = batch_interval
+        self.max_pending = max_pending
+        self.outgoing = deque()
+        self.incoming = deque()
+        self.connections = []
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+        self.stopping = asyncio.Event()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        except OSError as error:
+            logger.error(f"Collaboration stopped: {error}")
+        finally:
+            self.loop.close()
+
+    # Start sharing the changes made to the input manager
+    def start(self):
+        self.input_manager.add_listener(self)
+        self.thread.start()
+
+    async def serve(self):
+        flush = asyncio.ensure_future(self.flush_loop())
+        await self.stopping.wait()
+        flush.cancel()
+        self.flush()
+        for connection in list(self.connections):
+            connection.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Whether changes to a device are sent to peers
+    def shares(self, device_id):
+        return True
+
+    # InputManager listener methods, called on the render thread
+    def on_point(self, device, point):
+        if self.shares(device.device_id):
+            self.outgoing.append((POINTS, device, point))
+
+    def on_add_stroke(self, device, stroke):
+        if self.shares(device.device_id):
+            self.outgoing.append((ADD, device, stroke))
+
+    def on_undo(self, device, removed, added):
+        if self.shares(device.device_id):
+            self.outgoing.append((UNDO, device, self.changes(removed), self.changes(added)))
+
+    def on_redo(self, device, removed, added):
+        if self.shares(device.device_id):
+            self.outgoing.append((REDO, device, self.changes(removed), self.changes(added)))
+
+    # Return the strokes an undo or redo changed, by owner, as (device id,
+    # stroke) pairs
+    def changes(self, strokes):
+        return [(owner.device_id, stroke) for stroke, owner in strokes.items()]
+
+    def on_clear(self, device):
+        if self.shares(device.device_id):
+            self.outgoing.append((CLEAR, device))
+
+    def on_erase(self, device, pos, start):
+        if self.shares(device.device_id):
+            self.outgoing.append((ERASE, device, pos, pos if start is None else start))
+
+    def on_unpair(self, device):
+        if self.shares(device.device_id):
+            self.outgoing.append((LEAVE, device))
+
+    # Take the changes queued so far as (device id, name, encoded operation)
+    # tuples, merging each run of points from a device into one operation
+    def take_outgoing(self):
+        operations = []
+        points = None
+        for _ in range(len(self.outgoing)):
+            change = self.outgoing.popleft()
+            kind, device = change[0], change[1]
+            if kind == POINTS:
+                if points is None or points[0] is not device:
+                    points = (device, new_points())
+                    operations.append(points)
+                points[1].extend(change[2])
+                continue
+            points = None
+            operations.append((device, (kind, device.device_id) + change[2:]))
+
+        encoded = []
+        for device, operation in operations:
+            if isinstance(operation, tuple):
+                data = encode_operation(operation)
+            else:
+                data = encode_operation((POINTS, device.device_id, device.get_color(), device.get_size(), operation))
+            encoded.append((device.device_id, device.name, data))
+        return encoded
+
+    # Queue a frame of operations for a peer, leaving out its own changes
+    # and declaring devices it has not heard of. A peer that has fallen
+    # max_pending bytes behind is disconnected rather than buffered without
+    # bound, it is sent the whole canvas again when it reconnects.
+    def send_operations(self, connection, operations, limit=True):
+        out = bytearray()
+        for device_id, name, data in operations:
+            if device_id.startswith(connection.prefix):
+                continue
+            if device_id not in connection.declared:
+                connection.declared.add(device_id)
+                out += encode_operation((DEVICE, device_id, name))
+            out += data
+        if out and not connection.send(bytes(out), limit):
+            logger.warning(f"Disconnecting {connection.label}, it is not keeping up")
+            connection.abort()
+
+    # Send the changes queued since the last batch to every peer
+    def flush(self):
+        if self.outgoing:
+            operations = self.take_outgoing()
+            for connection in list(self.connections):
+                self.send_operations(connection, operations)
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            self.flush()
+
+    # Return operations that recreate every shared device's strokes. The
+    # input lock is held while the strokes are copied, so nothing changes
+    # between the copy and the changes still queued, which are returned for
+    # the peers already connected.
+    def snapshot(self):
+        with self.input_manager.lock:
+            pending = self.take_outgoing()
+            log = self.input_manager.log
+            devices = [
+                (device.device_id, device.name, device.get_strokes(), log.get_redo_strokes(device.device_id))
+                for device in list(self.input_manager.inputs.values()) + list(self.input_manager.detached.values())
+                if self.shares(device.device_id)
+            ]
+
+        operations = []
+        for device_id, name, strokes, redo_strokes in devices:
+            # Declaring the device, even with nothing to add, replaces what
+            # the peer kept of it from an earlier connection
+            operations.append((device_id, name, b""))
+            # Undoing the strokes to redo, the last added first, leaves them
+            # to be redone in the same order
+            redo_strokes.reverse()
+            for stroke in strokes + redo_strokes:
+                operations.append((device_id, name, encode_operation((ADD, device_id, stroke))))
+            for stroke in reversed(redo_strokes):
+                operations.append((device_id, name, encode_operation((UNDO, device_id, [(device_id, stroke)], []))))
+        return operations, pending
+
+    # Exchange operations with a peer until it disconnects
+    async def handle_connection(self, connection):
+        writer = asyncio.ensure_future(connection.write_loop())
+        try:
+            await asyncio.wait_for(connection.greet(self.name), 10)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError, IndexError, OverflowError, UnicodeDecodeError) as error:
+            logger.warning(f"Rejected {connection.label}: {error}")
+            writer.cancel()
+            connection.close()
+            return
+        if any(other.label == connection.label for other in self.connections):
+            logger.warning(f"Rejected {connection.label}, a peer with that name is connected")
+            writer.cancel()
+            connection.close()
+            return
+
+        operations, pending = self.snapshot()
+        for other in list(self.connections):
+            self.send_operations(other, pending)
+        self.connections.append(connection)
+        self.send_operations(connection, operations, limit=False)
+        logger.info(f"Collaborating with {connection.label}")
+
+        try:
+            async for operations in connection.read_frames():
+                for operation in operations:
+                    self.incoming.append((connection, operation))
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError, OverflowError, UnicodeDecodeError) as error:
+            if not connection.closed:
+                logger.warning(f"Lost {connection.label}: {error}")
+        finally:
+            writer.cancel()
+            connection.close()
+            self.connections.remove(connection)
+            self.incoming.append((connection, (LEAVE, None)))
+            logger.info(f"{connection.label} disconnected")
+
+    # Apply the operations received from peers, called once per frame by
+    # the render loop
+    def apply_remote(self):
+        input_manager = self.input_manager
+        for _ in range(len(self.incoming)):
+            connection, operation = self.incoming.popleft()
+            kind = operation[0]
+            if operation[1] is None:
+                # The peer is gone, its devices keep their strokes
+                for device_id in connection.devices:
+                    if input_manager.get_device(device_id):
+                        input_manager.unpair_device(device_id)
+                continue
+
+            device_id = connection.prefix + operation[1]
+            if kind == DEVICE:
+                # The peer sends everything a device holds when it is first
+                # declared, so start it afresh
+                input_manager.restore_device(device_id, operation[2], [], [])
+                connection.devices.add(device_id)
+            elif device_id not in connection.devices:
+                logger.warning(f"{connection.label} sent an operation for undeclared device {operation[1]}")
+            elif kind == POINTS:
+                # A device drawing on the peer shows up with its cursor here
+                _, _, color, width, points = operation
+                if not input_manager.get_device(device_id):
+                    input_manager.pair_device(device_id, input_manager.find_device(device_id).name, connection.label)
+                input_manager.set_color(device_id, color)
+                input_manager.set_size(device_id, width)
+                for i in range(0, len(points) - 1, 2):
+                    input_manager.add_to_current_line(device_id, (points[i], points[i + 1]))
+                if points:
+                    input_manager.set_position(device_id, (points[-2], points[-1]))
+            elif kind == ADD:
+                input_manager.clear_current_line(device_id)
+                input_manager.add_stroke(device_id, operation[2])
+            elif kind in (UNDO, REDO):
+                removed = [(self.local_id(connection, owner_id), stroke) for owner_id, stroke in operation[2]]
+                added = [(self.local_id(connection, owner_id), stroke) for owner_id, stroke in operation[3]]
+                input_manager.apply_recorded(device_id, removed, added, redo=kind == REDO)
+            elif kind == CLEAR:
+                input_manager.clear(device_id)
+            elif kind == ERASE:
+                input_manager.erase(device_id, operation[2], operation[3])
+            elif kind == LEAVE and input_manager.get_device(device_id):
+                input_manager.unpair_device(device_id)
+
+    # Return our id for a device named in a peer's operation. The peer
+    # knows our devices by the prefix it gave us, and every other device
+    # gets the peer's prefix.
+    def local_id(self, connection, device_id):
+        own = f"remote:{self.name}:"
+        if device_id.startswith(own):
+            return device_id[len(own):]
+        return connection.prefix + device_id
+
+    # Close every connection and stop the loop
+    def stop(self, timeout=2):
+        if not self.thread.is_alive():
+            return
+        self.loop.call_soon_threadsafe(self.stopping.set)
+        self.thread.join(timeout)
+
+
+class CollabServer(CollabPeer):
+    # Accepts any number of peers and relays each one's changes to the others
+    def __init__(self, input_manager, name, host="0.0.0.0", port=8765, **kwargs):
+        super().__init__(input_manager, name, **kwargs)
+        self.host = host
+        self.port = port
+
+    async def accept(self, reader, writer):
+        host, port = writer.get_extra_info("peername")[:2]
+        await self.handle_connection(Connection(reader, writer, f"{host}:{port}", self.max_pending))
+
+    async def serve(self):
+        self.server = await asyncio.start_server(self.accept, self.host, self.port)
+        logger.info(f"Collaboration server listening on {self.host}:{self.port}")
+        try:
+            await super().serve()
+        finally:
+            self.server.close()
+
+
+class CollabClient(CollabPeer):
+    # Connects to a server, reconnecting until it is stopped. The server
+    # relays the other peers, so only this canvas's own devices are sent.
+    def __init__(self, input_manager, name, host, port=8765, retry_interval=2.0, **kwargs):
+        super().__init__(input_manager, name, **kwargs)
+        self.host = host
+        self.port = port
+        self.retry_interval = retry_interval
+
+    def shares(self, device_id):
+        return not device_id.startswith("remote:")
+
+    async def serve(self):
+        asyncio.ensure_future(self.connect_loop())
+        await super().serve()
+
+    async def connect_loop(self):
+        while not self.stopping.is_set():
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as error:
+                logger.warning(f"Could not reach collaboration server {self.host}:{self.port}: {error}")
+            else:
+                await self.handle_connection(Connection(reader, writer, f"{self.host}:{self.port}", self.max_pending))
+            await asyncio.sleep(self.retry_interval)
@@ -1,18 +1,29 @@
 import pygame
 
 class ColorButton:
-    def __init__(self, color, position):
+    def __init__(self, color, position, background=(200, 200, 200)):
         self.color = color
         self.position = position
         self.rect = pygame.Rect(position[0] - 10, position[1] - 10, 20, 20)
+        self.background = background
+        # The button rendered in its normal and hover state
+        self.surfaces = {hover: self.render(hover) for hover in (False, True)}
 
-    def draw(self, surface, hover=False):
+    # Render the button onto a surface of its own size
+    def render(self, hover):
+        surface = pygame.Surface(self.rect.size)
+        surface.fill(self.background)
+        rect = surface.get_rect()
         if hover:
             brighter = tuple(min(c + 50, 255) for c in self.color)
-            pygame.draw.rect(surface, brighter, self.rect, border_radius=5)
-            pygame.draw.rect(surface, (255, 255, 255), self.rect, 2, border_radius=5)
+            pygame.draw.rect(surface, brighter, rect, border_radius=5)
+            pygame.draw.rect(surface, (255, 255, 255), rect, 2, border_radius=5)
         else:
-            pygame.draw.rect(surface, self.color, self.rect, border_radius=5)
+            pygame.draw.rect(surface, self.color, rect, border_radius=5)
+        return surface
+
+    def draw(self, surface, hover=False):
+        surface.blit(self.surfaces[hover], self.rect)
 
-    def is_clicked(self, pos):
-        return self.rect.collidepoint(pos)
\ No newline at end of file
+    def get_rect(self):
+        return self.rect
@@ -0,0 +1,211 @@
+import json
+import os
+from collections import namedtuple
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# The settings are read once at startup into these immutable tuples, which
+# the objects built from them copy into plain attributes
+DeviceConfig = namedtuple("DeviceConfig", "name role")
+ButtonConfig = namedtuple("ButtonConfig", "action label x color")
+HeaderConfig = namedtuple("HeaderConfig", "height background button_y buttons palette_x palette_spacing")
+PerformanceConfig = namedtuple(
+    "PerformanceConfig",
+    "refresh_interval fps eraser_radius simplify_tolerance motion_clamp min_distance queue_size"
+)
+# device_names are the devices to pair and admin_names the admins among
+# them, both frozensets so checking a name is a single hash lookup
+Config = namedtuple("Config", "devices device_names admin_names palette header performance")
+
+# Largest eraser radius or stroke width, in pixels. Strokes received from
+# collaborating peers are held to the same limit.
+MAX_SIZE = 200
+
+# Roles a device can have. An admin's erasing and clearing applies to every
+# device's strokes, a user's only to its own.
+ROLES = ("admin", "user")
+# What a header button can do, HeaderManager acts on these
+BUTTON_ACTIONS = ("Undo", "Redo", "Clear", "Eraser", "Marker", "Change Color")
+
+DEFAULTS = {
+    "devices": [
+        {"name": "ImExPS/2 Generic Explorer Mouse", "role": "admin"},
+        {"name": "Lenovo Bluetooth Mouse", "role": "user"},
+        {"name": "Microsoft Arc Mouse", "role": "user"},
+    ],
+    "palette": [[255, 0, 0], [0, 255, 0], [0, 0, 255], [255, 255, 0], [255, 0, 255], [0, 255, 255]],
+    "header": {
+        "height": 100,
+        "background": [200, 200, 200],
+        "button_y": 50,
+        "buttons": [
+            {"action": "Undo", "label": "<-", "x": 100, "color": [255, 255, 255]},
+            {"action": "Redo", "label": "->", "x": 250, "color": [255, 255, 255]},
+            {"action": "Clear", "label": "X", "x": 400, "color": [255, 255, 255]},
+            {"action": "Eraser", "label": "E", "x": 550, "color": [255, 255, 255]},
+            {"action": "Marker", "label": "M", "x": 700, "color": [0, 0, 0]},
+            {"action": "Change Color", "label": "C", "x": 850, "color": [128, 128, 128]},
+        ],
+        "palette_x": 950,
+        "palette_spacing": 50,
+    },
+    "performance": {
+        "refresh_interval": 0.1,
+        "fps": 60,
+        "eraser_radius": 10,
+        "simplify_tolerance": 1,
+        "motion_clamp": 7,
+        "min_distance": 2,
+        "queue_size": 4096,
+    },
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+# Return a table of the config, complaining about keys it does not know
+def check_table(value, where, keys):
+    if not isinstance(value, dict):
+        raise ConfigError(f"{where} must be a table")
+    unknown = set(value) - set(keys)
+    if unknown:
+        raise ConfigError(f"Unknown setting {where}.{sorted(unknown)[0]}")
+    return value
+
+# Return a number from a table, or its default, within bounds
+def check_number(table, defaults, key, where, minimum, maximum=None, integer=True):
+    value = table.get(key, defaults[key])
+    kinds = int if integer else (int, float)
+    if isinstance(value, bool) or not isinstance(value, kinds):
+        raise ConfigError(f"{where}.{key} must be {'an integer' if integer else 'a number'}")
+    if value < minimum or (maximum is not None and value > maximum):
+        bounds = f"at least {minimum}" if maximum is None else f"between {minimum} and {maximum}"
+        raise ConfigError(f"{where}.{key} must be {bounds}, not {value}")
+    return value
+
+# Return an (r, g, b) color
+def check_color(value, where):
+    if (not isinstance(value, list) or len(value) != 3
+            or any(isinstance(part, bool) or not isinstance(part, int) or not 0 <= part <= 255 for part in value)):
+        raise ConfigError(f"{where} must be a list of three integers from 0 to 255")
+    return tuple(value)
+
+# Return a non-empty string
+def check_text(table, key, where):
+    value = table.get(key)
+    if not isinstance(value, str) or not value:
+        raise ConfigError(f"{where}.{key} must be a non-empty string")
+    return value
+
+
+# Validate the settings read from a file, with anything left out taken from
+# DEFAULTS, and return them as a Config
+def build_config(settings):
+    check_table(settings, "config", DEFAULTS)
+
+    devices = []
+    names = set()
+    for i, device in enumerate(settings.get("devices", DEFAULTS["devices"])):
+        where = f"devices[{i}]"
+        check_table(device, where, ("name", "role"))
+        name = check_text(device, "name", where)
+        role = device.get("role", "user")
+        if role not in ROLES:
+            raise ConfigError(f"{where}.role must be one of {', '.join(ROLES)}, not {role!r}")
+        if name in names:
+            raise ConfigError(f"Device {name!r} is listed twice")
+        names.add(name)
+        devices.append(DeviceConfig(name, role))
+
+    palette = settings.get("palette", DEFAULTS["palette"])
+    if not isinstance(palette, list) or not palette:
+        raise ConfigError("palette must be a non-empty list of colors")
+    palette = tuple(check_color(color, f"palette[{i}]") for i, color in enumerate(palette))
+
+    defaults = DEFAULTS["header"]
+    header = check_table(settings.get("header", {}), "header", defaults)
+    height = check_number(header, defaults, "height", "header", 20)
+    button_y = check_number(header, defaults, "button_y", "header", 0, height)
+    buttons = []
+    actions = set()
+    for i, button in enumerate(header.get("buttons", defaults["buttons"])):
+        where = f"header.buttons[{i}]"
+        check_table(button, where, ("action", "label", "x", "color"))
+        action = check_text(button, "action", where)
+        if action not in BUTTON_ACTIONS:
+            raise ConfigError(f"{where}.action must be one of {', '.join(BUTTON_ACTIONS)}, not {action!r}")
+        if action in actions:
+            raise ConfigError(f"Header button {action!r} is listed twice")
+        actions.add(action)
+        buttons.append(ButtonConfig(
+            action,
+            check_text(button, "label", where),
+            check_number(button, {"x": None}, "x", where, 0),
+            check_color(button.get("color", [255, 255, 255]), f"{where}.color")
+        ))
+    header = HeaderConfig(
+        height,
+        check_color(header.get("background", defaults["background"]), "header.background"),
+        button_y,
+        tuple(buttons),
+        check_number(header, defaults, "palette_x", "header", 0),
+        check_number(header, defaults, "palette_spacing", "header", 20)
+    )
+
+    defaults = DEFAULTS["performance"]
+    performance = check_table(settings.get("performance", {}), "performance", defaults)
+    performance = PerformanceConfig(
+        check_number(performance, defaults, "refresh_interval", "performance", 0, 1, integer=False),
+        check_number(performance, defaults, "fps", "performance", 1, 1000),
+        check_number(performance, defaults, "eraser_radius", "performance", 1, MAX_SIZE),
+        check_number(performance, defaults, "simplify_tolerance", "performance", 0, 20, integer=False),
+        check_number(performance, defaults, "motion_clamp", "performance", 1),
+        check_number(performance, defaults, "min_distance", "performance", 0),
+        check_number(performance, defaults, "queue_size", "performance", 16),
+    )
+
+    return Config(
+        tuple(devices),
+        frozenset(device.name for device in devices),
+        frozenset(device.name for device in devices if device.role == "admin"),
+        palette,
+        header,
+        performance
+    )
+
+
+# Read a TOML or JSON config file, by its extension, or return the defaults
+# when path is None
+def load_config(path=None):
+    if path is None:
+        return DEFAULT_CONFIG
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension == ".toml":
+            if tomllib is None:
+                raise ConfigError("TOML config files need Python 3.11 or later, use JSON instead")
+            with open(path, "rb") as config_file:
+                settings = tomllib.load(config_file)
+        elif extension == ".json":
+            with open(path) as config_file:
+                settings = json.load(config_file)
+        else:
+            raise ConfigError(f"{path} must be a .toml or .json file")
+    except OSError as error:
+        raise ConfigError(f"Cannot read {path}: {error.strerror}")
+    except ValueError as error:
+        if isinstance(error, ConfigError):
+            raise
+        raise ConfigError(f"Cannot parse {path}: {error}")
+    try:
+        return build_config(settings)
+    except ConfigError as error:
+        raise ConfigError(f"{path}: {error}")
+
+
+DEFAULT_CONFIG = build_config({})
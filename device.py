@@ -1,22 +1,30 @@
 from logging_manager import logger
+from stroke import Stroke, new_points, simplify, erase_points
+from stroke_index import StrokeIndex
 
 class Device:   
-    ADMIN = 'ImExPS/2 Generic Explorer Mouse'
-
-    def __init__(self, device_id, name, user_id, position):
+    # An admin's eraser and clear apply to every device's strokes. The
+    # simplify tolerance is in pixels, 0 keeps every point of a line.
+    def __init__(self, device_id, name, user_id, position, admin=False, eraser_radius=10, simplify_tolerance=1):
         self.device_id = device_id
         self.user_id = user_id
         self.name = name
+        self.admin = admin
+        self.eraser_radius = eraser_radius
+        self.simplify_tolerance = simplify_tolerance
         self.position = position
         self.color = (0, 0, 0)
         self.tool = "Marker"
         self.size = 5
-        self.undo_stack = []
-        self.redo_stack = []
-        self.current_line = []
+        # Committed strokes on the board, in drawing order. A dict keeps the
+        # order and finds a stroke without searching.
+        self.strokes = {}
+        self.current_line = new_points()
+        self.index = None
+        self.points_saved = 0
     
     def is_admin(self):
-        return self.name == self.ADMIN
+        return self.admin
 
     # Set a device (x, y) position
     def set_position(self, new_pos):
@@ -28,75 +36,103 @@ class Device:
 
     # Track and update the current line
     def add_to_current_line(self, point):
-        self.current_line.append(point)
+        self.current_line.extend(point)
 
     # Clear current line
     def reset_current_line(self):
-        self.current_line = []
+        self.current_line = new_points()
 
     # Return current line
     def get_current_line(self):
         return self.current_line
 
-    # Add line to the stack
+    # Return the eraser index, built from the strokes on first use so
+    # restored devices do not pay for it up front
+    def get_index(self):
+        if self.index is None:
+            self.index = StrokeIndex()
+            for stroke in self.strokes:
+                self.index.add(stroke)
+        return self.index
+
+    # Commit the current line and return the stroke, the current line
+    # buffer is simplified into the stroke rather than copied. Points are
+    # kept at most the eraser radius apart, so an eraser anywhere on a
+    # straight run still hits one.
     def add_line(self):
         if self.current_line:
-            self.undo_stack.append((self.current_line.copy(), self.color))
-            self.redo_stack.clear()
+            points = simplify(self.current_line, self.simplify_tolerance, self.eraser_radius)
+            self.points_saved += (len(self.current_line) - len(points)) // 2
+            stroke = Stroke(points, self.color, self.size, self.tool)
+            self.add_stroke(stroke)
             self.reset_current_line()
-
-    # Pop line from undo stack and push line onto redo stack
-    def undo(self):
-        if self.undo_stack:
-            line = self.undo_stack.pop()
-            self.redo_stack.append(line)
-            logger.info(f"{self.user_id} performed undo")
-            return True
-        logger.info(f"{self.user_id} undo stack empty")
-        return False
-
-    # Pop line from redo stack and push line onto redo stack
-    def redo(self):
-        if self.redo_stack:
-            line = self.redo_stack.pop()
-            self.undo_stack.append(line)
-            logger.info(f"{self.user_id} performed redo")
-            return True
-        logger.info(f"{self.user_id} redo stack empty")
-        return False
-
-    # Return undo stack
-    def get_undo_stack(self):
-        return self.undo_stack if self.undo_stack else None
-
-    # Return redo stack
-    def get_redo_stack(self):
-        return self.redo_stack if self.redo_stack else None
-
-    # Remove and split the line
-    def remove_point(self, pos):
-        temp_stack = []
-        for line, color in self.undo_stack or []:
-            segments = []
-            current_segment = []
-            for point in line:
-                if (pos[0] - point[0]) ** 2 + (pos[1] - point[1]) ** 2 >= 10 ** 2:
-                    current_segment.append(point)
+            return stroke
+        return None
+
+    # Put a committed stroke on top of the device's strokes
+    def add_stroke(self, stroke):
+        self.strokes[stroke] = None
+        if self.index is not None:
+            self.index.add(stroke)
+
+    # Take a stroke off the board
+    def remove_stroke(self, stroke):
+        del self.strokes[stroke]
+        if self.index is not None:
+            self.index.remove(stroke)
+
+    # Replace the strokes with restored ones
+    def restore(self, strokes):
+        self.strokes = dict.fromkeys(strokes)
+        self.index = None
+
+    # Return the committed strokes in drawing order
+    def get_strokes(self):
+        return list(self.strokes)
+
+    # Return the number of points dropped by simplifying committed lines
+    def get_points_saved(self):
+        return self.points_saved
+
+    # Remove and split the lines near the position, or near the eraser's
+    # path to it from start, return each line that changed with the
+    # segments that replaced it
+    def remove_point(self, pos, start=None):
+        changes = []
+        if start is None:
+            start = pos
+        index = self.get_index()
+        for stroke in index.query(pos, self.eraser_radius, start):
+            segments = erase_points(stroke.points, start, pos, self.eraser_radius)
+            if segments is None:
+                continue
+
+            # Swap the split line for its segments in the index
+            index.remove(stroke)
+            split = [stroke.with_points(segment) for segment in segments]
+            for segment in split:
+                index.add(segment)
+            changes.append((stroke, split))
+
+        # Put the segments where each split line was drawn, in one pass
+        if changes:
+            replaced = dict(changes)
+            strokes = {}
+            for stroke in self.strokes:
+                if stroke in replaced:
+                    strokes.update(dict.fromkeys(replaced[stroke]))
                 else:
-                    if len(current_segment) >= 2:
-                        segments.append(current_segment)
-                    current_segment = []
-            if len(current_segment) >= 2:
-                segments.append(current_segment)
-            for segment in segments:
-                temp_stack.append((segment, color))
-        self.undo_stack = temp_stack
-
-    # Clear the device stacks
+                    strokes[stroke] = None
+            self.strokes = strokes
+        return changes
+
+    # Take every stroke off the board and return them
     def clear(self):
-        self.undo_stack = []
-        self.redo_stack = []
+        strokes = list(self.strokes)
+        self.strokes = {}
+        self.index = None
         logger.info(f"{self.user_id} cleared canvas")
+        return strokes
 
     # Set the device color
     def set_color(self, color):
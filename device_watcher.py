@@ -0,0 +1,94 @@
+import threading
+from evdev import InputDevice, list_devices
+from logging_manager import logger
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+
+# Return the name of the input device at a path
+def read_device_name(device_path):
+    device = InputDevice(device_path)
+    try:
+        return device.name
+    finally:
+        device.close()
+
+
+class DeviceWatcher:
+    # on_add(path, name) and on_remove(path) are called from the watcher
+    # thread. list_paths and read_name can be replaced to feed the watcher
+    # fake devices instead of /dev/input.
+    def __init__(self, device_names, on_add, on_remove, list_paths=list_devices, read_name=read_device_name, interval=1.0):
+        self.device_names = device_names
+        self.on_add = on_add
+        self.on_remove = on_remove
+        self.list_paths = list_paths
+        self.read_name = read_name
+        self.interval = interval
+        self.names = {}
+        self.paired = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="DeviceWatcher", daemon=True)
+        self.monitor = None
+        if pyudev is not None and list_paths is list_devices:
+            self.monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            self.monitor.filter_by(subsystem='input')
+            self.monitor.start()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(self.interval * 2)
+
+    # Return the paths currently paired, by device name
+    def get_paired(self):
+        return dict(self.paired)
+
+    # Compare the device nodes against the last scan, then remove the ones
+    # that went away and add the wanted devices that appeared. Nodes seen
+    # before are checked again, so a second device with a wanted name is
+    # paired once the first one is unplugged.
+    def scan(self):
+        paths = set(self.list_paths())
+
+        for device_path in list(self.names):
+            if device_path not in paths:
+                name = self.names.pop(device_path)
+                if self.paired.get(name) == device_path:
+                    del self.paired[name]
+                    logger.info(f"Device {name} removed from {device_path}")
+                    self.on_remove(device_path)
+
+        for device_path in sorted(paths):
+            name = self.names.get(device_path)
+            if name is None:
+                try:
+                    name = self.read_name(device_path)
+                except OSError as error:
+                    # The node may not be readable yet, try again on the next scan
+                    logger.debug("Could not open %s: %s", device_path, error)
+                    continue
+                self.names[device_path] = name
+            if name in self.device_names and name not in self.paired:
+                self.paired[name] = device_path
+                logger.info(f"Device {name} found at {device_path}")
+                self.on_add(device_path, name)
+
+    # Wait for udev to report a change, or for the polling interval
+    def wait(self):
+        if self.monitor is not None:
+            self.monitor.poll(timeout=self.interval)
+            # Let the device node settle before it is opened
+            self.stop_event.wait(0.1)
+        else:
+            self.stop_event.wait(self.interval)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.scan()
+            self.wait()
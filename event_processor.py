@@ -0,0 +1,219 @@
+from collections import deque
+from evdev import ecodes
+from logging_manager import logger
+
+class DeviceState:
+    def __init__(self, position):
+        self.x, self.y = position
+        self.button_pressed = False
+        # Motion accumulated since the last SYN_REPORT
+        self.dx = 0
+        self.dy = 0
+        self.last_point = None
+        # Board position the eraser last erased at while the button is held
+        self.last_erase = None
+
+
+class EventQueue(deque):
+    # A device's raw (type, code, value, time) events, appended by its
+    # reader and drained by the render thread. Past limit events, relative
+    # motion and the reports ending it are summed rather than queued, and
+    # queued as one report before the next event let in, so a render thread
+    # that falls behind loses the steps of the motion but never a button
+    # press or release. Only the reader touches the sums.
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.dx = 0
+        self.dy = 0
+        self.held_time = None
+        # Events summed since the count was last taken
+        self.coalesced = 0
+
+    def append(self, event):
+        event_type, code, value, read_time = event
+        if len(self) >= self.limit and event_type in (ecodes.EV_REL, ecodes.EV_SYN):
+            if event_type == ecodes.EV_REL:
+                if code == ecodes.REL_X:
+                    self.dx += value
+                elif code == ecodes.REL_Y:
+                    self.dy += value
+            if self.held_time is None:
+                self.held_time = read_time
+            self.coalesced += 1
+            return
+        if self.held_time is not None:
+            self.release()
+        super().append(event)
+
+    def extend(self, events):
+        for event in events:
+            self.append(event)
+
+    # Queue the motion summed so far as one report
+    def release(self):
+        held_time = self.held_time
+        if self.dx:
+            super().append((ecodes.EV_REL, ecodes.REL_X, self.dx, held_time))
+        if self.dy:
+            super().append((ecodes.EV_REL, ecodes.REL_Y, self.dy, held_time))
+        super().append((ecodes.EV_SYN, ecodes.SYN_REPORT, 0, held_time))
+        self.dx = 0
+        self.dy = 0
+        self.held_time = None
+
+    # Return the number of events summed since the last call
+    def take_coalesced(self):
+        coalesced = self.coalesced
+        self.coalesced = 0
+        return coalesced
+
+
+class EventProcessor:
+    def __init__(self, input_manager, header_manager, screen_width, screen_height, header_height=100, queue_size=4096, min_distance=2, viewport=None, motion_clamp=7):
+        self.input_manager = input_manager
+        self.header_manager = header_manager
+        # Maps screen positions to the board coordinates strokes are kept in
+        self.viewport = viewport
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.header_height = header_height
+        self.queue_size = queue_size
+        # Stroke points closer than this to the previous point are dropped
+        self.min_distance = min_distance
+        # Largest step in pixels a report moves a device while drawing
+        self.motion_clamp = motion_clamp
+        self.queues = {}
+        self.states = {}
+        # perf_counter time the oldest input applied since the last frame
+        # was shown was read at, or None
+        self.input_time = None
+        # Events applied per device since the counts were last taken
+        self.event_counts = {}
+        # (device id, queue) of the devices whose readers stopped
+        self.removed = deque()
+
+    # Register a device and return the queue its reader pushes raw (type,
+    # code, value, time) events onto, time being when the event was read by
+    # time.perf_counter. Past queue_size events motion is coalesced.
+    def add_device(self, device_id):
+        queue = EventQueue(self.queue_size)
+        self.queues[device_id] = queue
+        return queue
+
+    # Stop draining a device and unpair it, called by its reader when it
+    # stops. Both happen on the render thread once the events the device
+    # queued are applied, as unpairing commits its current line.
+    def remove_device(self, device_id):
+        self.removed.append((device_id, self.queues.get(device_id)))
+
+    # Apply every queued event and unpair the removed devices, called once
+    # per frame by the render thread
+    def drain(self):
+        for device_id, queue in list(self.queues.items()):
+            self.drain_queue(device_id, queue)
+        while self.removed:
+            device_id, queue = self.removed.popleft()
+            if queue is not None and self.queues.get(device_id) is queue:
+                self.drain_queue(device_id, queue)
+                del self.queues[device_id]
+            self.states.pop(device_id, None)
+            self.input_manager.unpair_device(device_id)
+
+    # Apply the events queued by a device
+    def drain_queue(self, device_id, queue):
+        count = len(queue)
+        if count:
+            self.event_counts[device_id] = self.event_counts.get(device_id, 0) + count
+        for _ in range(count):
+            event_type, code, value, read_time = queue.popleft()
+            if self.input_time is None:
+                self.input_time = read_time
+            self.apply(device_id, event_type, code, value)
+        coalesced = queue.take_coalesced()
+        if coalesced:
+            logger.warning(f"Render loop fell behind, coalesced {coalesced} motion events from {device_id}")
+
+    # Return when the oldest input applied since the last call was read, so
+    # the time it takes to reach the screen can be measured, or None
+    def take_input_time(self):
+        input_time = self.input_time
+        self.input_time = None
+        return input_time
+
+    # Return the events applied per device since the last call
+    def take_event_counts(self):
+        event_counts = self.event_counts
+        self.event_counts = {}
+        return event_counts
+
+    # Apply a single raw event to the device state
+    def apply(self, device_id, event_type, code, value):
+        state = self.states.get(device_id)
+        if state is None:
+            state = self.states[device_id] = DeviceState(self.input_manager.get_position(device_id))
+
+        if event_type == ecodes.EV_KEY and code == ecodes.BTN_LEFT:
+            self.apply_motion(device_id, state)
+            if not state.button_pressed:
+                if state.y < self.header_height:
+                    logger.info(f"Header click event received at {(state.x, state.y)} from {device_id}")
+                    self.header_manager.handle_click((state.x, state.y), device_id, self.input_manager)
+            state.button_pressed = (value == 1)
+            if not state.button_pressed:
+                current_line = self.input_manager.get_current_line(device_id)
+                if current_line:
+                    # Keep the end of the stroke even if it was too close to be sampled
+                    if state.last_point != (state.x, state.y) and state.y >= self.header_height:
+                        self.input_manager.add_to_current_line(device_id, self.to_board((state.x, state.y)))
+                    self.input_manager.add_line(device_id)
+                    self.input_manager.clear_current_line(device_id)
+                state.last_point = None
+                state.last_erase = None
+            return
+
+        # Accumulate relative motion until the report is complete
+        if event_type == ecodes.EV_REL:
+            if code == ecodes.REL_X:
+                state.dx += value
+            elif code == ecodes.REL_Y:
+                state.dy += value
+        elif event_type == ecodes.EV_SYN and code == ecodes.SYN_REPORT:
+            self.apply_motion(device_id, state)
+
+    # Apply the motion of a whole report as one position update and at most
+    # one stroke point
+    def apply_motion(self, device_id, state):
+        if not state.dx and not state.dy:
+            return
+        if state.button_pressed:
+            clamp = self.motion_clamp
+            state.x += max(-clamp, min(clamp, state.dx))
+            state.y += max(-clamp, min(clamp, state.dy))
+        else:
+            state.x += state.dx
+            state.y += state.dy
+        state.dx = 0
+        state.dy = 0
+
+        state.x = max(0, min(self.screen_width, state.x))
+        state.y = max(0, min(self.screen_height, state.y))
+
+        self.input_manager.set_position(device_id, (state.x, state.y))
+
+        if state.button_pressed and state.y >= self.header_height:
+            if self.input_manager.get_tool(device_id) == 'Eraser':
+                position = self.to_board((state.x, state.y))
+                self.input_manager.erase(device_id, position, state.last_erase)
+                state.last_erase = position
+            else:
+                last_point = state.last_point
+                if last_point is None or (state.x - last_point[0]) ** 2 + (state.y - last_point[1]) ** 2 >= self.min_distance ** 2:
+                    state.last_point = (state.x, state.y)
+                    self.input_manager.add_to_current_line(device_id, self.to_board(state.last_point))
+
+    # Return the board position under a screen position
+    def to_board(self, position):
+        if self.viewport is None:
+            return position
+        return self.viewport.to_board(position)
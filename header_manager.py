@@ -1,48 +1,87 @@
-import pygame
 import time
+from bisect import bisect_right
 from logging_manager import logger
+from config import DEFAULT_CONFIG, ConfigError
 from tool_button import ToolButton
 from color_button import ColorButton
 
 class HeaderManager:
-    def __init__(self, header_surface, colors):
+    # The buttons are laid out by a HeaderConfig
+    def __init__(self, header_surface, colors, layout=DEFAULT_CONFIG.header):
         self.surface = header_surface
+        self.background = layout.background
         self.buttons = [
-            ToolButton('Undo', '<-', (100, 50), (255, 255, 255)),
-            ToolButton('Redo', '->', (250, 50), (255, 255, 255)),
-            ToolButton('Clear', 'X', (400, 50), (255, 255, 255)),
-            ToolButton('Eraser', 'E', (550, 50), (255, 255, 255)),
-            ToolButton('Marker', 'M', (700, 50), (0, 0, 0)),
-            ToolButton('Change Color', 'C', (850, 50), (128, 128, 128))
+            ToolButton(button.action, button.label, (button.x, layout.button_y), button.color, self.background)
+            for button in layout.buttons
         ]
         self.show_palette = False
         self.palette_buttons = [
-            ColorButton(color, (950 + i * 50, 50)) for i, color in enumerate(colors)
+            ColorButton(color, (layout.palette_x + i * layout.palette_spacing, layout.button_y), self.background)
+            for i, color in enumerate(colors)
         ]
+        self.check_layout()
+        # Buttons shown, sorted by left edge, for finding the button under
+        # a position by its x coordinate
+        self.spans = []
+        self.lefts = []
+        self.update_spans()
+        self.hovered = set()
+        self.needs_redraw = True
         self.last_click_time = 0
         self.debounce_time = 0.1
 
+    # Refuse a layout with buttons that overlap, the lookup by left edge
+    # would miss clicks on them. The palette is shown with the buttons, so
+    # it may overlap neither. Their size depends on the rendered labels,
+    # which is why this is checked here rather than in config.py.
+    def check_layout(self):
+        named = [(f"header.buttons[{i}] ({button.text})", button) for i, button in enumerate(self.buttons)]
+        named += [(f"palette[{i}]", button) for i, button in enumerate(self.palette_buttons)]
+        for i, (name, button) in enumerate(named):
+            for other_name, other in named[:i]:
+                if button.get_rect().colliderect(other.get_rect()):
+                    raise ConfigError(f"{name} overlaps {other_name}")
+
+    # Sort the buttons shown by their left edge
+    def update_spans(self):
+        buttons = self.buttons + self.palette_buttons if self.show_palette else self.buttons
+        self.spans = sorted(((button.get_rect(), button) for button in buttons), key=lambda span: span[0].left)
+        self.lefts = [rect.left for rect, _ in self.spans]
+
+    # Return the button shown at a position, or None
+    def button_at(self, pos):
+        x, y = pos
+        i = bisect_right(self.lefts, x) - 1
+        if i < 0:
+            return None
+        rect, button = self.spans[i]
+        if x < rect.right and rect.top <= y < rect.bottom:
+            return button
+        return None
+
     # Draw the header background and buttons on the dedicated header_surface.
     def draw(self):
-        pygame.draw.rect(
-            self.surface,
-            (200, 200, 200),
-            (0, 0, self.surface.get_width(), self.surface.get_height())
-        )
-        for button in self.buttons:
+        self.surface.fill(self.background)
+        for _, button in self.spans:
             button.draw(self.surface)
-        if self.show_palette:
-            for button in self.palette_buttons:
-                button.draw(self.surface)
+        self.hovered = set()
+        self.needs_redraw = False
 
+    # Redraw the buttons whose hover state changed and return their rects
     def draw_buttons(self, device_positions):
-        for button in self.buttons:
-            combined_hover = any(button.is_clicked(pos) for pos in device_positions)
-            button.draw(self.surface, hover=combined_hover)
-        if self.show_palette:
-            for button in self.palette_buttons:
-                combined_hover = any(button.is_clicked(pos) for pos in device_positions)
-                button.draw(self.surface, hover=combined_hover)
+        hovered = set()
+        for pos in device_positions:
+            button = self.button_at(pos)
+            if button is not None:
+                hovered.add(button)
+        if hovered == self.hovered:
+            return []
+        rects = []
+        for button in hovered ^ self.hovered:
+            button.draw(self.surface, hover=button in hovered)
+            rects.append(button.get_rect())
+        self.hovered = hovered
+        return rects
 
     # Process click events for header buttons.
     def handle_click(self, pos, device_path, input_manager):
@@ -56,30 +95,32 @@ class HeaderManager:
             if current_line:
                 input_manager.add_line(device)
 
-        for button in self.buttons:
-            if button.is_clicked(pos):
-                logger.info(f"Button '{button.text}' clicked by {device_path}")
-                if button.text == 'Undo':
-                    input_manager.undo(device_path)
-                elif button.text == 'Redo':
-                    input_manager.redo(device_path)
-                elif button.text == 'Clear':
-                    input_manager.clear(device_path)
-                elif button.text == 'Change Color':
-                    self.show_palette = not self.show_palette
-                elif button.text == 'Eraser':
-                    input_manager.set_tool(device_path, 'Eraser')
-                    input_manager.set_size(device_path, 5)
-                elif button.text == 'Marker':
-                    input_manager.set_tool(device_path, 'Marker')
-                    input_manager.set_size(device_path, 5)
-                return
+        button = self.button_at(pos)
+        if button is None:
+            return
+        if button in self.palette_buttons:
+            logger.info(f"{device_path} changed color to {button.color}")
+            input_manager.set_color(device_path, button.color)
+            input_manager.set_tool(device_path, 'Marker')
+            self.show_palette = False
+            self.update_spans()
+            self.needs_redraw = True
+            return
 
-        if self.show_palette:
-            for color_button in self.palette_buttons:
-                if color_button.is_clicked(pos):
-                    logger.info(f"{device_path} changed color to {color_button.color}")
-                    input_manager.set_color(device_path, color_button.color)
-                    input_manager.set_tool(device_path, 'Marker')
-                    self.show_palette = False
-                    return
+        logger.info(f"Button '{button.text}' clicked by {device_path}")
+        if button.text == 'Undo':
+            input_manager.undo(device_path)
+        elif button.text == 'Redo':
+            input_manager.redo(device_path)
+        elif button.text == 'Clear':
+            input_manager.clear(device_path)
+        elif button.text == 'Change Color':
+            self.show_palette = not self.show_palette
+            self.update_spans()
+            self.needs_redraw = True
+        elif button.text == 'Eraser':
+            input_manager.set_tool(device_path, 'Eraser')
+            input_manager.set_size(device_path, 5)
+        elif button.text == 'Marker':
+            input_manager.set_tool(device_path, 'Marker')
+            input_manager.set_size(device_path, 5)
@@ -1,21 +1,52 @@
-import threading
+import time
 from logging_manager import logger
+from config import DEFAULT_CONFIG
 from device import Device
+from metrics import Timer, TimedLock
+from operation_log import OperationLog, ADD, ERASE, CLEAR
 
 
 class InputManager:
-    def __init__(self, screen_width, screen_height):
+    def __init__(self, screen_width, screen_height, config=DEFAULT_CONFIG):
         self.inputs = {}
-        self.lock = threading.Lock()
+        # Devices that were unpaired or restored, kept for their strokes
+        self.detached = {}
+        self.listeners = []
+        self.replaying = False
+        # Records its wait and hold times for the metrics
+        self.lock = TimedLock()
         self.screen_width = screen_width
         self.screen_height = screen_height
+        # Names of the devices with the admin role, and the settings every
+        # device is created with
+        self.admin_names = config.admin_names
+        self.eraser_radius = config.performance.eraser_radius
+        self.simplify_tolerance = config.performance.simplify_tolerance
+        # Changes to the committed strokes as (removed, added) pairs, where
+        # removed is a stroke or None and added a list of strokes
+        self.stroke_changes = []
+        self.needs_rebuild = True
+        # Every device's additions, erases and clears, for undo and redo
+        self.log = OperationLog()
+        # Time taken by each erase, a long one stalls the frame applying it
+        self.erase_timer = Timer()
 
     # Pair a device, and add it to the input
     def pair_device(self, device_id, name, user_id):
         with self.lock:
             logger.info(f"Attempting to pair Device {device_id} with user {user_id} and name {name}")
             if device_id not in self.inputs:
-                self.inputs[device_id] = Device(device_id, name, user_id, (self.screen_width // 2, self.screen_height // 2))
+                position = (self.screen_width // 2, self.screen_height // 2)
+                device = self.detached.pop(device_id, None)
+                if device:
+                    # A device that comes back keeps its strokes
+                    device.name = name
+                    device.admin = name in self.admin_names
+                    device.user_id = user_id
+                    device.set_position(position)
+                else:
+                    device = self.new_device(device_id, name, user_id, position)
+                self.inputs[device_id] = device
                 logger.info(f"Successfully paired Device {name} with user {user_id}")
                 return True
             else:
@@ -26,11 +57,79 @@ class InputManager:
         if device_id in self.inputs:
             return self.inputs[device_id].is_admin()
 
-    # Unpair a device, and remove it from the input
+    # Create a device with the role its name has and the configured settings
+    def new_device(self, device_id, name, user_id=None, position=None):
+        if position is None:
+            position = (self.screen_width // 2, self.screen_height // 2)
+        return Device(
+            device_id, name, user_id, position, admin=name in self.admin_names,
+            eraser_radius=self.eraser_radius, simplify_tolerance=self.simplify_tolerance
+        )
+
+    # Return a paired or detached device
+    def find_device(self, device_id):
+        return self.inputs.get(device_id) or self.detached.get(device_id)
+
+    # Return every device holding strokes, paired or detached
+    def get_stroke_devices(self):
+        with self.lock:
+            return list(self.inputs.values()) + list(self.detached.values())
+
+    # Register an object told about every change to the strokes
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Call a listener method unless the change is itself being replayed,
+    # listeners only implement the methods they care about
+    def notify(self, method, *args):
+        if not self.replaying:
+            for listener in self.listeners:
+                callback = getattr(listener, method, None)
+                if callback:
+                    callback(*args)
+
+    # Add restored strokes for a device, detached until it pairs again.
+    # Undo takes its latest strokes away and redo adds the redo strokes,
+    # the last one first.
+    def restore_device(self, device_id, name, strokes, redo_strokes):
+        with self.lock:
+            device = self.find_device(device_id)
+            if device is None:
+                device = self.detached[device_id] = self.new_device(device_id, name)
+            device.restore(strokes)
+            self.log.restore(device, strokes, redo_strokes)
+            self.needs_rebuild = True
+
+    # Take strokes off and put strokes back on the board, as undo and redo
+    # do, and queue the changes for the canvas
+    def apply(self, removed, added):
+        for stroke, device in removed.items():
+            device.remove_stroke(stroke)
+            self.stroke_changes.append((stroke, []))
+        for stroke, device in added.items():
+            device.add_stroke(stroke)
+            self.stroke_changes.append((None, [stroke]))
+
+    # Make sure a device exists to replay changes onto
+    def declare_device(self, device_id, name):
+        with self.lock:
+            if self.find_device(device_id) is None:
+                self.detached[device_id] = self.new_device(device_id, name)
+
+    # Unpair a device, and remove it from the input. Its strokes stay on
+    # the canvas and its current line is committed, so like every change
+    # to the strokes it is only called on the render thread.
     def unpair_device(self, device_id):
         with self.lock:
             if device_id in self.inputs:
-                del self.inputs[device_id]
+                device = self.inputs.pop(device_id)
+                stroke = device.add_line()
+                if stroke:
+                    self.stroke_changes.append((None, [stroke]))
+                    self.log.append(ADD, device_id, {}, {stroke: device})
+                    self.notify("on_add_stroke", device, stroke)
+                self.detached[device_id] = device
+                self.notify("on_unpair", device)
                 logger.info(f"{device_id} unpaired")
                 return True
             else:
@@ -61,45 +160,151 @@ class InputManager:
                 return self.inputs[device_id].get_position()
             return (self.screen_width // 2, self.screen_height // 2)
 
-    # Add a line to the input memory
+    # Add a line to the input memory and queue it for the canvas
     def add_line(self, device_id):
         with self.lock:
             if device_id in self.inputs:
-                self.inputs[device_id].add_line()
+                device = self.inputs[device_id]
+                stroke = device.add_line()
+                if stroke:
+                    self.stroke_changes.append((None, [stroke]))
+                    self.log.append(ADD, device_id, {}, {stroke: device})
+                    self.notify("on_add_stroke", device, stroke)
 
-    # Erase points from a line
-    def erase(self, device_id, pos):
+    # Add an already committed stroke, such as a restored one
+    def add_stroke(self, device_id, stroke):
         with self.lock:
-            if device_id in self.inputs:
-                if(self.is_admin(device_id)):
-                    for dev in self.inputs:
-                        self.inputs[dev].remove_point(pos)
-                self.inputs[device_id].remove_point(pos)
+            device = self.find_device(device_id)
+            if device:
+                device.add_stroke(stroke)
+                self.stroke_changes.append((None, [stroke]))
+                self.log.append(ADD, device_id, {}, {stroke: device})
+                self.notify("on_add_stroke", device, stroke)
 
-    # Undo the last line from an input
+    # Erase points from a line and record the strokes it was split into.
+    # With a start position, everything along the eraser's path from start
+    # to pos is erased, so fast motion leaves no gaps. The first erase of a
+    # press has no start and begins a new operation, the rest of the drag
+    # is merged into it. A start equal to pos counts as none, which is how
+    # the journal and peers receive a first erase.
+    def erase(self, device_id, pos, start=None):
+        started = time.perf_counter()
+        if start == pos:
+            start = None
+        with self.lock:
+            device = self.find_device(device_id)
+            if device:
+                devices = list(self.inputs.values()) + list(self.detached.values()) if device.is_admin() else [device]
+                removed = {}
+                added = {}
+                pieces = {}
+                for dev in devices:
+                    for stroke, split in dev.remove_point(pos, start):
+                        removed[stroke] = dev
+                        added.update(dict.fromkeys(split, dev))
+                        pieces[stroke] = split
+                        self.stroke_changes.append((stroke, split))
+                if removed:
+                    if start is None or not self.log.merge_erase(device_id, removed, added, pieces):
+                        self.log.append(ERASE, device_id, removed, added, pieces)
+                    self.notify("on_erase", device, pos, start)
+        self.erase_timer.add(time.perf_counter() - started)
+
+    # Undo the device's last operation, taking away what is left of the
+    # strokes it added and putting back the ones it removed
     def undo(self, device_id):
         with self.lock:
-            if device_id in self.inputs:
-                if self.inputs[device_id].undo():
-                    return self.inputs[device_id].get_undo_stack()
-            return None
+            device = self.find_device(device_id)
+            operation = self.log.undo_target(device_id)
+            if device is None or operation is None:
+                logger.info(f"{device_id} has nothing to undo")
+                return False
+            removed = {}
+            for stroke, owner in operation.added.items():
+                removed.update(dict.fromkeys(self.log.remains(owner, stroke), owner))
+            added = {stroke: owner for stroke, owner in operation.removed.items() if stroke not in owner.strokes}
+            self.apply(removed, added)
+            operation.reverted = (removed, added)
+            self.log.undo(operation)
+            logger.info(f"{device.user_id} performed undo")
+            self.notify("on_undo", device, removed, added)
+            return True
 
-    # Redo a line that was removed from an input
+    # Redo the operation the device last undid, reversing what undoing it
+    # changed
     def redo(self, device_id):
         with self.lock:
-            if device_id in self.inputs:
-                if self.inputs[device_id].redo():
-                    return self.inputs[device_id].get_undo_stack()
-            return None
+            device = self.find_device(device_id)
+            operation = self.log.redo_target(device_id)
+            if device is None or operation is None:
+                logger.info(f"{device_id} has nothing to redo")
+                return False
+            reverted_removed, reverted_added = operation.reverted
+            removed = {stroke: owner for stroke, owner in reverted_added.items() if stroke in owner.strokes}
+            added = {stroke: owner for stroke, owner in reverted_removed.items() if stroke not in owner.strokes}
+            self.apply(removed, added)
+            self.log.redo(operation)
+            logger.info(f"{device.user_id} performed redo")
+            self.notify("on_redo", device, removed, added)
+            return True
 
-    # A method to clear an input
+    # Apply an undo or redo as it was recorded, from the (device id,
+    # stroke) pairs it removed and added. The strokes removed are copies of
+    # the ones on the board, found by their style and points. The device's
+    # undo and redo stacks move as they did when it was recorded.
+    def apply_recorded(self, device_id, removed, added, redo=False):
+        with self.lock:
+            device = self.find_device(device_id)
+            if device is None:
+                logger.warning(f"Recorded {'redo' if redo else 'undo'} for unknown device {device_id}")
+                return False
+            found = {}
+            lookups = {}
+            for owner_id, stroke in removed:
+                owner = self.find_device(owner_id)
+                if owner is None:
+                    continue
+                lookup = lookups.get(owner_id)
+                if lookup is None:
+                    lookup = lookups[owner_id] = {
+                        (on_board.style, on_board.points.tobytes()): on_board for on_board in owner.strokes
+                    }
+                match = lookup.pop((stroke.style, stroke.points.tobytes()), None)
+                if match is not None:
+                    found[match] = owner
+            restored = {}
+            for owner_id, stroke in added:
+                owner = self.find_device(owner_id)
+                if owner is not None:
+                    restored[stroke] = owner
+            self.apply(found, restored)
+            if redo:
+                operation = self.log.redo_target(device_id)
+                if operation is not None:
+                    self.log.redo(operation)
+            else:
+                operation = self.log.undo_target(device_id)
+                if operation is not None:
+                    operation.reverted = (found, restored)
+                    self.log.undo(operation)
+            self.notify("on_redo" if redo else "on_undo", device, found, restored)
+            return True
+
+    # Clear the device's strokes, or every device's for the admin
     def clear(self, device_id):
         with self.lock:
-            if device_id in self.inputs:
-                if(self.is_admin(device_id)):
-                    for dev in self.inputs:
-                        self.inputs[dev].clear()
-                self.inputs[device_id].clear()
+            device = self.find_device(device_id)
+            if device:
+                devices = list(self.inputs.values()) + list(self.detached.values()) if device.is_admin() else [device]
+                removed = {}
+                for dev in devices:
+                    removed.update(dict.fromkeys(dev.clear(), dev))
+                if device.is_admin():
+                    self.needs_rebuild = True
+                else:
+                    self.stroke_changes.extend((stroke, []) for stroke in removed)
+                self.log.append(CLEAR, device_id, removed, {})
+                self.notify("on_clear", device)
 
     # Set the input's color
     def set_color(self, device_id, color):
@@ -151,7 +356,19 @@ class InputManager:
     def add_to_current_line(self, device_id, point):
         with self.lock:
             if device_id in self.inputs:
-                self.inputs[device_id].add_to_current_line(point)
+                device = self.inputs[device_id]
+                device.add_to_current_line(point)
+                if self.listeners:
+                    self.notify("on_point", device, point)
+
+    # Return (device id, current line, color, size) for every input, taken
+    # under one lock so the renderer needs none while drawing
+    def get_current_lines(self):
+        with self.lock:
+            return [
+                (device_id, device.current_line, device.color, device.size)
+                for device_id, device in self.inputs.items()
+            ]
 
     # Resets the current line
     def clear_current_line(self, device_id):
@@ -163,3 +380,22 @@ class InputManager:
     def get_active_inputs(self):
         with self.lock:
             return list(self.inputs.keys())
+
+    # Return the number of points dropped by simplification across inputs
+    def get_points_saved(self):
+        with self.lock:
+            return sum(device.get_points_saved() for device in list(self.inputs.values()) + list(self.detached.values()))
+
+    # Return whether there are changes the canvas has not drawn yet
+    def has_canvas_updates(self):
+        with self.lock:
+            return self.needs_rebuild or bool(self.stroke_changes)
+
+    # Return whether the committed strokes must be redrawn from scratch and
+    # the stroke changes made since the last call
+    def take_canvas_updates(self):
+        with self.lock:
+            updates = (self.needs_rebuild, self.stroke_changes)
+            self.needs_rebuild = False
+            self.stroke_changes = []
+            return updates
@@ -0,0 +1,44 @@
+import time
+from collections import deque
+from logging_manager import logger
+
+
+class LatencyMeter:
+    # Keeps the latest input to display latencies, measured from when a
+    # reader read an event to when the frame applying it was shown, and
+    # logs their percentiles every report_interval seconds
+    def __init__(self, size=2048, report_interval=10):
+        self.samples = deque(maxlen=size)
+        self.report_interval = report_interval
+        self.last_report_time = time.perf_counter()
+
+    # Record that input read at input_time was shown at shown_time
+    def add(self, input_time, shown_time):
+        self.samples.append(shown_time - input_time)
+
+    # Return the p50, p95, p99 and maximum latency in milliseconds, or None
+    # before anything was measured
+    def percentiles(self):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return {
+            name: samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000
+            for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))
+        }
+
+    # Log the percentiles once the report interval has passed
+    def update(self, now):
+        if now - self.last_report_time < self.report_interval:
+            return
+        self.last_report_time = now
+        self.report()
+
+    # Log the percentiles measured so far
+    def report(self):
+        measured = self.percentiles()
+        if measured:
+            logger.info(
+                f"Input to display latency ms p50 {measured['p50']:.1f} p95 {measured['p95']:.1f} "
+                f"p99 {measured['p99']:.1f} max {measured['max']:.1f} over {len(self.samples)} frames"
+            )
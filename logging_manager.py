@@ -1,9 +1,37 @@
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# Hand records to the listener unformatted, so formatting happens on the
+# listener thread instead of the thread that logged
+class LazyQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+# Let at most max_per_second debug records through per call site, so hot
+# paths can log freely without flooding the queue
+class RateLimitFilter(logging.Filter):
+    def __init__(self, max_per_second=5):
+        super().__init__()
+        self.max_per_second = max_per_second
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.pathname, record.lineno)
+        second = int(record.created)
+        window, count = self.windows.get(key, (second, 0))
+        if window != second:
+            window, count = second, 0
+        self.windows[key] = (window, count + 1)
+        return count < self.max_per_second
 
 # Create a logger
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG) 
-logger.propagate = False 
+logger.setLevel(logging.DEBUG)
+logger.propagate = False
 
 # Create handlers for each log level
 debug_handler = logging.FileHandler('logs/debug.log')
@@ -27,9 +55,31 @@ error_handler.setFormatter(log_format)
 info_handler.setFormatter(log_format)
 warning_handler.setFormatter(log_format)
 
+# Records are queued by the logging thread and written to the files by a
+# background listener, so logging never waits on disk
+log_queue = queue.SimpleQueue()
+queue_handler = LazyQueueHandler(log_queue)
+queue_handler.addFilter(RateLimitFilter())
+listener = QueueListener(
+    log_queue, debug_handler, error_handler, info_handler, warning_handler,
+    respect_handler_level=True
+)
+
 # Add handlers to the logger
 if not logger.hasHandlers():
-    logger.addHandler(debug_handler)
-    logger.addHandler(error_handler)
-    logger.addHandler(info_handler)
-    logger.addHandler(warning_handler)
+    logger.addHandler(queue_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+# A forked process does not inherit the listener thread, give it its own
+# queue and listener. Forked processes skip atexit, so the caller stops
+# the returned listener to write the last records.
+def start_forked_listener():
+    global listener
+    queue_handler.queue = queue.SimpleQueue()
+    listener = QueueListener(
+        queue_handler.queue, debug_handler, error_handler, info_handler, warning_handler,
+        respect_handler_level=True
+    )
+    listener.start()
+    return listener
@@ -1,155 +1,379 @@
-import threading
+import argparse
+import socket
+import time
 import pygame
-from evdev import InputDevice, ecodes, list_devices
-from logging_manager import logger
 from input_manager import InputManager
 from canvas import Canvas
 from header_manager import HeaderManager
+from event_processor import EventProcessor
+from async_reader import AsyncReader
+from threaded_reader import ThreadedReader
+from device_watcher import DeviceWatcher
+from session_recorder import SessionRecorder, SessionReplayer
+from canvas_store import CanvasStore
+from collab_server import CollabServer, CollabClient
+from motion_predictor import MotionPredictor
+from latency_meter import LatencyMeter
+from metrics import Metrics
+from render_link import RenderLink, StrokeSender
+from logging_manager import start_forked_listener
+from shared_canvas import SharedCanvas
+from thumbnail_exporter import ThumbnailExporter
+from config import load_config, ConfigError
 
 pygame.init()
 
+# Everything below is built from the config, so --config is parsed on its
+# own before the display opens and again with the other options in main
+config_parser = argparse.ArgumentParser(add_help=False)
+config_parser.add_argument("--config", metavar="FILE",
+                           help="TOML or JSON file with the devices, palette, header layout and performance settings")
+try:
+    CONFIG = load_config(config_parser.parse_known_args()[0].config)
+except ConfigError as error:
+    config_parser.error(str(error))
+PERFORMANCE = CONFIG.performance
+
 screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN | pygame.HWSURFACE | pygame.DOUBLEBUF)
 WIDTH, HEIGHT = screen.get_size()
 pygame.display.set_caption("Canvas")
 pygame.mouse.set_visible(False)
 
-HEADER_HEIGHT = 100
-COLORS = ((255, 0, 0), (0, 255, 0), (0, 0, 255),(255, 255, 0), (255, 0, 255), (0, 255, 255))
+HEADER_HEIGHT = CONFIG.header.height
+# Only redraw and update the regions of the screen that changed each frame
+DAMAGE_TRACKING = True
 
 # Create surfaces for the header and the canvas
-canvas_surface = pygame.Surface((WIDTH, HEIGHT - HEADER_HEIGHT))
+# The canvas is a view below the header of a screen sized layer, so strokes
+# in screen coordinates are drawn onto it without being offset. The layer's
+# pixels are in shared memory, where other processes can read them.
+shared_canvas = SharedCanvas((WIDTH, HEIGHT), (0, HEADER_HEIGHT, WIDTH, HEIGHT - HEADER_HEIGHT))
+canvas_layer = shared_canvas.surface
+canvas_surface = canvas_layer.subsurface((0, HEADER_HEIGHT, WIDTH, HEIGHT - HEADER_HEIGHT))
 canvas_surface.fill((255, 255, 255))
 header_surface = pygame.Surface((WIDTH, HEADER_HEIGHT))
-header_surface.fill((200, 200, 200))
+header_surface.fill(CONFIG.header.background)
 
 # Instantiate manager classes
-input_manager = InputManager(WIDTH, HEIGHT)
-canvas = Canvas(canvas_surface, input_manager, header_height=HEADER_HEIGHT)
-header_manager = HeaderManager(header_surface,COLORS)
-
-draw_lock = threading.Lock()
-stop_threads = threading.Event()
-
-# A method to find all devices
-def find_device_paths(device_names):
-    device_paths = {}
-    for path in list_devices():
-        device = InputDevice(path)
-        if device.name in device_names and device.name not in device_paths:
-            device_paths[device.name] = path
-    return list(device_paths.values())
-
-# A method to handle each device
-def handle_device(device_path, name, stop_event):
-    thread_name = threading.current_thread().name
-    if not input_manager.pair_device(device_path, name, thread_name):
-        logger.error(f"Failed to pair device {device_path}")
-        return
-
-    try:
-        inputs = InputDevice(device_path)
-        x, y = input_manager.get_position(device_path)
-        button_pressed = False
-
-        for event in inputs.read_loop():
-            if stop_event.is_set():
-                break
-
-            if event.type == ecodes.EV_KEY and event.code == ecodes.BTN_LEFT:
-                if not button_pressed:  
-                    if y < HEADER_HEIGHT:
-                        pygame.event.post(pygame.event.Event(
-                            pygame.USEREVENT, 
-                            {"pos": (x, y), "device_path": device_path}
-                        ))
-                button_pressed = (event.value == 1)
-                if not button_pressed:
-                    current_line = input_manager.get_current_line(device_path)
-                    if current_line:
-                        with draw_lock:
-                            input_manager.add_line(device_path)
-                            input_manager.clear_current_line(device_path)
-                continue
-
-            if event.type == ecodes.EV_REL:
-                if event.code == ecodes.REL_X:
-                    if button_pressed:
-                        x += max(-7, min(7, event.value))
-                    else:
-                        x += event.value
-                elif event.code == ecodes.REL_Y:
-                    if button_pressed:
-                        y += max(-7, min(7, event.value))
-                    else:
-                        y += event.value
-
-                x = max(0, min(WIDTH, x))
-                y = max(0, min(HEIGHT, y))
-
-                with draw_lock:
-                    input_manager.set_position(device_path, (x, y))
-
-                if button_pressed and y >= HEADER_HEIGHT:
-                    current_tool = input_manager.get_tool(device_path)
-                    if current_tool == 'Eraser':
-                        with draw_lock:
-                            input_manager.erase(device_path, (x, y))
-                    else:
-                        input_manager.add_to_current_line(device_path, (x, y))
-
-    finally:
-        input_manager.unpair_device(device_path)
+input_manager = InputManager(WIDTH, HEIGHT, CONFIG)
+canvas = Canvas(canvas_surface, input_manager, header_height=HEADER_HEIGHT, refresh_interval=PERFORMANCE.refresh_interval)
+try:
+    header_manager = HeaderManager(header_surface, CONFIG.palette, CONFIG.header)
+except ConfigError as error:
+    config_parser.error(str(error))
+event_processor = EventProcessor(
+    input_manager, header_manager, WIDTH, HEIGHT, header_height=HEADER_HEIGHT, queue_size=PERFORMANCE.queue_size,
+    min_distance=PERFORMANCE.min_distance, viewport=canvas.viewport, motion_clamp=PERFORMANCE.motion_clamp
+)
+
+# Keyboard controls for moving around the board
+PAN_STEP = 128
+PAN_KEYS = {
+    pygame.K_LEFT: (-PAN_STEP, 0),
+    pygame.K_RIGHT: (PAN_STEP, 0),
+    pygame.K_UP: (0, -PAN_STEP),
+    pygame.K_DOWN: (0, PAN_STEP),
+}
+ZOOM_KEYS = {
+    pygame.K_EQUALS: 1.25,
+    pygame.K_PLUS: 1.25,
+    pygame.K_KP_PLUS: 1.25,
+    pygame.K_MINUS: 0.8,
+    pygame.K_KP_MINUS: 0.8,
+}
+# Key showing and hiding the metrics overlay
+METRICS_KEY = pygame.K_F3
+
+# Return the screen rect covered by a device cursor
+def cursor_rect(position):
+    x, y = position
+    return pygame.Rect(x - 10, y - 10, 20, 20)
+
+# Restore the canvas, start sharing it and start reading devices, return
+# what stop_input takes to end the session
+def start_input(args):
+    # Restore the canvas before any device pairs, so returning devices get
+    # their strokes back
+    canvas_store = None
+    if not args.no_persist:
+        # The input process of --split-render hands its stroke changes to
+        # the render process, so its own tiles are never brought up to date
+        canvas_store = CanvasStore(args.state_dir, input_manager, canvas, save_tiles=not args.split_render)
+        canvas_store.load()
+
+    # Share the canvas once it is restored, peers are sent all of it
+    collab = None
+    if args.serve:
+        collab = CollabServer(input_manager, args.collab_name, port=args.serve)
+    elif args.connect:
+        host, _, port = args.connect.rpartition(":")
+        collab = CollabClient(input_manager, args.collab_name, host, int(port))
+    if collab:
+        collab.start()
+
+    recorder = SessionRecorder(args.record) if args.record else None
+    watcher = None
+
+    if args.replay:
+        # Feed the recorded events through the same queues as live input
+        reader = SessionReplayer(args.replay, input_manager, event_processor, speed=args.replay_speed)
+    elif args.input_backend == "asyncio":
+        # Read every device on a single event loop
+        reader = AsyncReader(input_manager, event_processor, recorder)
+    else:
+        # Start one thread per input device
+        reader = ThreadedReader(input_manager, event_processor, recorder)
+    reader.start([])
+
+    if not args.replay:
+        # Pair devices as they are plugged in and unpair them when they go away
+        watcher = DeviceWatcher(CONFIG.device_names, reader.add_device, reader.remove_device)
+        watcher.start()
+
+    return watcher, reader, collab, recorder, canvas_store
+
+# Stop reading devices and sharing the canvas, and save it
+def stop_input(watcher, reader, collab, recorder, canvas_store):
+    if watcher:
+        watcher.stop()
+    reader.stop()
+    # Unpair the devices the readers removed, committing their lines
+    event_processor.drain()
+    if collab:
+        collab.stop()
+    if recorder:
+        recorder.close()
+    if canvas_store:
+        canvas_store.close()
+
+# Apply the input queued since the last frame or tick
+def apply_input(collab):
+    event_processor.drain()
+    if collab:
+        collab.apply_remote()
+
+# Run the input side of --split-render in the forked input process, sending
+# the strokes to draw to the render process over connection
+def input_process(args, connection):
+    log_listener = start_forked_listener()
+    # The canvas here only renders tiles for snapshots, onto its own layer
+    # rather than the shared pixels the render process shows
+    layer = pygame.Surface((WIDTH, HEIGHT))
+    canvas.layer = layer
+    canvas.surface = layer.subsurface(canvas.area)
+    session = start_input(args)
+    _, _, collab, _, canvas_store = session
+
+    def step():
+        apply_input(collab)
+        if canvas_store:
+            canvas_store.update()
+
+    StrokeSender(input_manager, event_processor, header_manager, connection).run(step)
+    stop_input(*session)
+    connection.close()
+    log_listener.stop()
 
 def main():
-    device_names = ['ImExPS/2 Generic Explorer Mouse', 'Lenovo Bluetooth Mouse', 'Microsoft Arc Mouse']
-    device_paths = find_device_paths(device_names)
-    threads = []
+    global canvas_layer, canvas_surface
+    parser = argparse.ArgumentParser(description="Collaborative canvas", parents=[config_parser])
+    parser.add_argument("--input-backend", choices=("threaded", "asyncio"), default="threaded",
+                        help="read devices with one thread each, or all on one asyncio loop")
+    parser.add_argument("--record", metavar="FILE", help="record the raw input events of the session to FILE")
+    parser.add_argument("--replay", metavar="FILE", help="replay a recorded session instead of reading devices")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="replay speed multiplier, 0 replays as fast as possible")
+    parser.add_argument("--state-dir", default="state", help="directory for canvas snapshots and the stroke journal")
+    parser.add_argument("--no-persist", action="store_true", help="start with an empty canvas and keep nothing")
+    parser.add_argument("--serve", metavar="PORT", type=int, help="share the canvas with peers connecting on PORT")
+    parser.add_argument("--connect", metavar="HOST:PORT", help="share the canvas with the server at HOST:PORT")
+    parser.add_argument("--collab-name", default=socket.gethostname(), help="name this canvas is known by to its peers")
+    parser.add_argument("--low-latency", action="store_true",
+                        help="draw current lines every frame, and cursors and stroke tips where devices are heading")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="append frame, lock and input metrics to FILE, as CSV rows if it ends in .csv else JSON lines")
+    parser.add_argument("--metrics-interval", type=float, default=2.0, help="seconds between metrics samples")
+    parser.add_argument("--split-render", action="store_true",
+                        help="read input and keep the strokes in a separate process from rendering")
+    parser.add_argument("--thumbnail", metavar="FILE", help="keep a downscaled PNG or WebP image of the canvas in FILE")
+    parser.add_argument("--thumbnail-interval", type=float, default=5.0, help="seconds between thumbnails")
+    parser.add_argument("--thumbnail-width", type=int, default=320, help="width of the thumbnails in pixels")
+    args = parser.parse_args()
+    if args.serve and args.connect:
+        parser.error("--serve and --connect cannot be used together")
+    if args.connect:
+        host, _, port = args.connect.rpartition(":")
+        if not host or not port.isdigit():
+            parser.error("--connect expects HOST:PORT")
+    if args.thumbnail and not ThumbnailExporter.supports(args.thumbnail):
+        parser.error("WebP thumbnails need Pillow installed")
+
+    # Export thumbnails from a process forked before any other thread starts
+    exporter = None
+    if args.thumbnail:
+        exporter = ThumbnailExporter(shared_canvas, args.thumbnail, args.thumbnail_interval, args.thumbnail_width)
+        exporter.start()
 
-    # Start one thread per input device
-    for path, name in zip(device_paths, device_names):
-        thread = threading.Thread(target=handle_device, args=(path, name, stop_threads))
-        thread.start()
-        threads.append(thread)
+    # Input runs in this process, or in its own one that sends the strokes
+    # to draw over a pipe
+    link = None
+    collab = canvas_store = None
+    if args.split_render:
+        link = RenderLink(input_process, (args,), header_manager)
+        source = link.mirror
+        canvas.input_manager = source
+        events = source
+    else:
+        session = start_input(args)
+        _, _, collab, _, canvas_store = session
+        source = input_manager
+        events = event_processor
+
+    # In low latency mode current lines are drawn every frame, and the
+    # cursors and the ends of the strokes being drawn are drawn straight
+    # onto the screen ahead of the input
+    predictor = None
+    if args.low_latency:
+        canvas.refresh_interval = 0
+        predictor = MotionPredictor()
+    latency_meter = LatencyMeter()
+    metrics = Metrics(source, events, {"input": source.lock}, args.metrics, args.metrics_interval)
 
     clock = pygame.time.Clock()
     running = True
+    full_redraw = True
+    cursor_positions = {}
+    tip_rects = []
+    overlay_rect = None
 
     while running:
+        metrics.begin_frame()
         for event in pygame.event.get():
             if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
                 running = False
-                stop_threads.set()
-            elif event.type == pygame.USEREVENT:
-                logger.info(f"Header click event received at {event.pos} from {event.device_path}")
-                header_manager.handle_click(event.pos, event.device_path, input_manager)
+            elif event.type == pygame.KEYDOWN and event.key in PAN_KEYS:
+                canvas.viewport.pan(*PAN_KEYS[event.key])
+            elif event.type == pygame.KEYDOWN and event.key in ZOOM_KEYS:
+                canvas.viewport.zoom_by(ZOOM_KEYS[event.key])
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_0:
+                canvas.viewport.reset()
+            elif event.type == pygame.KEYDOWN and event.key == METRICS_KEY:
+                metrics.toggle_overlay()
+        metrics.mark("events")
 
-        # Lock and refresh the canvas once per frame
-        with draw_lock:
-            canvas.refresh()
+        # Apply the input queued since the last frame, or what the input
+        # process sent
+        if link:
+            if not link.receive():
+                running = False
+            if canvas.viewport.changed:
+                link.send_viewport(canvas.viewport)
+        else:
+            apply_input(collab)
+        metrics.mark("input")
 
-            screen.blit(canvas_surface, (0, HEADER_HEIGHT))
+        # Refresh the canvas once per frame, a new frame for readers of the
+        # shared pixels when it changed
+        shared_canvas.begin_write()
+        canvas_rects = canvas.refresh()
+        shared_canvas.end_write(canvas_rects != [])
+        metrics.mark("canvas")
+        if canvas_store:
+            canvas_store.update()
+            metrics.mark("store")
+        if canvas_rects is None or not DAMAGE_TRACKING:
+            full_redraw = True
 
-            # Draw the header
-            header_surface.fill((200, 200, 200))
+        # Draw the header
+        header_rects = []
+        if header_manager.needs_redraw or not DAMAGE_TRACKING:
             header_manager.draw()
+            header_rects.append(header_surface.get_rect())
 
-            # Updates the button if an input is hovering over the button
-            device_positions = [input_manager.get_position(device) for device in device_paths]
-            header_manager.draw_buttons(device_positions)
+        # Updates the button if an input is hovering over the button
+        positions = {device: source.get_position(device) for device in source.get_active_inputs()}
+        header_rects.extend(header_manager.draw_buttons(list(positions.values())))
+        metrics.mark("header")
 
+        # Where the cursors are drawn, ahead of the input in low latency mode
+        drawn_positions = positions
+        if predictor:
+            now = time.perf_counter()
+            for device, position in positions.items():
+                predictor.update(device, position, now)
+            predictor.retain(positions)
+            drawn_positions = {device: predictor.predict(device) for device in positions}
+
+        if full_redraw:
+            screen.blit(canvas_surface, (0, HEADER_HEIGHT))
             screen.blit(header_surface, (0, 0))
+        else:
+            dirty_rects = [rect.move(0, HEADER_HEIGHT) for rect in canvas_rects] + header_rects + tip_rects
+            if overlay_rect:
+                dirty_rects.append(overlay_rect)
+            for device, position in cursor_positions.items():
+                if device not in drawn_positions:
+                    dirty_rects.append(cursor_rect(position))
+            for device, position in drawn_positions.items():
+                if cursor_positions.get(device) != position:
+                    if device in cursor_positions:
+                        dirty_rects.append(cursor_rect(cursor_positions[device]))
+                    dirty_rects.append(cursor_rect(position))
+
+            # Restore the canvas and header underneath each changed region
+            for rect in dirty_rects:
+                screen.set_clip(rect)
+                screen.blit(canvas_surface, (0, HEADER_HEIGHT))
+                screen.blit(header_surface, (0, 0))
+            screen.set_clip(None)
+
+        # Draw the stroke tips, which the next frame restores the canvas
+        # under
+        if predictor:
+            tip_rects = canvas.draw_tips(screen, [(device, positions[device], drawn_positions[device]) for device in positions])
+            if not full_redraw:
+                dirty_rects.extend(tip_rects)
+
+        # Drawing cursor for each device
+        for x, y in drawn_positions.values():
+            pygame.draw.rect(screen, (0, 0, 0), (x - 10, y - 10, 20, 20), 2)
+            pygame.draw.rect(screen, (255, 255, 255), (x - 9, y - 9, 18, 18))
+        cursor_positions = drawn_positions
+
+        # Draw the metrics overlay over everything, the next frame restores
+        # the canvas under it
+        overlay_rect = metrics.draw_overlay(screen, (10, HEADER_HEIGHT + 10))
+        if overlay_rect and not full_redraw:
+            dirty_rects.append(overlay_rect)
+        metrics.mark("compose")
 
-            # Drawing cursor for each device
-            for device_path in device_paths:
-                x, y = input_manager.get_position(device_path)
-                pygame.draw.rect(screen, (0, 0, 0), (x - 10, y - 10, 20, 20), 2)
-                pygame.draw.rect(screen, (255, 255, 255), (x - 9, y - 9, 18, 18))
+        if full_redraw:
+            pygame.display.flip()
+            full_redraw = False
+        elif dirty_rects:
+            pygame.display.update(dirty_rects)
+        metrics.mark("display")
 
-        pygame.display.flip()
-        clock.tick(60)
+        # Time from reading the oldest input applied this frame to showing it
+        input_time = events.take_input_time()
+        shown_time = time.perf_counter()
+        if input_time is not None:
+            latency_meter.add(input_time, shown_time)
+        latency_meter.update(shown_time)
+        metrics.end_frame()
+        clock.tick(PERFORMANCE.fps)
 
-    for thread in threads:
-        thread.join()
+    if link:
+        link.stop()
+    else:
+        stop_input(*session)
+    latency_meter.report()
+    metrics.close()
+    if exporter:
+        exporter.stop()
+    # The shared pixels are unmapped once no surface is drawn onto them
+    canvas_layer = canvas_surface = canvas.layer = canvas.surface = None
+    shared_canvas.close()
 
     pygame.quit()
 
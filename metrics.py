@@ -0,0 +1,280 @@
+import bisect
+import csv
+import json
+import threading
+import time
+from collections import deque
+import pygame
+from logging_manager import logger
+
+# Upper bounds in milliseconds of the frame time histogram buckets, frames
+# slower than the last bound are counted in an overflow bucket
+FRAME_BUCKETS = (2, 4, 8, 16, 33, 50, 100)
+
+
+class Timer:
+    # Accumulates the count, total and maximum of durations in seconds
+    # until they are taken. Adding is cheap enough for every lock
+    # acquisition, and a duration racing with take is at worst lost.
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    # Record one duration
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Add the (count, total, max) taken from another timer
+    def merge(self, taken):
+        count, total, longest = taken
+        self.count += count
+        self.total += total
+        if longest > self.max:
+            self.max = longest
+
+    # Return (count, total, max) since the last call and start again
+    def take(self):
+        taken = (self.count, self.total, self.max)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        return taken
+
+
+class TimedLock:
+    # A drop in threading.Lock that records how long acquiring it waited
+    # and how long it was held
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wait = Timer()
+        self.hold = Timer()
+        self.acquired_at = 0.0
+
+    # The wait is recorded once the lock is held, so only one thread
+    # updates the timers at a time
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.acquired_at = time.perf_counter()
+            self.wait.add(self.acquired_at - start)
+        return acquired
+
+    def release(self):
+        self.hold.add(time.perf_counter() - self.acquired_at)
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# Return the (p50, p95, p99, max) of a sorted list
+def percentiles(values):
+    return tuple(
+        values[min(len(values) - 1, int(fraction * len(values)))]
+        for fraction in (0.5, 0.95, 0.99, 1.0)
+    )
+
+
+# Return the durations of a Timer's take as a dict of milliseconds
+def timer_summary(taken):
+    count, total, longest = taken
+    return {
+        "count": count,
+        "total_ms": round(total * 1000, 3),
+        "mean_ms": round(total * 1000 / count, 3) if count else 0.0,
+        "max_ms": round(longest * 1000, 3),
+    }
+
+
+# Yield (name, value) pairs of a nested dict, with names joined by dots
+def flatten(sample, prefix=""):
+    for key, value in sample.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from flatten(value, name + ".")
+        else:
+            yield name, value
+
+
+class Metrics:
+    # Frame, lock and input instrumentation for the main loop. Each frame is
+    # split into phases by calling mark after each one, and the frame times
+    # are kept in a rolling window for the histogram. Every interval seconds
+    # the counters are taken into a sample, shown by the overlay and, given
+    # a path, handed to a background thread that appends it to the file as
+    # JSON lines, or as time, metric, value rows for a .csv path.
+    def __init__(self, input_manager, event_processor, locks, path=None, interval=2.0, window=600):
+        self.input_manager = input_manager
+        self.event_processor = event_processor
+        # Named TimedLocks to report the wait and hold times of
+        self.locks = locks
+        self.interval = interval
+        self.frame_times = deque(maxlen=window)
+        self.phases = {}
+        self.frames = 0
+        self.frame_start = 0.0
+        self.phase_start = 0.0
+        self.last_sample_time = time.perf_counter()
+        self.sample = None
+        self.overlay_visible = False
+        self.overlay_surface = None
+        self.font = None
+
+        self.path = path
+        self.pending = deque()
+        self.stop_event = threading.Event()
+        self.thread = None
+        if path:
+            self.thread = threading.Thread(target=self.run, name="MetricsWriter", daemon=True)
+            self.thread.start()
+
+    # Start timing a frame
+    def begin_frame(self):
+        self.frame_start = self.phase_start = time.perf_counter()
+
+    # Record the time since the last mark, or the frame start, as a phase
+    def mark(self, phase):
+        now = time.perf_counter()
+        timer = self.phases.get(phase)
+        if timer is None:
+            timer = self.phases[phase] = Timer()
+        timer.add(now - self.phase_start)
+        self.phase_start = now
+
+    # Finish timing a frame, and take a sample once the interval has passed
+    def end_frame(self):
+        now = time.perf_counter()
+        self.frame_times.append((now - self.frame_start) * 1000)
+        self.frames += 1
+        if now - self.last_sample_time >= self.interval:
+            self.take_sample(now)
+
+    # Take the counters since the last sample into a new one
+    def take_sample(self, now):
+        elapsed = now - self.last_sample_time
+        self.last_sample_time = now
+
+        frame_times = sorted(self.frame_times)
+        histogram = [0] * (len(FRAME_BUCKETS) + 1)
+        for frame_time in frame_times:
+            histogram[bisect.bisect_left(FRAME_BUCKETS, frame_time)] += 1
+        labels = [f"<{bound}" for bound in FRAME_BUCKETS] + [f">={FRAME_BUCKETS[-1]}"]
+
+        # The strokes only change on the render thread, so they are counted
+        # without holding the lock
+        devices = self.input_manager.get_stroke_devices()
+        strokes = sum(len(device.strokes) for device in devices)
+        points = sum(len(stroke) for device in devices for stroke in device.get_strokes())
+        event_counts = self.event_processor.take_event_counts()
+
+        sample = {
+            "time": round(time.time(), 3),
+            "fps": round(self.frames / elapsed, 1) if elapsed > 0 else 0.0,
+            "frame_ms": dict(zip(("p50", "p95", "p99", "max"), (round(value, 3) for value in percentiles(frame_times))))
+            if frame_times else {},
+            "histogram": dict(zip(labels, histogram)),
+            "phases": {phase: timer_summary(timer.take()) for phase, timer in self.phases.items()},
+            "locks": {
+                name: {"wait": timer_summary(lock.wait.take()), "hold": timer_summary(lock.hold.take())}
+                for name, lock in self.locks.items()
+            },
+            "erase": timer_summary(self.input_manager.erase_timer.take()),
+            "events_per_sec": {device_id: round(count / elapsed, 1) for device_id, count in event_counts.items()},
+            "devices": len(devices),
+            "strokes": strokes,
+            "points": points,
+        }
+        self.frames = 0
+        self.sample = sample
+        self.overlay_surface = None
+        if self.thread:
+            self.pending.append(sample)
+
+    # Show or hide the overlay
+    def toggle_overlay(self):
+        self.overlay_visible = not self.overlay_visible
+        logger.info(f"Metrics overlay {'shown' if self.overlay_visible else 'hidden'}")
+
+    # Return the text lines of the overlay for the latest sample
+    def overlay_lines(self):
+        sample = self.sample
+        if sample is None:
+            return ["Collecting metrics..."]
+        frame_ms = sample["frame_ms"]
+        lines = [f"{sample['fps']:.0f} fps  frame ms p50 {frame_ms.get('p50', 0):.1f} p99 {frame_ms.get('p99', 0):.1f} max {frame_ms.get('max', 0):.1f}"]
+        lines.append("  ".join(f"{label} {count}" for label, count in sample["histogram"].items()))
+        for phase, summary in sample["phases"].items():
+            lines.append(f"{phase}: mean {summary['mean_ms']:.2f} max {summary['max_ms']:.2f} ms")
+        for name, lock in sample["locks"].items():
+            lines.append(
+                f"{name} lock: wait max {lock['wait']['max_ms']:.2f} hold max {lock['hold']['max_ms']:.2f} ms"
+                f" over {lock['wait']['count']}"
+            )
+        erase = sample["erase"]
+        lines.append(f"erase: {erase['count']} mean {erase['mean_ms']:.2f} max {erase['max_ms']:.2f} ms")
+        for device_id, rate in sample["events_per_sec"].items():
+            lines.append(f"{device_id}: {rate:.0f} events/s")
+        lines.append(f"{sample['devices']} devices  {sample['strokes']} strokes  {sample['points']} points")
+        return lines
+
+    # Draw the overlay at a position on the screen and return its rect, or
+    # None when hidden. The text is rendered again only for a new sample.
+    def draw_overlay(self, screen, position):
+        if not self.overlay_visible:
+            return None
+        if self.overlay_surface is None:
+            if self.font is None:
+                self.font = pygame.font.Font(None, 20)
+            rendered = [self.font.render(line, True, (255, 255, 255)) for line in self.overlay_lines()]
+            line_height = self.font.get_linesize()
+            self.overlay_surface = pygame.Surface(
+                (max(text.get_width() for text in rendered) + 12, line_height * len(rendered) + 12)
+            )
+            self.overlay_surface.fill((40, 40, 40))
+            for i, text in enumerate(rendered):
+                self.overlay_surface.blit(text, (6, 6 + i * line_height))
+        return screen.blit(self.overlay_surface, position)
+
+    # Append the queued samples to the metrics file
+    def flush(self):
+        if not self.pending:
+            return
+        try:
+            with open(self.path, "a", newline="") as metrics_file:
+                if self.path.endswith(".csv"):
+                    writer = csv.writer(metrics_file)
+                    if metrics_file.tell() == 0:
+                        writer.writerow(("time", "metric", "value"))
+                for _ in range(len(self.pending)):
+                    sample = self.pending.popleft()
+                    if self.path.endswith(".csv"):
+                        writer.writerows((sample["time"], name, value) for name, value in flatten(sample) if name != "time")
+                    else:
+                        metrics_file.write(json.dumps(sample) + "\n")
+        except OSError as error:
+            logger.error(f"Writing metrics to {self.path} failed: {error}")
+            self.pending.clear()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.flush()
+
+    # Write the samples left and stop the writer
+    def close(self):
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.flush()
+            logger.info(f"Metrics written to {self.path}")
@@ -0,0 +1,51 @@
+from collections import deque
+
+
+class MotionPredictor:
+    # Extrapolates where each device is heading from its recent positions,
+    # so the cursor and stroke tip can be drawn where the device will be
+    # once the frame reaches the screen rather than where it was read.
+    # Velocity is measured over the last window seconds and the prediction
+    # is lead seconds ahead, at most max_distance pixels from the position.
+    def __init__(self, lead=0.016, window=0.05, max_distance=40):
+        self.lead = lead
+        self.window = window
+        self.max_distance = max_distance
+        self.samples = {}
+
+    # Record a device's position at a perf_counter time, called once per
+    # frame so a device that stops slows to a halt
+    def update(self, device_id, position, now):
+        samples = self.samples.get(device_id)
+        if samples is None:
+            samples = self.samples[device_id] = deque()
+        samples.append((now, position))
+        while len(samples) > 2 and now - samples[0][0] > self.window:
+            samples.popleft()
+
+    # Return the predicted position of a device, or its last position when
+    # there is not enough motion to go on
+    def predict(self, device_id):
+        samples = self.samples.get(device_id)
+        if not samples:
+            return None
+        first_time, (first_x, first_y) = samples[0]
+        last_time, (x, y) = samples[-1]
+        elapsed = last_time - first_time
+        if elapsed <= 0:
+            return (x, y)
+        scale = self.lead / elapsed
+        dx = (x - first_x) * scale
+        dy = (y - first_y) * scale
+        distance_squared = dx * dx + dy * dy
+        if distance_squared > self.max_distance ** 2:
+            shrink = self.max_distance / distance_squared ** 0.5
+            dx *= shrink
+            dy *= shrink
+        return (round(x + dx), round(y + dy))
+
+    # Forget the devices not in device_ids
+    def retain(self, device_ids):
+        for device_id in list(self.samples):
+            if device_id not in device_ids:
+                del self.samples[device_id]
@@ -0,0 +1,167 @@
+from logging_manager import logger
+
+# Kinds of operation
+ADD, ERASE, CLEAR = range(3)
+
+
+class Operation:
+    __slots__ = ('kind', 'device_id', 'index', 'previous', 'removed', 'added', 'pieces', 'reverted')
+
+    # Removed and added map strokes to the device holding them, as an
+    # admin's operation can change the strokes of other devices. An erase
+    # also maps each stroke it split to the pieces left.
+    def __init__(self, kind, device_id, index, previous, removed, added, pieces=None):
+        self.kind = kind
+        self.device_id = device_id
+        self.index = index
+        # Log index of the device's operation before this one, or None
+        self.previous = previous
+        self.removed = removed
+        self.added = added
+        self.pieces = pieces
+        # The (removed, added) strokes undoing the operation actually
+        # changed, which redoing it reverses
+        self.reverted = None
+
+
+class OperationLog:
+    # An append-only log of every device's operations. Each device has a
+    # cursor at the last operation it applied and a stack of the operations
+    # it undid, so undo and redo only move between entries. Past limit
+    # operations the oldest half is checkpointed: dropped from the log, their
+    # effect on the strokes stays but can no longer be undone.
+    def __init__(self, limit=50000):
+        self.limit = limit
+        self.operations = []
+        # Log index of operations[0]
+        self.base = 0
+        self.cursors = {}
+        self.undone = {}
+        # Pieces each erased stroke was split into, so undoing the operation
+        # that added a stroke also takes away what is left of it
+        self.pieces = {}
+
+    # Return the operation at a log index, or None once it is checkpointed
+    def get(self, index):
+        if index is None or index < self.base:
+            return None
+        return self.operations[index - self.base]
+
+    # Record an operation that was just applied, which discards the
+    # device's redo stack
+    def append(self, kind, device_id, removed, added, pieces=None):
+        index = self.base + len(self.operations)
+        operation = Operation(kind, device_id, index, self.cursors.get(device_id), removed, added, pieces)
+        self.operations.append(operation)
+        self.cursors[device_id] = index
+        self.undone.pop(device_id, None)
+        if pieces:
+            self.pieces.update(pieces)
+        if len(self.operations) > self.limit:
+            self.checkpoint(len(self.operations) // 2)
+        return operation
+
+    # Start a restored device's history as if it had drawn its latest
+    # strokes, up to history of them, and undone the strokes to redo
+    def restore(self, device, strokes, redo_strokes, history=500):
+        device_id = device.device_id
+        self.forget(device_id)
+        for stroke in strokes[-history:] if history else ():
+            self.append(ADD, device_id, {}, {stroke: device})
+        previous = self.cursors.get(device_id)
+        undone = []
+        for stroke in reversed(redo_strokes):
+            index = self.base + len(self.operations)
+            operation = Operation(ADD, device_id, index, previous, {}, {stroke: device})
+            operation.reverted = ({stroke: device}, {})
+            self.operations.append(operation)
+            undone.append(operation)
+            previous = index
+        if undone:
+            undone.reverse()
+            self.undone[device_id] = undone
+
+    # Return the operation a device would undo
+    def undo_target(self, device_id):
+        return self.get(self.cursors.get(device_id))
+
+    # Fold an erase into the device's last operation when that was an erase
+    # too and nothing was undone since, so dragging the eraser is undone in
+    # one step. Only called for erases after the first of a drag. Returns
+    # False when it cannot be merged. Depends only on the device's own
+    # operations, so replaying them merges the same way.
+    def merge_erase(self, device_id, removed, added, pieces):
+        operation = self.undo_target(device_id)
+        if operation is None or operation.kind != ERASE or self.undone.get(device_id):
+            return False
+        for stroke, device in removed.items():
+            if stroke in operation.added:
+                # A piece this operation left is split again
+                del operation.added[stroke]
+            else:
+                operation.removed[stroke] = device
+        operation.added.update(added)
+        operation.pieces.update(pieces)
+        self.pieces.update(pieces)
+        return True
+
+    # Move a device's cursor back over an operation it undid
+    def undo(self, operation):
+        self.cursors[operation.device_id] = operation.previous
+        self.undone.setdefault(operation.device_id, []).append(operation)
+
+    # Return the operation a device would redo
+    def redo_target(self, device_id):
+        undone = self.undone.get(device_id)
+        return undone[-1] if undone else None
+
+    # Move a device's cursor forward over an operation it redid
+    def redo(self, operation):
+        self.undone[operation.device_id].pop()
+        self.cursors[operation.device_id] = operation.index
+
+    # Return the strokes the device's undone additions would bring back, in
+    # the order a redo stack holds them
+    def get_redo_strokes(self, device_id):
+        return [
+            stroke
+            for operation in self.undone.get(device_id, [])
+            if operation.kind == ADD
+            for stroke in operation.added
+        ]
+
+    # Return what is left on the board of a stroke, following the pieces
+    # erasing split it into
+    def remains(self, device, stroke):
+        remains = []
+        strokes = [stroke]
+        while strokes:
+            stroke = strokes.pop()
+            if stroke in device.strokes:
+                remains.append(stroke)
+            else:
+                strokes.extend(reversed(self.pieces.get(stroke, ())))
+        return remains
+
+    # Forget every operation of a device, such as one being restored
+    def forget(self, device_id):
+        self.cursors.pop(device_id, None)
+        self.undone.pop(device_id, None)
+
+    # Drop the oldest operations, the undone ones among them can no longer
+    # be redone either
+    def checkpoint(self, count):
+        self.operations = self.operations[count:]
+        self.base += count
+        for device_id, undone in list(self.undone.items()):
+            undone = [operation for operation in undone if operation.index >= self.base]
+            if undone:
+                self.undone[device_id] = undone
+            else:
+                del self.undone[device_id]
+        self.pieces = {
+            stroke: pieces
+            for operation in self.operations if operation.pieces
+            for stroke, pieces in operation.pieces.items()
+        }
+        logger.info(f"Checkpointed {count} operations, {len(self.operations)} kept")
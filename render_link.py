@@ -0,0 +1,322 @@
+import multiprocessing
+import queue
+import threading
+import time
+from logging_manager import logger
+from metrics import Timer, TimedLock
+from stroke import Stroke, new_points
+
+# Messages between the input and render processes, tuples starting with one
+# of these. A FRAME carries everything that changed in the input process
+# since the last one, VIEWPORT the board position and zoom the render
+# process shows, and QUIT asks the input process to finish.
+FRAME, VIEWPORT, QUIT = range(3)
+# Seconds between the input process's statistics sent to the render process
+STATS_INTERVAL = 0.5
+
+
+# Return a stroke as (id, point bytes, style), the form strokes cross the
+# pipe in
+def encode_stroke(stroke_id, stroke):
+    return (stroke_id, stroke.points.tobytes(), stroke.style)
+
+# Return the id and stroke of an encoded stroke
+def decode_stroke(encoded):
+    stroke_id, data, style = encoded
+    points = new_points()
+    points.frombytes(data)
+    stroke = Stroke.__new__(Stroke)
+    stroke.points = points
+    stroke.style = style
+    return stroke_id, stroke
+
+
+class StrokeSender:
+    # Runs the input process's loop: applies input, then sends the render
+    # process a FRAME with the stroke changes the canvas would have taken,
+    # what was added to each current line, the device positions and the
+    # header state. Committed strokes are numbered so changes to them are
+    # sent by id. Frames are queued and written by a background thread, so
+    # a render process that falls behind never blocks input.
+    def __init__(self, input_manager, event_processor, header_manager, connection, interval=0.002):
+        self.input_manager = input_manager
+        self.event_processor = event_processor
+        self.header_manager = header_manager
+        self.connection = connection
+        self.interval = interval
+        self.ids = {}
+        self.next_id = 0
+        # Every stroke is sent on the first frame, the canvas was restored
+        # before the render process could take its changes
+        self.needs_rebuild = True
+        # Current line and number of its points sent, per device
+        self.lines = {}
+        self.positions = {}
+        self.show_palette = None
+        self.last_stats_time = time.perf_counter()
+        self.outgoing = queue.SimpleQueue()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.write_loop, name="StrokeSender", daemon=True)
+
+    # Return the encoded form of a stroke, numbering it
+    def encode(self, stroke):
+        stroke_id = self.ids[stroke] = self.next_id
+        self.next_id += 1
+        return encode_stroke(stroke_id, stroke)
+
+    # Return a FRAME of what changed since the last one, or None
+    def take_frame(self):
+        input_manager = self.input_manager
+        rebuild, changes = input_manager.take_canvas_updates()
+        strokes = None
+        sent_changes = []
+        if rebuild or self.needs_rebuild:
+            self.needs_rebuild = False
+            self.ids = {}
+            strokes = [
+                self.encode(stroke)
+                for device in input_manager.get_stroke_devices()
+                for stroke in device.get_strokes()
+            ]
+        else:
+            for removed, added in changes:
+                removed_id = None if removed is None else self.ids.pop(removed, None)
+                sent_changes.append((removed_id, [self.encode(stroke) for stroke in added]))
+
+        lines = []
+        sent_lines = {}
+        for device_id, line, color, size in input_manager.get_current_lines():
+            sent_line, sent = self.lines.get(device_id, (None, 0))
+            reset = sent_line is not line
+            if reset:
+                sent = 0
+            if reset or len(line) > sent:
+                lines.append((device_id, reset, line[sent:].tobytes(), color, size))
+            sent_lines[device_id] = (line, len(line))
+        self.lines = sent_lines
+
+        positions = {device_id: input_manager.get_position(device_id) for device_id in sent_lines}
+        if positions == self.positions:
+            positions = None
+        else:
+            self.positions = positions
+
+        show_palette = self.header_manager.show_palette
+        if show_palette == self.show_palette:
+            show_palette = None
+        else:
+            self.show_palette = show_palette
+
+        input_time = self.event_processor.take_input_time()
+
+        stats = None
+        now = time.perf_counter()
+        if now - self.last_stats_time >= STATS_INTERVAL:
+            self.last_stats_time = now
+            stats = (
+                self.event_processor.take_event_counts(),
+                input_manager.erase_timer.take(),
+                input_manager.lock.wait.take(),
+                input_manager.lock.hold.take(),
+            )
+
+        if strokes is None and not sent_changes and not lines and positions is None \
+                and show_palette is None and input_time is None and stats is None:
+            return None
+        return (FRAME, strokes, sent_changes, lines, positions, show_palette, input_time, stats)
+
+    # Apply the messages from the render process, and return False once it
+    # asked to quit or went away
+    def receive(self):
+        try:
+            while self.connection.poll():
+                message = self.connection.recv()
+                if message[0] == QUIT:
+                    return False
+                if message[0] == VIEWPORT:
+                    viewport = self.event_processor.viewport
+                    viewport.origin, viewport.zoom = message[1], message[2]
+        except (EOFError, OSError):
+            logger.warning("Render process went away")
+            return False
+        return True
+
+    # Call step to apply input and send the frames until the render process
+    # quits
+    def run(self, step):
+        self.thread.start()
+        while self.receive() and not self.stop_event.is_set():
+            step()
+            frame = self.take_frame()
+            if frame is not None:
+                self.outgoing.put(frame)
+            time.sleep(self.interval)
+        self.outgoing.put(None)
+        self.thread.join()
+
+    def write_loop(self):
+        while True:
+            frame = self.outgoing.get()
+            if frame is None:
+                break
+            try:
+                self.connection.send(frame)
+            except OSError as error:
+                logger.warning(f"Sending to the render process failed: {error}")
+                self.stop_event.set()
+                break
+
+
+class StrokeMirror:
+    # The render process's copy of the input process's strokes, current
+    # lines and device positions, built from FRAMEs. It answers the
+    # InputManager and EventProcessor calls the canvas, the main loop and
+    # the metrics make, so they run unchanged on top of it.
+    def __init__(self):
+        self.strokes = {}
+        self.needs_rebuild = True
+        self.stroke_changes = []
+        self.lines = {}
+        self.positions = {}
+        self.show_palette = False
+        self.input_time = None
+        self.event_counts = {}
+        # Timings of the input process, for the metrics
+        self.erase_timer = Timer()
+        self.lock = TimedLock()
+
+    # Apply a FRAME from the input process
+    def apply(self, frame):
+        _, strokes, changes, lines, positions, show_palette, input_time, stats = frame
+        if strokes is not None:
+            self.strokes = dict(decode_stroke(encoded) for encoded in strokes)
+            self.needs_rebuild = True
+            self.stroke_changes = []
+        for removed_id, added in changes:
+            removed = None if removed_id is None else self.strokes.pop(removed_id, None)
+            added = dict(decode_stroke(encoded) for encoded in added)
+            self.strokes.update(added)
+            self.stroke_changes.append((removed, list(added.values())))
+
+        for device_id, reset, data, color, size in lines:
+            line = self.lines.get(device_id, (None,))[0]
+            if reset or line is None:
+                line = new_points()
+            line.frombytes(data)
+            self.lines[device_id] = (line, color, size)
+        if positions is not None:
+            self.positions = positions
+            for device_id in list(self.lines):
+                if device_id not in positions:
+                    del self.lines[device_id]
+
+        if show_palette is not None:
+            self.show_palette = show_palette
+        if input_time is not None and self.input_time is None:
+            self.input_time = input_time
+        if stats is not None:
+            event_counts, erase, lock_wait, lock_hold = stats
+            for device_id, count in event_counts.items():
+                self.event_counts[device_id] = self.event_counts.get(device_id, 0) + count
+            self.erase_timer.merge(erase)
+            self.lock.wait.merge(lock_wait)
+            self.lock.hold.merge(lock_hold)
+
+    # Return the mirror as the only device holding strokes
+    def get_stroke_devices(self):
+        return [self]
+
+    # Return the committed strokes in drawing order
+    def get_strokes(self):
+        return list(self.strokes.values())
+
+    def get_current_lines(self):
+        return [(device_id, line, color, size) for device_id, (line, color, size) in self.lines.items()]
+
+    def has_canvas_updates(self):
+        return self.needs_rebuild or bool(self.stroke_changes)
+
+    def take_canvas_updates(self):
+        updates = (self.needs_rebuild, self.stroke_changes)
+        self.needs_rebuild = False
+        self.stroke_changes = []
+        return updates
+
+    def get_active_inputs(self):
+        return list(self.positions)
+
+    def get_position(self, device_id):
+        return self.positions.get(device_id)
+
+    def take_input_time(self):
+        input_time = self.input_time
+        self.input_time = None
+        return input_time
+
+    def take_event_counts(self):
+        event_counts = self.event_counts
+        self.event_counts = {}
+        return event_counts
+
+
+class RenderLink:
+    # The render process's end of the split: forks the input process, which
+    # calls target(*args, connection), and applies the FRAMEs it sends. The
+    # process is forked rather than spawned, as spawning would run the main
+    # module again and open a second display. Input, stroke bookkeeping and
+    # erasing then run under their own GIL, so expensive rendering no longer
+    # delays reading devices.
+    def __init__(self, target, args, header_manager, join_timeout=30):
+        self.header_manager = header_manager
+        self.join_timeout = join_timeout
+        self.mirror = StrokeMirror()
+        context = multiprocessing.get_context("fork")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=target, args=(*args, child_connection), name="CanvasInput")
+        self.process.start()
+        child_connection.close()
+        logger.info(f"Started input process {self.process.pid}")
+
+    # Apply every frame received since the last call, and return False once
+    # the input process is gone
+    def receive(self):
+        try:
+            while self.connection.poll():
+                self.mirror.apply(self.connection.recv())
+        except (EOFError, OSError):
+            logger.error("Input process went away")
+            return False
+        if self.mirror.show_palette != self.header_manager.show_palette:
+            self.header_manager.show_palette = self.mirror.show_palette
+            self.header_manager.update_spans()
+            self.header_manager.needs_redraw = True
+        return True
+
+    # Tell the input process where the board is shown, so it maps device
+    # positions to the same board coordinates
+    def send_viewport(self, viewport):
+        try:
+            self.connection.send((VIEWPORT, viewport.origin, viewport.zoom))
+        except OSError as error:
+            logger.error(f"Sending the viewport to the input process failed: {error}")
+
+    # Ask the input process to finish and wait for it, which includes its
+    # final canvas snapshot
+    def stop(self):
+        try:
+            self.connection.send((QUIT,))
+            # Keep taking frames so the input process never blocks on a full
+            # pipe while finishing
+            deadline = time.monotonic() + self.join_timeout
+            while self.process.is_alive() and time.monotonic() < deadline:
+                if self.connection.poll(0.05):
+                    self.connection.recv()
+        except (EOFError, OSError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            logger.error("Input process did not finish, terminating it")
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+        logger.info(f"Input process exited with code {self.process.exitcode}")
@@ -0,0 +1,165 @@
+import struct
+import threading
+import time
+from collections import deque
+from logging_manager import logger
+
+# A session log starts with MAGIC, followed by records that each begin with
+# a kind byte. A device record maps a small index to a device path and name,
+# an event record holds the index, timestamp, type, code and value.
+MAGIC = b"CCSESSION1\n"
+DEVICE = 0
+EVENT = 1
+DEVICE_RECORD = struct.Struct("<BHHH")
+EVENT_RECORD = struct.Struct("<BHdHHi")
+
+
+class SessionRecorder:
+    # Input threads only append to a deque, a background thread packs the
+    # records and writes them through a buffered file
+    def __init__(self, path, flush_interval=0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.pending = deque()
+        self.devices = {}
+        self.stop_event = threading.Event()
+        self.file = open(path, "wb", buffering=64 * 1024)
+        self.file.write(MAGIC)
+        self.thread = threading.Thread(target=self.run, name="SessionRecorder", daemon=True)
+        self.thread.start()
+
+    # Declare a device, called before its events are recorded
+    def add_device(self, device_path, name):
+        self.pending.append((DEVICE, device_path, name))
+
+    # Record one raw event, cheap enough to call on every input event
+    def record(self, device_path, timestamp, event_type, code, value):
+        self.pending.append((EVENT, device_path, timestamp, event_type, code, value))
+
+    # Pack and write everything queued so far
+    def flush(self):
+        write = self.file.write
+        for _ in range(len(self.pending)):
+            record = self.pending.popleft()
+            if record[0] == DEVICE:
+                _, device_path, name = record
+                index = self.devices.setdefault(device_path, len(self.devices))
+                path_bytes = device_path.encode()
+                name_bytes = name.encode()
+                write(DEVICE_RECORD.pack(DEVICE, index, len(path_bytes), len(name_bytes)))
+                write(path_bytes)
+                write(name_bytes)
+            else:
+                _, device_path, timestamp, event_type, code, value = record
+                index = self.devices.get(device_path)
+                if index is None:
+                    continue
+                write(EVENT_RECORD.pack(EVENT, index, timestamp, event_type, code, value))
+        self.file.flush()
+
+    def run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    # Write what is left and close the log
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+        logger.info(f"Session recorded to {self.path}")
+
+
+# Yield the records of a session log as ('device', path, name) and
+# ('event', path, timestamp, type, code, value) tuples
+def read_session(path):
+    with open(path, "rb") as log:
+        if log.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a session log")
+        paths = {}
+        while True:
+            kind = log.read(1)
+            if not kind:
+                return
+            if kind[0] == DEVICE:
+                data = log.read(DEVICE_RECORD.size - 1)
+                if len(data) < DEVICE_RECORD.size - 1:
+                    return
+                _, index, path_length, name_length = DEVICE_RECORD.unpack(kind + data)
+                device_path = log.read(path_length).decode()
+                name = log.read(name_length).decode()
+                paths[index] = device_path
+                yield ("device", device_path, name)
+            elif kind[0] == EVENT:
+                # A session cut off mid-record ends at the last whole record
+                data = log.read(EVENT_RECORD.size - 1)
+                if len(data) < EVENT_RECORD.size - 1:
+                    return
+                _, index, timestamp, event_type, code, value = EVENT_RECORD.unpack(kind + data)
+                yield ("event", paths[index], timestamp, event_type, code, value)
+            else:
+                raise ValueError(f"Corrupt session log {path}")
+
+
+class SessionReplayer:
+    # Feeds a session log through the event processor queues, the same path
+    # live input takes. A speed of 1 replays in real time, 0 as fast as the
+    # render loop drains the queues.
+    def __init__(self, path, input_manager, event_processor, speed=1.0):
+        self.path = path
+        self.input_manager = input_manager
+        self.event_processor = event_processor
+        self.speed = speed
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="SessionReplayer", daemon=True)
+        self.queues = {}
+
+    # Devices come from the log, so there is nothing to add up front
+    def start(self, devices):
+        self.thread.start()
+
+    def add_device(self, device_path, name):
+        pass
+
+    def remove_device(self, device_path):
+        pass
+
+    def run(self):
+        first_timestamp = None
+        started = None
+        try:
+            for record in read_session(self.path):
+                if self.stop_event.is_set():
+                    break
+                if record[0] == "device":
+                    _, device_path, name = record
+                    if self.input_manager.pair_device(device_path, name, f"replay:{device_path}"):
+                        self.queues[device_path] = self.event_processor.add_device(device_path)
+                    continue
+
+                _, device_path, timestamp, event_type, code, value = record
+                queue = self.queues.get(device_path)
+                if queue is None:
+                    continue
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                    started = time.perf_counter()
+                if self.speed > 0:
+                    delay = (timestamp - first_timestamp) / self.speed - (time.perf_counter() - started)
+                    if delay > 0 and self.stop_event.wait(delay):
+                        break
+                else:
+                    # Wait for the render loop rather than overflow the queue
+                    while len(queue) > queue.limit // 2 and not self.stop_event.is_set():
+                        time.sleep(0.001)
+                queue.append((event_type, code, value, time.perf_counter()))
+        except (OSError, ValueError) as error:
+            logger.error(f"Replay of {self.path} failed: {error}")
+        logger.info(f"Replay of {self.path} finished")
+
+    # Stop replaying and unpair the replayed devices
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        for device_path in self.queues:
+            self.event_processor.remove_device(device_path)
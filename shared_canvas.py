@@ -0,0 +1,95 @@
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+import pygame
+from logging_manager import logger
+
+# A shared canvas segment starts with a header, followed by the pixels as
+# rows of R, G, B, X bytes. The header holds a magic, the sequence counter,
+# the width, height and row pitch of the pixels, and the (x, y, width,
+# height) of the canvas area within them, the rest is the header bar.
+HEADER = struct.Struct("<8sQIIIIIII")
+MAGIC = b"CCSHARE1"
+# Offset of the sequence counter in the header
+SEQUENCE_OFFSET = 8
+SEQUENCE = struct.Struct("<Q")
+# The pixels start on a cache line after the header
+PIXELS_OFFSET = 64
+PIXEL_FORMAT = "RGBX"
+
+
+class SharedCanvas:
+    # Pixels for the screen sized canvas layer in shared memory, so other
+    # processes can read the board without the render loop copying it. The
+    # sequence counter is odd while the render loop may be drawing and goes
+    # up to the next even number once it changed the pixels, readers copy
+    # while it stays the same even number.
+    def __init__(self, size, area):
+        width, height = size
+        pitch = width * 4
+        self.shm = shared_memory.SharedMemory(create=True, size=PIXELS_OFFSET + pitch * height)
+        self.name = self.shm.name
+        self.sequence = 0
+        HEADER.pack_into(self.shm.buf, 0, MAGIC, self.sequence, width, height, pitch, *area)
+        self.surface = pygame.image.frombuffer(self.shm.buf[PIXELS_OFFSET:], size, PIXEL_FORMAT)
+        logger.info(f"Canvas pixels shared as {self.name}")
+
+    # Mark the pixels as being drawn
+    def begin_write(self):
+        self.sequence += 1
+        SEQUENCE.pack_into(self.shm.buf, SEQUENCE_OFFSET, self.sequence)
+
+    # Mark the pixels as drawn, as a new frame if they changed and as the
+    # frame they were before otherwise
+    def end_write(self, changed):
+        self.sequence += 1 if changed else -1
+        SEQUENCE.pack_into(self.shm.buf, SEQUENCE_OFFSET, self.sequence)
+
+    # Remove the segment, once every surface over the pixels is gone
+    def close(self):
+        self.surface = None
+        self.shm.unlink()
+        self.shm.close()
+
+
+class SharedCanvasReader:
+    # Reads frames of a shared canvas, by its name when in another process,
+    # or through the mapping a forked process inherited
+    def __init__(self, name=None, shm=None):
+        if shm is None:
+            shm = shared_memory.SharedMemory(name=name)
+            # Attaching registers the segment to be removed when this
+            # process exits, which is the owner's to do
+            resource_tracker.unregister(shm._name, "shared_memory")
+        self.shm = shm
+        magic, _, self.width, self.height, self.pitch, *area = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{shm.name} is not a shared canvas")
+        self.area = pygame.Rect(area)
+
+    # Return the current sequence number
+    def get_sequence(self):
+        return SEQUENCE.unpack_from(self.shm.buf, SEQUENCE_OFFSET)[0]
+
+    # Return (sequence, surface) with a copy of the pixels of a frame newer
+    # than last_sequence, or None when there is none or it kept changing
+    # while it was copied
+    def read(self, last_sequence=None, attempts=5):
+        pixels = self.shm.buf[PIXELS_OFFSET:PIXELS_OFFSET + self.pitch * self.height]
+        try:
+            for _ in range(attempts):
+                sequence = self.get_sequence()
+                if sequence == last_sequence:
+                    return None
+                if sequence % 2:
+                    time.sleep(0.001)
+                    continue
+                data = bytes(pixels)
+                if self.get_sequence() == sequence:
+                    return sequence, pygame.image.frombuffer(data, (self.width, self.height), PIXEL_FORMAT)
+        finally:
+            pixels.release()
+        return None
+
+    def close(self):
+        self.shm.close()
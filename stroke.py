@@ -0,0 +1,182 @@
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Tools a stroke can be drawn with, in the order their numbers are saved
+TOOLS = ("Marker", "Eraser")
+
+# Range of the board coordinates a point buffer holds
+BOARD_MIN = -32768
+BOARD_MAX = 32767
+
+# Strokes with at least this many points are erased with NumPy when it is
+# installed, shorter ones cost less to loop over than to convert
+VECTOR_MIN_POINTS = 32
+
+
+class Stroke:
+    __slots__ = ('points', 'style')
+
+    # Points are a flat array('h') of board coordinates: x0, y0, x1, y1, ...
+    # The style is fixed when the stroke is committed, as a (color, width,
+    # tool) tuple that pieces split off by the eraser share.
+    def __init__(self, points, color, width, tool="Marker"):
+        self.points = points
+        self.style = (tuple(color), width, tool)
+
+    @property
+    def color(self):
+        return self.style[0]
+
+    @property
+    def width(self):
+        return self.style[1]
+
+    @property
+    def tool(self):
+        return self.style[2]
+
+    def __len__(self):
+        return len(self.points) // 2
+
+    # Return a stroke with the same style over a slice of the points
+    def with_points(self, points):
+        stroke = Stroke.__new__(Stroke)
+        stroke.points = points
+        stroke.style = self.style
+        return stroke
+
+    # Return the bounding box (left, top, right, bottom) of the points
+    def get_bounds(self):
+        xs = self.points[0::2]
+        ys = self.points[1::2]
+        return (min(xs), min(ys), max(xs), max(ys))
+
+    # Return the (x, y) pairs needed to draw the points
+    def get_pairs(self):
+        return point_pairs(self.points)
+
+
+# Return a new, empty point buffer
+def new_points():
+    return array('h')
+
+# Return the (x, y) pairs of a flat point buffer
+def point_pairs(points):
+    return list(zip(points[0::2], points[1::2]))
+
+# Return the points kept by Ramer-Douglas-Peucker simplification, walking
+# an explicit stack of ranges so long strokes cannot exhaust the recursion
+# limit. Points within tolerance pixels of the kept line are dropped. With
+# a max_gap, kept points are never further apart than that where the line
+# had points in between, as the eraser only hits a stroke's points.
+def simplify(points, tolerance, max_gap=None):
+    count = len(points) // 2
+    if count < 3 or tolerance <= 0:
+        return points
+    keep = bytearray(count)
+    keep[0] = keep[count - 1] = 1
+    tolerance_squared = tolerance * tolerance
+    max_gap_squared = max_gap * max_gap if max_gap else None
+    ranges = [(0, count - 1)]
+    while ranges:
+        first, last = ranges.pop()
+        x1, y1 = points[2 * first], points[2 * first + 1]
+        x2, y2 = points[2 * last], points[2 * last + 1]
+        dx = x2 - x1
+        dy = y2 - y1
+        length_squared = dx * dx + dy * dy
+        farthest = 0
+        index = first
+        for i in range(first + 1, last):
+            px = points[2 * i] - x1
+            py = points[2 * i + 1] - y1
+            if length_squared:
+                # Squared distance to the line, scaled by its squared length
+                cross = px * dy - py * dx
+                distance = cross * cross
+            else:
+                distance = px * px + py * py
+            if distance > farthest:
+                farthest = distance
+                index = i
+        limit = tolerance_squared * length_squared if length_squared else tolerance_squared
+        if farthest <= limit and max_gap_squared and last - first > 1 and length_squared > max_gap_squared:
+            # Straight, but too long to leave without a point in the middle
+            farthest = limit + 1
+            index = (first + last) // 2
+        if farthest > limit:
+            keep[index] = 1
+            ranges.append((first, index))
+            ranges.append((index, last))
+    simplified = new_points()
+    for i in range(count):
+        if keep[i]:
+            simplified.append(points[2 * i])
+            simplified.append(points[2 * i + 1])
+    return simplified
+
+# Return the pieces of a flat point buffer left after erasing every point
+# within radius of the eraser's path from start to end, or None when no
+# point is hit. Pieces of a single point are dropped.
+def erase_points(points, start, end, radius):
+    if numpy is not None and len(points) >= 2 * VECTOR_MIN_POINTS:
+        return erase_points_vectorized(points, start, end, radius)
+    x1, y1 = start
+    dx = end[0] - x1
+    dy = end[1] - y1
+    length_squared = dx * dx + dy * dy
+    radius_squared = radius * radius
+    pieces = []
+    begin = 0
+    hit = False
+    for i in range(0, len(points), 2):
+        px = points[i] - x1
+        py = points[i + 1] - y1
+        if length_squared:
+            # Offset from the closest point of the path
+            t = (px * dx + py * dy) / length_squared
+            if t >= 1:
+                px -= dx
+                py -= dy
+            elif t > 0:
+                px -= t * dx
+                py -= t * dy
+        if px * px + py * py < radius_squared:
+            hit = True
+            if i - begin >= 4:
+                pieces.append(points[begin:i])
+            begin = i + 2
+    if not hit:
+        return None
+    if len(points) - begin >= 4:
+        pieces.append(points[begin:])
+    return pieces
+
+# erase_points over the whole buffer at once: a mask of the points within
+# radius of the path, split into the runs of points it leaves
+def erase_points_vectorized(points, start, end, radius):
+    x1, y1 = start
+    dx = end[0] - x1
+    dy = end[1] - y1
+    length_squared = dx * dx + dy * dy
+    xy = numpy.frombuffer(points, dtype=numpy.int16).reshape(-1, 2)
+    px = xy[:, 0] - float(x1)
+    py = xy[:, 1] - float(y1)
+    if length_squared:
+        t = numpy.clip((px * dx + py * dy) / length_squared, 0, 1)
+        px -= t * dx
+        py -= t * dy
+    kept = px * px + py * py >= radius * radius
+    if kept.all():
+        return None
+    # Boundaries of the runs of kept points, as begin and end indices
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([False], kept, [False]))))
+    return [
+        points[2 * begin:2 * end]
+        for begin, end in zip(edges[0::2].tolist(), edges[1::2].tolist())
+        if end - begin >= 2
+    ]
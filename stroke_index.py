@@ -0,0 +1,65 @@
+class StrokeIndex:
+    def __init__(self, cell_size=32):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.strokes = {}
+
+    # Return the grid cells covered by the bounding box
+    def cells_in(self, left, top, right, bottom):
+        size = self.cell_size
+        return [
+            (cx, cy)
+            for cx in range(left // size, right // size + 1)
+            for cy in range(top // size, bottom // size + 1)
+        ]
+
+    # Index a stroke under every cell its segment bounding boxes touch
+    def add(self, stroke):
+        points = stroke.points
+        if not points:
+            return
+        size = self.cell_size
+        covered = set()
+        prev_x, prev_y = points[0], points[1]
+        covered.add((prev_x // size, prev_y // size))
+        for i in range(2, len(points), 2):
+            x, y = points[i], points[i + 1]
+            covered.update(self.cells_in(min(x, prev_x), min(y, prev_y), max(x, prev_x), max(y, prev_y)))
+            prev_x, prev_y = x, y
+        self.strokes[id(stroke)] = (stroke, covered, stroke.get_bounds())
+        for cell in covered:
+            self.cells.setdefault(cell, set()).add(id(stroke))
+
+    # Remove a stroke from the cells it was indexed under
+    def remove(self, stroke):
+        entry = self.strokes.pop(id(stroke), None)
+        if entry is None:
+            return
+        for cell in entry[1]:
+            ids = self.cells.get(cell)
+            if ids is not None:
+                ids.discard(id(stroke))
+                if not ids:
+                    del self.cells[cell]
+
+    # Return the bounding box (left, top, right, bottom) of an indexed stroke
+    def get_bounds(self, stroke):
+        entry = self.strokes.get(id(stroke))
+        return entry[2] if entry else None
+
+    # Return the strokes with a segment near the position, or near the path
+    # to it from start
+    def query(self, pos, radius, start=None):
+        x, y = pos
+        sx, sy = pos if start is None else start
+        found = set()
+        for cell in self.cells_in(min(x, sx) - radius, min(y, sy) - radius, max(x, sx) + radius, max(y, sy) + radius):
+            ids = self.cells.get(cell)
+            if ids:
+                found.update(ids)
+        return [self.strokes[stroke_id][0] for stroke_id in found]
+
+    # Remove every stroke from the index
+    def clear(self):
+        self.cells = {}
+        self.strokes = {}
@@ -0,0 +1,199 @@
+import math
+from collections import OrderedDict
+import pygame
+from stroke import point_pairs, new_points
+
+# Distance in pixels between the points interpolated along a stroke
+SMOOTH_STEP = 3
+# Strokes are drawn this many times larger and scaled down, which blends
+# their edges into the background
+SUPERSAMPLE = 2
+# Largest supersampled sprite drawn, in pixels, bigger strokes are drawn at
+# a lower factor
+MAX_SUPERSAMPLED = 4096 * 4096
+# A long stroke is split into sprites with tight bounds instead of one
+# mostly transparent one. A chunk of its points ends at a point whose hash
+# hits one in CHUNK_SPACING, or once it has CHUNK_POINTS points or runs
+# CHUNK_LENGTH pixels. The ends depend only on the points, so the pieces the
+# eraser leaves share the chunks of the stroke they were cut from.
+CHUNK_SPACING = 8
+CHUNK_POINTS = 32
+CHUNK_LENGTH = 96
+
+
+# Return the (x, y) pairs of a Catmull-Rom spline through the points of a
+# flat point buffer, with a pair about every step pixels. The spline passes
+# through every point, so sparse simplified strokes come out as curves.
+def smooth_path(points, step=SMOOTH_STEP):
+    pairs = point_pairs(points)
+    return smooth_pairs(pairs, 0, len(pairs) - 1, step)
+
+# Return the part of the spline through a list of pairs from the pair at
+# first to the one at last. The pairs either side of them only shape it.
+def smooth_pairs(pairs, first, last, step=SMOOTH_STEP):
+    count = len(pairs)
+    if count < 3:
+        return pairs[first:last + 1]
+    path = [pairs[first]]
+    for i in range(first, last):
+        x0, y0 = pairs[i - 1] if i > 0 else pairs[i]
+        x1, y1 = pairs[i]
+        x2, y2 = pairs[i + 1]
+        x3, y3 = pairs[i + 2] if i + 2 < count else pairs[i + 1]
+        steps = max(1, int(math.hypot(x2 - x1, y2 - y1) / step))
+        # Polynomial coefficients of the segment from (x1, y1) to (x2, y2)
+        bx = x2 - x0
+        by = y2 - y0
+        cx = 2 * x0 - 5 * x1 + 4 * x2 - x3
+        cy = 2 * y0 - 5 * y1 + 4 * y2 - y3
+        dx = 3 * (x1 - x2) + x3 - x0
+        dy = 3 * (y1 - y2) + y3 - y0
+        for j in range(1, steps):
+            t = j / steps
+            path.append((
+                x1 + 0.5 * t * (bx + t * (cx + t * dx)),
+                y1 + 0.5 * t * (by + t * (cy + t * dy))
+            ))
+        path.append((x2, y2))
+    return path
+
+# Return the indices of the points a stroke's chunks end at, the last point
+# included
+def chunk_ends(pairs):
+    ends = []
+    last = 0
+    length = 0
+    for i in range(1, len(pairs)):
+        x, y = pairs[i]
+        previous_x, previous_y = pairs[i - 1]
+        length += abs(x - previous_x) + abs(y - previous_y)
+        if (i - last >= CHUNK_POINTS or length >= CHUNK_LENGTH
+                or ((x * 0x9E3779B1 + y * 0x85EBCA77) >> 16) % CHUNK_SPACING == 0):
+            ends.append(i)
+            last = i
+            length = 0
+    if not ends or ends[-1] != len(pairs) - 1:
+        ends.append(len(pairs) - 1)
+    return ends
+
+# Draw connected lines with a disc at every point, so joints have no gaps
+# and the ends are round, and return the rect they cover
+def draw_round_lines(surface, color, pairs, width):
+    if len(pairs) < 2:
+        return pygame.draw.circle(surface, color, pairs[0], width / 2)
+    rect = pygame.draw.lines(surface, color, False, pairs, width)
+    radius = width / 2
+    if radius > 1:
+        for pair in pairs:
+            rect.union_ip(pygame.draw.circle(surface, color, pair, radius))
+    return rect
+
+
+class StrokeRenderer:
+    # Rasterizes committed strokes into anti-aliased sprites, kept with the
+    # board position of their top left corner so repainting a tile only
+    # blits them. A stroke's sprites share the point where one chunk of its
+    # path ends and the next begins, the disc drawn there covers the seam.
+    # Sprites are kept by their style and the points that shape them, with
+    # the point either side, so strokes with the same chunks share them.
+    # The least recently drawn strokes are dropped once their sprites take
+    # more than max_bytes, along with the sprites no other stroke uses.
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # (chunks, sprites) of each stroke drawn, least recent first
+        self.strokes = OrderedDict()
+        # [sprite, number of strokes using it] by chunk
+        self.sprites = {}
+
+    # Return the board area, as (left, top, right, bottom), a smoothed path
+    # covers when drawn at a width
+    def get_bounds(self, path, width):
+        pad = width / 2 + 1
+        xs = [x for x, _ in path]
+        ys = [y for _, y in path]
+        return (
+            math.floor(min(xs) - pad), math.floor(min(ys) - pad),
+            math.ceil(max(xs) + pad) + 1, math.ceil(max(ys) + pad) + 1
+        )
+
+    # Return the keys of a stroke's chunks, as (style, whether there is a
+    # point before, whether there is one after, points) tuples
+    def get_chunks(self, stroke):
+        pairs = point_pairs(stroke.points)
+        data = stroke.points.tobytes()
+        last = len(pairs) - 1
+        chunks = []
+        start = 0
+        for end in chunk_ends(pairs):
+            before = start > 0
+            after = end < last
+            chunks.append((stroke.style, before, after, data[(start - before) * 4:(end + 1 + after) * 4]))
+            start = end
+        return chunks
+
+    # Return the sprites of a stroke as (surface, rect) pairs, with rects
+    # in board coordinates, drawing the ones no stroke has yet
+    def get_sprites(self, stroke):
+        cached = self.strokes.get(stroke)
+        if cached is not None:
+            self.strokes.move_to_end(stroke)
+            return cached[1]
+        chunks = self.get_chunks(stroke)
+        sprites = []
+        for chunk in chunks:
+            entry = self.sprites.get(chunk)
+            if entry is None:
+                entry = self.sprites[chunk] = [self.rasterize_chunk(chunk), 0]
+                rect = entry[0][1]
+                self.size += rect.width * rect.height * 4
+            entry[1] += 1
+            sprites.append(entry[0])
+        self.strokes[stroke] = (chunks, sprites)
+        self.evict()
+        return sprites
+
+    # Draw the part of a stroke's path a chunk covers
+    def rasterize_chunk(self, chunk):
+        (color, width, _), before, after, data = chunk
+        points = new_points()
+        points.frombytes(data)
+        pairs = point_pairs(points)
+        path = smooth_pairs(pairs, int(before), len(pairs) - 1 - int(after))
+        return self.rasterize(path, color, width)
+
+    # Draw part of a smoothed path larger than it is shown and scale it
+    # down to a sprite with soft edges
+    def rasterize(self, path, color, line_width):
+        left, top, right, bottom = self.get_bounds(path, line_width)
+        width = right - left
+        height = bottom - top
+        scale = SUPERSAMPLE
+        while scale > 1 and width * height * scale * scale > MAX_SUPERSAMPLED:
+            scale -= 1
+        surface = pygame.Surface((width * scale, height * scale), pygame.SRCALPHA)
+        surface.fill((*color, 0))
+        pairs = [((x - left) * scale, (y - top) * scale) for x, y in path]
+        draw_round_lines(surface, (*color, 255), pairs, max(1, round(line_width * scale)))
+        if scale > 1:
+            surface = pygame.transform.smoothscale(surface, (width, height))
+        return surface, pygame.Rect(left, top, width, height)
+
+    # Drop the least recently drawn strokes beyond the memory limit, and the
+    # sprites only they used
+    def evict(self):
+        while self.size > self.max_bytes and len(self.strokes) > 1:
+            chunks = self.strokes.popitem(last=False)[1][0]
+            for chunk in chunks:
+                entry = self.sprites[chunk]
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.sprites[chunk]
+                    rect = entry[0][1]
+                    self.size -= rect.width * rect.height * 4
+
+    # Drop every sprite
+    def clear(self):
+        self.strokes = OrderedDict()
+        self.sprites = {}
+        self.size = 0
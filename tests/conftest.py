@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules live at the top of the repository and log to logs/ under the
+# working directory, as they do when the canvas is run
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.makedirs("logs", exist_ok=True)
@@ -0,0 +1,196 @@
+import socket
+import time
+import pytest
+from collab_server import (
+    CollabServer, CollabClient, FRAME, ADD, DEVICE, HELLO,
+    decode_operations, encode_operation, write_signed, write_style, write_text, write_varint
+)
+from input_manager import InputManager
+from stroke import Stroke, new_points
+
+USER_NAME = "Lenovo Bluetooth Mouse"
+
+
+# Call apply_remote on every peer until check passes or timeout runs out
+def wait_for(peers, check, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for peer in peers:
+            peer.apply_remote()
+        if check():
+            return
+        time.sleep(0.01)
+    pytest.fail("Peers did not sync in time")
+
+# Return each device's strokes as (device id, points) pairs
+def strokes_of(input_manager):
+    return sorted(
+        (device.device_id, stroke.points.tolist())
+        for device in input_manager.get_stroke_devices()
+        for stroke in device.get_strokes()
+    )
+
+def draw(input_manager, device_id, y, count=20):
+    for i in range(count):
+        input_manager.add_to_current_line(device_id, (100 + 10 * i, y))
+    input_manager.add_line(device_id)
+
+
+@pytest.fixture
+def server():
+    server = CollabServer(InputManager(1920, 1080), "server", host="127.0.0.1", port=0, max_pending=256 * 1024)
+    server.start()
+    deadline = time.monotonic() + 5
+    while getattr(server, "server", None) is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    server.port = server.server.sockets[0].getsockname()[1]
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client(server):
+    client = CollabClient(InputManager(1920, 1080), "client", "127.0.0.1", server.port)
+    yield client
+    client.stop()
+
+
+def test_sync_points_commit_erase_undo_redo(server, client):
+    server_im = server.input_manager
+    client_im = client.input_manager
+
+    # Strokes drawn before the client connects are sent when it does
+    server_im.pair_device("s1", USER_NAME, "server user")
+    draw(server_im, "s1", 200)
+    client.start()
+    wait_for([server, client], lambda: strokes_of(client_im) == [("remote:server:s1", strokes_of(server_im)[0][1])])
+
+    # Points show up as the remote device's current line before it commits
+    client_im.pair_device("c1", USER_NAME, "client user")
+    for i in range(5):
+        client_im.add_to_current_line("c1", (100 + 10 * i, 400))
+    wait_for([server, client], lambda: len(server_im.get_current_line("remote:client:c1") or ()) == 10)
+    for i in range(5, 20):
+        client_im.add_to_current_line("c1", (100 + 10 * i, 400))
+    client_im.add_line("c1")
+
+    def synced():
+        client_strokes = [points for device_id, points in strokes_of(client_im) if device_id == "c1"]
+        server_strokes = [points for device_id, points in strokes_of(server_im) if device_id == "remote:client:c1"]
+        return client_strokes == server_strokes
+
+    wait_for([server, client], lambda: synced() and len(server_im.find_device("remote:client:c1").get_strokes()) == 1)
+
+    # An erase splits the stroke on both sides
+    client_im.set_tool("c1", "Eraser")
+    client_im.erase("c1", (200, 400))
+    wait_for([server, client], lambda: synced() and len(server_im.find_device("remote:client:c1").get_strokes()) == 2)
+
+    client_im.undo("c1")
+    wait_for([server, client], lambda: synced() and len(server_im.find_device("remote:client:c1").get_strokes()) == 1)
+
+    client_im.redo("c1")
+    wait_for([server, client], lambda: synced() and len(server_im.find_device("remote:client:c1").get_strokes()) == 2)
+
+    # The server's own device was left alone
+    assert [points for device_id, points in strokes_of(server_im) if device_id == "s1"] == \
+        [points for device_id, points in strokes_of(client_im) if device_id == "remote:server:s1"]
+
+
+def test_undo_after_late_join(server, client):
+    server_im = server.input_manager
+    client_im = client.input_manager
+
+    # The client joins after the erase, so it only ever sees the pieces
+    server_im.pair_device("s1", USER_NAME, "server user")
+    draw(server_im, "s1", 200)
+    server_im.set_tool("s1", "Eraser")
+    server_im.erase("s1", (200, 200))
+    assert len(server_im.find_device("s1").get_strokes()) == 2
+    client.start()
+
+    def synced():
+        return strokes_of(client_im) == [("remote:server:" + device_id, points) for device_id, points in strokes_of(server_im)]
+
+    wait_for([server, client], lambda: synced() and len(client_im.find_device("remote:server:s1").get_strokes()) == 2)
+
+    # Undoing the erase brings the whole stroke back on the client too
+    server_im.undo("s1")
+    wait_for([server, client], lambda: synced() and len(client_im.find_device("remote:server:s1").get_strokes()) == 1)
+
+    server_im.redo("s1")
+    wait_for([server, client], lambda: synced() and len(client_im.find_device("remote:server:s1").get_strokes()) == 2)
+
+    # Undoing past what the client saw happen takes the pieces away
+    server_im.undo("s1")
+    server_im.undo("s1")
+    wait_for([server, client], lambda: synced() and not client_im.find_device("remote:server:s1").get_strokes())
+
+
+def test_slow_client_is_disconnected(server, client):
+    server_im = server.input_manager
+    client.start()
+
+    # A peer that introduces itself and then never reads, with a small
+    # receive buffer so the server's writes back up soon
+    slow = socket.socket()
+    slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    slow.connect(("127.0.0.1", server.port))
+    hello = bytes(encode_operation((HELLO, "slow")))
+    slow.sendall(FRAME.pack(len(hello)) + hello)
+
+    def labels():
+        return {connection.label for connection in server.connections}
+
+    wait_for([server, client], lambda: labels() == {"client", "slow"})
+
+    # Batches well under max_pending, which the client keeps up with
+    points = new_points()
+    points.extend(value for i in range(4000) for value in (i % 2000, 200 + i % 7))
+    server_im.pair_device("s1", USER_NAME, "server user")
+    deadline = time.monotonic() + 10
+    added = 0
+    while "slow" in labels() and time.monotonic() < deadline:
+        for _ in range(5):
+            server_im.add_stroke("s1", Stroke(points, (0, 0, 0), 5))
+            added += 1
+        server.apply_remote()
+        client.apply_remote()
+        time.sleep(server.batch_interval)
+    slow.close()
+
+    assert "slow" not in labels()
+    # The client keeping up stays connected and gets every stroke
+    wait_for([server, client], lambda: len(client.input_manager.find_device("remote:server:s1").get_strokes()) == added)
+    assert labels() == {"client"}
+
+
+# A stroke point past the range points are stored in, and widths that
+# would stall drawing or not fit in a saved canvas
+@pytest.mark.parametrize("width, x", [(5, 70000), (60000, 100), (70000, 100), (0, 100)])
+def test_malformed_stroke_disconnects(server, width, x):
+    peer = socket.create_connection(("127.0.0.1", server.port))
+    hello = bytes(encode_operation((HELLO, "bad")))
+    peer.sendall(FRAME.pack(len(hello)) + hello)
+
+    payload = bytearray(encode_operation((DEVICE, "b1", USER_NAME)))
+    payload.append(ADD)
+    write_text(payload, "b1")
+    write_style(payload, (0, 0, 0), width, "Marker")
+    write_varint(payload, 1)
+    write_signed(payload, x)
+    write_signed(payload, 0)
+    # Refused as malformed, which handle_connection logs and disconnects
+    with pytest.raises(ValueError):
+        decode_operations(payload)
+    peer.sendall(FRAME.pack(len(payload)) + bytes(payload))
+
+    peer.settimeout(5)
+    try:
+        while peer.recv(65536):
+            pass
+    except ConnectionResetError:
+        pass
+    peer.close()
+    wait_for([server], lambda: not server.connections)
+    assert server.input_manager.find_device("remote:bad:b1") is None
@@ -0,0 +1,58 @@
+from device_watcher import DeviceWatcher
+
+USER_NAME = "Lenovo Bluetooth Mouse"
+
+
+class FakeDevices:
+    # Device nodes by path, fed to a DeviceWatcher in place of /dev/input,
+    # with the on_add and on_remove calls it made
+    def __init__(self, device_names=(USER_NAME,)):
+        self.nodes = {}
+        self.calls = []
+        self.watcher = DeviceWatcher(
+            set(device_names),
+            lambda path, name: self.calls.append(("add", path, name)),
+            lambda path: self.calls.append(("remove", path)),
+            list_paths=lambda: list(self.nodes),
+            read_name=lambda path: self.nodes[path]
+        )
+
+    def add(self, path, name=USER_NAME):
+        self.nodes[path] = name
+        self.watcher.scan()
+
+    def remove(self, path):
+        del self.nodes[path]
+        self.watcher.scan()
+
+
+def test_replugged_device_is_paired_again():
+    devices = FakeDevices()
+    devices.add("/dev/input/event3")
+    devices.remove("/dev/input/event3")
+    devices.add("/dev/input/event7")
+    devices.remove("/dev/input/event7")
+    devices.add("/dev/input/event8")
+    assert devices.calls == [
+        ("add", "/dev/input/event3", USER_NAME),
+        ("remove", "/dev/input/event3"),
+        ("add", "/dev/input/event7", USER_NAME),
+        ("remove", "/dev/input/event7"),
+        ("add", "/dev/input/event8", USER_NAME),
+    ]
+    assert devices.watcher.get_paired() == {USER_NAME: "/dev/input/event8"}
+
+def test_second_node_is_paired_when_first_is_removed():
+    devices = FakeDevices()
+    devices.add("/dev/input/event3")
+    devices.add("/dev/input/event4")
+    devices.add("/dev/input/event5", "Some Keyboard")
+    assert devices.calls == [("add", "/dev/input/event3", USER_NAME)]
+    devices.remove("/dev/input/event3")
+    assert devices.calls[1:] == [
+        ("remove", "/dev/input/event3"),
+        ("add", "/dev/input/event4", USER_NAME),
+    ]
+    devices.remove("/dev/input/event5")
+    assert devices.watcher.get_paired() == {USER_NAME: "/dev/input/event4"}
+    assert len(devices.calls) == 3
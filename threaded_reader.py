@@ -0,0 +1,71 @@
+import threading
+import time
+from evdev import InputDevice
+from logging_manager import logger
+
+class ThreadedReader:
+    def __init__(self, input_manager, event_processor, recorder=None):
+        self.input_manager = input_manager
+        self.event_processor = event_processor
+        self.recorder = recorder
+        self.threads = {}
+        self.stop_events = {}
+
+    # Begin reading the given (path, name) pairs
+    def start(self, devices):
+        for device_path, name in devices:
+            self.add_device(device_path, name)
+
+    # Start a reader thread for a device unless one is already running
+    def add_device(self, device_path, name):
+        thread = self.threads.get(device_path)
+        if thread and thread.is_alive():
+            return
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self.handle_device, args=(device_path, name, stop_event))
+        self.threads[device_path] = thread
+        self.stop_events[device_path] = stop_event
+        thread.start()
+
+    # Ask a device's reader thread to stop, it exits on its next event or
+    # as soon as the device node goes away
+    def remove_device(self, device_path):
+        stop_event = self.stop_events.pop(device_path, None)
+        if stop_event:
+            stop_event.set()
+        self.threads.pop(device_path, None)
+
+    # A method to handle each device, events are only queued here and
+    # applied by the main loop so the reader never waits on the renderer
+    def handle_device(self, device_path, name, stop_event):
+        thread_name = threading.current_thread().name
+        if not self.input_manager.pair_device(device_path, name, thread_name):
+            logger.error(f"Failed to pair device {device_path}")
+            return
+
+        events = self.event_processor.add_device(device_path)
+        recorder = self.recorder
+        if recorder:
+            recorder.add_device(device_path, name)
+        try:
+            inputs = InputDevice(device_path)
+
+            for event in inputs.read_loop():
+                if stop_event.is_set():
+                    break
+                events.append((event.type, event.code, event.value, time.perf_counter()))
+                if recorder:
+                    recorder.record(device_path, event.timestamp(), event.type, event.code, event.value)
+
+        except OSError as error:
+            logger.warning(f"Stopped reading {device_path}: {error}")
+        finally:
+            self.event_processor.remove_device(device_path)
+
+    # Stop every reader thread and wait for them to finish
+    def stop(self):
+        threads = list(self.threads.values())
+        for device_path in list(self.stop_events):
+            self.remove_device(device_path)
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,70 @@
+import multiprocessing
+import os
+import pygame
+from logging_manager import logger, start_forked_listener
+from shared_canvas import SharedCanvasReader
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class ThumbnailExporter:
+    # Writes a downscaled image of the canvas area to path every interval
+    # seconds while the canvas changes, from a forked process reading the
+    # shared canvas, so the render loop neither copies nor encodes frames.
+    # PNG is written by pygame, WebP needs Pillow. The image replaces the
+    # previous one in a single rename, so viewers never see half of it.
+    def __init__(self, shared_canvas, path, interval=5.0, width=320):
+        self.shared_canvas = shared_canvas
+        self.path = path
+        self.interval = interval
+        self.width = width
+        context = multiprocessing.get_context("fork")
+        self.stop_event = context.Event()
+        self.process = context.Process(target=self.run, name="ThumbnailExporter", daemon=True)
+
+    # Return whether thumbnails can be written in the format of a path
+    @staticmethod
+    def supports(path):
+        return not path.lower().endswith(".webp") or Image is not None
+
+    # Fork the exporting process, done before other threads start
+    def start(self):
+        self.process.start()
+        logger.info(f"Exporting thumbnails to {self.path} every {self.interval} s")
+
+    def run(self):
+        log_listener = start_forked_listener()
+        reader = SharedCanvasReader(shm=self.shared_canvas.shm)
+        sequence = None
+        while not self.stop_event.wait(self.interval):
+            frame = reader.read(sequence)
+            if frame is None:
+                continue
+            sequence, surface = frame
+            self.write(surface.subsurface(reader.area))
+        log_listener.stop()
+
+    # Scale a frame down to the thumbnail width and write it
+    def write(self, surface):
+        width, height = surface.get_size()
+        size = (self.width, max(1, round(height * self.width / width)))
+        thumbnail = pygame.transform.smoothscale(surface, size)
+        # Keep the extension, pygame picks the format by it
+        root, extension = os.path.splitext(self.path)
+        temporary = f"{root}.tmp{extension}"
+        try:
+            if extension.lower() == ".webp":
+                Image.frombytes("RGB", size, pygame.image.tobytes(thumbnail, "RGB")).save(temporary, "WEBP")
+            else:
+                pygame.image.save(thumbnail, temporary)
+            os.replace(temporary, self.path)
+        except (OSError, pygame.error) as error:
+            logger.error(f"Writing thumbnail {self.path} failed: {error}")
+
+    # Stop exporting
+    def stop(self):
+        self.stop_event.set()
+        self.process.join()
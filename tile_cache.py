@@ -0,0 +1,205 @@
+import math
+import zlib
+from collections import OrderedDict
+import pygame
+from stroke import point_pairs
+from stroke_renderer import StrokeRenderer
+
+TILE_SIZE = 256
+
+
+# Compress the RGB pixels of a tile, the form tiles are evicted and saved in
+def compress_pixels(pixels):
+    return zlib.compress(pixels, 1)
+
+
+class Tile:
+    __slots__ = ('strokes', 'surface', 'compressed', 'dirty')
+
+    def __init__(self):
+        # Strokes overlapping the tile, in the order they are drawn
+        self.strokes = []
+        self.surface = None
+        self.compressed = None
+        self.dirty = True
+
+
+class TileCache:
+    # Splits the board into square tiles, each with the strokes that overlap
+    # it and a surface they are rendered to when the tile is first shown.
+    # At most max_surfaces tiles keep a surface, the least recently shown
+    # are compressed until they are needed again. Strokes are drawn from
+    # their cached sprites, up to max_sprite_bytes of them.
+    def __init__(self, tile_size=TILE_SIZE, max_surfaces=128, max_sprite_bytes=64 * 1024 * 1024):
+        self.tile_size = tile_size
+        self.max_surfaces = max_surfaces
+        self.tiles = {}
+        self.cached = OrderedDict()
+        # Keys of the tiles each stroke was added to, so removing it does
+        # not work them out again
+        self.keys = {}
+        self.renderer = StrokeRenderer(max_sprite_bytes)
+
+    # Return the keys of the tiles a stroke covers, taking its width and
+    # soft edge into account. The smoothed path between two points strays
+    # from their box by at most 2/27 of the distances between the points
+    # either side of them, which the box is padded by. Only the segments
+    # starting at the indices in segments are covered when it is given.
+    def tiles_of(self, stroke, segments=None):
+        pairs = point_pairs(stroke.points)
+        count = len(pairs)
+        size = self.tile_size
+        pad = stroke.width / 2 + 2
+        keys = set()
+        for i in segments if segments is not None else range(max(1, count - 1)):
+            x0, y0 = pairs[i - 1] if i > 0 else pairs[i]
+            x1, y1 = pairs[i]
+            x2, y2 = pairs[i + 1] if i + 1 < count else pairs[i]
+            x3, y3 = pairs[i + 2] if i + 2 < count else (x2, y2)
+            pad_x = pad + (abs(x2 - x0) + abs(x3 - x1)) * 2 / 27
+            pad_y = pad + (abs(y2 - y0) + abs(y3 - y1)) * 2 / 27
+            for tx in range(math.floor((min(x1, x2) - pad_x) / size), math.floor((max(x1, x2) + pad_x) / size) + 1):
+                for ty in range(math.floor((min(y1, y2) - pad_y) / size), math.floor((max(y1, y2) + pad_y) / size) + 1):
+                    keys.add((tx, ty))
+        return keys
+
+    # Return the keys of the tiles a piece the eraser left of a stroke
+    # covers, given the stroke's keys. The piece is a run of the stroke's
+    # points, so away from its two end segments its path is the stroke's,
+    # and those tiles are the stroke's within the piece's box padded by the
+    # most any of its segments strays. Only the end segments are worked out.
+    def tiles_of_piece(self, piece, stroke_keys):
+        count = len(piece.points) // 2
+        if count < 4:
+            return self.tiles_of(piece)
+        left, top, right, bottom = piece.get_bounds()
+        pad = piece.width / 2 + 2 + max(right - left, bottom - top) * 4 / 27
+        size = self.tile_size
+        min_x = math.floor((left - pad) / size)
+        max_x = math.floor((right + pad) / size)
+        min_y = math.floor((top - pad) / size)
+        max_y = math.floor((bottom + pad) / size)
+        keys = {key for key in stroke_keys if min_x <= key[0] <= max_x and min_y <= key[1] <= max_y}
+        keys |= self.tiles_of(piece, (0, count - 2))
+        return keys
+
+    # Draw strokes onto a tile surface in order, the sprites of each that
+    # overlap the tile in a single blits call. The sprites keep the order
+    # the strokes were drawn in, so strokes of the same style cannot be
+    # grouped without changing which one ends up on top.
+    def draw_strokes(self, surface, key, strokes):
+        area = pygame.Rect(key[0] * self.tile_size, key[1] * self.tile_size, self.tile_size, self.tile_size)
+        get_sprites = self.renderer.get_sprites
+        blits = []
+        for stroke in strokes:
+            if len(stroke.points) > 2:
+                for sprite, rect in get_sprites(stroke):
+                    if area.colliderect(rect):
+                        blits.append((sprite, (rect.x - area.x, rect.y - area.y)))
+        surface.blits(blits, doreturn=False)
+
+    # Forget every stroke and rendered tile, the sprites are kept for
+    # strokes that come back
+    def clear(self):
+        self.tiles = {}
+        self.cached = OrderedDict()
+        self.keys = {}
+
+    # Add a stroke on top of the tiles it covers and return their keys.
+    # Tiles already rendered have it drawn straight onto them.
+    def add(self, stroke, draw=True):
+        keys = self.keys[stroke] = self.tiles_of(stroke)
+        for key in keys:
+            tile = self.tiles.get(key)
+            if tile is None:
+                tile = self.tiles[key] = Tile()
+            tile.strokes.append(stroke)
+            if not draw:
+                continue
+            if tile.surface is not None and not tile.dirty:
+                self.draw_strokes(tile.surface, key, (stroke,))
+            else:
+                tile.dirty = True
+                tile.compressed = None
+        return keys
+
+    # Put strokes in place of one in every tile it covers, such as the
+    # pieces an eraser leaves or nothing at all, and return the keys of the
+    # tiles that must be rendered again
+    def replace(self, stroke, strokes):
+        keys = self.keys.pop(stroke, None)
+        if keys is None:
+            keys = self.tiles_of(stroke)
+        pieces = []
+        for piece in strokes:
+            piece_keys = self.keys[piece] = self.tiles_of_piece(piece, keys)
+            pieces.append((piece, piece_keys))
+        for key in keys:
+            tile = self.tiles.get(key)
+            if tile is None:
+                continue
+            try:
+                position = tile.strokes.index(stroke)
+            except ValueError:
+                continue
+            tile.strokes[position:position + 1] = [piece for piece, piece_keys in pieces if key in piece_keys]
+            if not tile.strokes:
+                del self.tiles[key]
+                self.cached.pop(key, None)
+            else:
+                tile.dirty = True
+                tile.compressed = None
+        return keys
+
+    # Return the rendered surface of a tile, or None when it is empty
+    def get_surface(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            return None
+        if tile.surface is None:
+            tile.surface = pygame.Surface((self.tile_size, self.tile_size))
+            if tile.compressed is not None and not tile.dirty:
+                tile.surface.blit(pygame.image.frombytes(zlib.decompress(tile.compressed), tile.surface.get_size(), "RGB"), (0, 0))
+        if tile.dirty:
+            tile.surface.fill((255, 255, 255))
+            self.draw_strokes(tile.surface, key, tile.strokes)
+            tile.dirty = False
+        tile.compressed = None
+        self.cached[key] = tile
+        self.cached.move_to_end(key)
+        return tile.surface
+
+    # Compress the least recently shown surfaces beyond the limit, except
+    # the tiles in keep
+    def evict(self, keep=()):
+        for key in list(self.cached):
+            if len(self.cached) <= self.max_surfaces:
+                break
+            if key in keep:
+                continue
+            tile = self.cached.pop(key)
+            if not tile.dirty:
+                tile.compressed = compress_pixels(pygame.image.tobytes(tile.surface, "RGB"))
+            tile.surface = None
+
+    # Return the rendered tiles as (tx, ty, pixels, compressed) tuples, with
+    # either the raw RGB pixels or the compressed form set
+    def export(self):
+        tiles = []
+        for (tx, ty), tile in self.tiles.items():
+            if tile.dirty:
+                continue
+            if tile.surface is not None:
+                tiles.append((tx, ty, pygame.image.tobytes(tile.surface, "RGB"), None))
+            elif tile.compressed is not None:
+                tiles.append((tx, ty, None, tile.compressed))
+        return tiles
+
+    # Use compressed renders of tiles instead of drawing them, for tiles
+    # whose strokes have not changed since
+    def load(self, tiles):
+        for tx, ty, compressed in tiles:
+            tile = self.tiles.get((tx, ty))
+            if tile is not None and tile.surface is None:
+                tile.compressed = compressed
+                tile.dirty = False
@@ -1,17 +1,26 @@
 import pygame
-from logging_manager import logger
 
 class ToolButton:
-    def __init__(self, text, symbol, position, color):
+    def __init__(self, text, symbol, position, color, background=(200, 200, 200)):
         self.text = text
         self.symbol = symbol
         self.position = position
         self.color = color
+        self.background = background
         self.font = pygame.font.Font(None, 36)
         self.text_surface = self.font.render(symbol, True, (0, 0, 0))
         self.button_rect = self.text_surface.get_rect(center=position).inflate(40, 20) # Increased hitbox size
+        # The button rendered in each (hover, clicked) state, the normal
+        # and hover states up front
+        self.surfaces = {}
+        self.get_surface(False, False)
+        self.get_surface(True, False)
 
-    def draw(self, screen, hover=False, clicked=False):
+    # Return the button rendered in a state onto a surface of its own size
+    def get_surface(self, hover, clicked):
+        surface = self.surfaces.get((hover, clicked))
+        if surface is not None:
+            return surface
         if clicked:
             rect_color = (max(0, self.color[0] - 100), max(0, self.color[1] - 100), max(0, self.color[2] - 100))
         elif hover:
@@ -19,10 +28,15 @@ class ToolButton:
         else:
             rect_color = self.color
 
-        pygame.draw.rect(screen, rect_color, self.button_rect, border_radius=5)
-        screen.blit(self.text_surface, self.text_surface.get_rect(center=self.button_rect.center))
+        surface = self.surfaces[(hover, clicked)] = pygame.Surface(self.button_rect.size)
+        surface.fill(self.background)
+        rect = surface.get_rect()
+        pygame.draw.rect(surface, rect_color, rect, border_radius=5)
+        surface.blit(self.text_surface, self.text_surface.get_rect(center=rect.center))
+        return surface
+
+    def draw(self, screen, hover=False, clicked=False):
+        screen.blit(self.get_surface(hover, clicked), self.button_rect)
 
-    def is_clicked(self, pos):
-        clicked = self.button_rect.collidepoint(pos)
-        logger.debug(f"Checking button '{self.text}' at {self.button_rect} for click at {pos}: {'Clicked' if clicked else 'Not Clicked'}")
-        return clicked
\ No newline at end of file
+    def get_rect(self):
+        return self.button_rect